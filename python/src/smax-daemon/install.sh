@@ -16,6 +16,10 @@ mkdir -p "$CONFIG/cryostat/selector"
 
 cp "./selector_smax_daemon.py" $INSTALL
 cp "./selector_interface.py" $INSTALL
+cp "./selector_watchdog.py" $INSTALL
+cp "./selector_events.py" $INSTALL
+cp "./selector_backends.py" $INSTALL
+cp "./selector_drift.py" $INSTALL
 cp "./selector_smax_daemon.service" $INSTALL
 cp "./on_start.sh" $INSTALL
 
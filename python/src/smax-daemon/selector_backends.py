@@ -0,0 +1,207 @@
+"""
+Pluggable SMA-X and systemd backends for the selector daemon.
+
+The daemon normally talks to a live SMA-X Redis server with `SmaxRedisClient`,
+and tells systemd about its state with `systemd.daemon.notify`.  For development
+and testing away from the antennas, the `memory` SMA-X backend keeps the SMA-X
+values in a `MemorySmaxStore` in the daemon's own process, and the notifier falls
+back to doing nothing when systemd-python is not installed.
+
+Several `MemorySmaxClient`s may share a store, e.g. one per simulated daemon and
+one for a test harness.  Each client delivers its pubsub notifications on its
+own thread, as `SmaxRedisClient` does, and can be degraded with extra latency
+and random connection failures.
+"""
+import collections
+import collections.abc
+import fnmatch
+import queue
+import random
+import threading
+import time
+
+from smax import SmaxRedisClient, SmaxConnectionError, SmaxKeyError, join
+
+try:
+    import systemd.daemon
+except ImportError: # systemd-python is not available on development machines
+    systemd = None
+
+#: list: Names of the available SMA-X backends
+smax_backends = ["redis", "memory"]
+
+#: A pubsub notification delivered to a subscription callback, with the fields of
+#: the smax-python messages used by the daemon.
+MemoryMessage = collections.namedtuple("MemoryMessage", ["data", "smaxname", "origin", "timestamp", "seq"])
+
+
+def null_notify(state):
+    """A systemd notifier that does nothing."""
+    return False
+
+
+def systemd_notify(state):
+    """Send `state` to systemd, or do nothing if systemd-python is not installed."""
+    if systemd is None:
+        return False
+    return systemd.daemon.notify(state)
+
+
+class MemorySmaxStore:
+    """In-memory stand-in for an SMA-X server, holding values and delivering notifications."""
+    def __init__(self):
+        self._values = {}
+        self._seq = collections.Counter()
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def share(self, name, value, origin):
+        """Store `value` as `name`, and notify the clients subscribed to it."""
+        with self._lock:
+            if isinstance(value, collections.abc.Mapping):
+                # Structures are stored by their leaves, as SMA-X does
+                for key in [k for k in self._values if k.startswith(name + ":")]:
+                    del self._values[key]
+                self._values.pop(name, None)
+                for key, leaf in _flatten(value, name):
+                    self._values[key] = leaf
+            else:
+                self._values[name] = value
+            self._seq[name] += 1
+            message = MemoryMessage(value, name, origin, time.time(), self._seq[name])
+            clients = [client for pattern, client in self._subscriptions
+                       if fnmatch.fnmatchcase(name, pattern)]
+        for client in clients:
+            client._deliver(message)
+
+    def pull(self, name):
+        """Return the value of `name`, or a dict of its leaves if it is a structure.
+
+        Raises:
+            SmaxKeyError: if there is no value or structure named `name`."""
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+            prefix = name + ":"
+            leaves = {k[len(prefix):]: v for k, v in self._values.items() if k.startswith(prefix)}
+        if not leaves:
+            raise SmaxKeyError(f"No key {name} in SMA-X")
+        struct = {}
+        for key, leaf in leaves.items():
+            *parents, last = key.split(":")
+            node = struct
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[last] = leaf
+        return struct
+
+    def subscribe(self, pattern, client):
+        with self._lock:
+            if (pattern, client) not in self._subscriptions:
+                self._subscriptions.append((pattern, client))
+
+    def unsubscribe(self, client, pattern=None):
+        with self._lock:
+            self._subscriptions = [(p, c) for p, c in self._subscriptions
+                                   if c is not client or (pattern is not None and p != pattern)]
+
+
+def _flatten(value, name):
+    """Yield the (name, value) of each leaf of a nested dict."""
+    for key, leaf in value.items():
+        if isinstance(leaf, collections.abc.Mapping):
+            yield from _flatten(leaf, join(name, key))
+        else:
+            yield join(name, key), leaf
+
+
+#: MemorySmaxStore: Store shared by memory clients that are not given one
+default_store = MemorySmaxStore()
+
+
+class MemorySmaxClient:
+    """A client of a `MemorySmaxStore`, with the methods of `SmaxRedisClient` used by the daemon."""
+    def __init__(self, store=None, program_name="memory", latency=0.0, jitter=0.0, failure_rate=0.0):
+        """Create a client.
+
+        Arguments:
+            store (MemorySmaxStore) : store to connect to. Defaults to `default_store`.
+            program_name (str) : name reported as the origin of shared values
+            latency (float) : extra time in seconds taken by every share and pull
+            jitter (float) : maximum random time in seconds added to `latency`
+            failure_rate (float) : fraction of shares and pulls that fail with SmaxConnectionError"""
+        self.store = store if store is not None else default_store
+        self.program_name = program_name
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._callbacks = {}
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _degrade(self):
+        """Apply the configured latency and failures to a request."""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise SmaxConnectionError("Simulated SMA-X connection failure")
+
+    def smax_connect_to(self, *args, **kwargs):
+        pass
+
+    def smax_disconnect(self):
+        self.smax_unsubscribe()
+
+    def smax_share(self, table, key, value):
+        self._degrade()
+        self.store.share(join(table, key), value, self.program_name)
+
+    def smax_pull(self, table, key):
+        self._degrade()
+        return self.store.pull(join(table, key))
+
+    def smax_subscribe(self, pattern, callback=None):
+        """Call `callback` with a `MemoryMessage` on each share of a name matching `pattern`."""
+        with self._lock:
+            self._callbacks[pattern] = callback
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, daemon=True,
+                                                name=f"{self.program_name} pubsub")
+                self._thread.start()
+        self.store.subscribe(pattern, self)
+
+    def smax_unsubscribe(self, pattern=None):
+        self.store.unsubscribe(self, pattern)
+        with self._lock:
+            if pattern is None:
+                self._callbacks.clear()
+            else:
+                self._callbacks.pop(pattern, None)
+
+    def _deliver(self, message):
+        self._queue.put(message)
+
+    def _dispatch(self):
+        """Run the subscription callbacks for each notification, in the order they were shared."""
+        while True:
+            message = self._queue.get()
+            with self._lock:
+                callbacks = [cb for pattern, cb in self._callbacks.items()
+                             if cb and fnmatch.fnmatchcase(message.smaxname, pattern)]
+            for callback in callbacks:
+                try:
+                    callback(message)
+                except Exception:
+                    pass
+
+
+def create_smax_client(backend, server, port, db, program_name, logger=None, debug=False):
+    """Create an SMA-X client using `backend`, one of `smax_backends`."""
+    if backend == "redis":
+        return SmaxRedisClient(redis_ip=server, redis_port=port, redis_db=db, program_name=program_name,
+                               debug=debug, logger=logger)
+    if backend == "memory":
+        return MemorySmaxClient(program_name=program_name)
+    raise ValueError(f"Unknown SMA-X backend {backend}, must be one of {smax_backends}")
@@ -0,0 +1,242 @@
+"""
+Online statistics of the selector angle error while the wheel is parked.
+
+While the wheel is parked, the controller corrects the position whenever the
+angle error drifts beyond the angle tolerance, and falls back to a full home if
+the corrective moves fail.  A `DriftMonitor` follows the angle error and the
+controller's correction and home fallback counters as the daemon polls them,
+keeping exponentially weighted statistics for each position in constant memory,
+and raises alerts while the drift or noise of the angle error is still well
+within the tolerance, before it leads to corrections and homes.
+"""
+import math
+
+from wsma_cryostat_selector import STATUS_SEQUENCE
+
+import selector_events
+
+#: str: Alert raised when the mean angle error at the parked position approaches the tolerance
+DRIFT = "drift"
+
+#: str: Alert raised when the scatter of the angle error at the parked position approaches the tolerance
+NOISE = "noise"
+
+#: str: Alert raised when the controller makes corrective moves faster than allowed
+CORRECTIONS = "corrections"
+
+#: str: Alert raised when the controller homes because corrective moves failed
+HOME_FALLBACK = "home_fallback"
+
+#: dict: Default settings of a DriftMonitor, overridden by the "drift" section of the config
+default_settings = {
+    "time_constant": 300.0,
+    "settle_time": 2.0,
+    "min_samples": 20,
+    "drift_fraction": 0.5,
+    "noise_fraction": 0.25,
+    "max_correction_rate": 6.0,
+    "hysteresis": 0.8,
+}
+
+#: float: Longest gap between samples in seconds that is still weighted by its length. Longer
+#: gaps, e.g. while the daemon was disconnected, count as a single sample interval.
+max_sample_gap = 60.0
+
+
+class PositionStats:
+    """Exponentially weighted mean and variance of the angle error at one position."""
+    __slots__ = ("mean", "variance", "samples", "last")
+
+    def __init__(self):
+        self.mean = 0.0
+        self.variance = 0.0
+        self.samples = 0
+        self.last = None
+
+    def add(self, value, now, time_constant):
+        """Add a sample `value` taken at time `now`, weighted by the time since the last sample."""
+        if self.samples == 0:
+            self.mean = value
+            self.variance = 0.0
+        else:
+            dt = now - self.last
+            if dt <= 0 or dt > max_sample_gap:
+                dt = min(max_sample_gap, time_constant)
+            alpha = 1.0 - math.exp(-dt / time_constant)
+            delta = value - self.mean
+            self.mean += alpha * delta
+            self.variance = (1.0 - alpha) * (self.variance + alpha * delta * delta)
+        self.samples += 1
+        self.last = now
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class DriftMonitor:
+    """Follows the angle error of the parked wheel and raises alerts on drift, noise and corrections."""
+    def __init__(self, time_constant=default_settings["time_constant"],
+                 settle_time=default_settings["settle_time"],
+                 min_samples=default_settings["min_samples"],
+                 drift_fraction=default_settings["drift_fraction"],
+                 noise_fraction=default_settings["noise_fraction"],
+                 max_correction_rate=default_settings["max_correction_rate"],
+                 hysteresis=default_settings["hysteresis"]):
+        """Create a monitor.
+
+        Arguments:
+            time_constant (float) : time constant of the exponential weighting in seconds
+            settle_time (float) : time after the wheel parks before its angle error is sampled, in seconds
+            min_samples (int) : number of samples at a position before it can raise drift or noise alerts
+            drift_fraction (float) : fraction of the angle tolerance above which the magnitude of
+                the mean angle error raises a drift alert
+            noise_fraction (float) : fraction of the angle tolerance above which the standard
+                deviation of the angle error raises a noise alert
+            max_correction_rate (float) : rate of corrective moves per hour above which a
+                corrections alert is raised
+            hysteresis (float) : fraction of each threshold below which a raised alert clears"""
+        self.time_constant = float(time_constant)
+        self.settle_time = float(settle_time)
+        self.min_samples = int(min_samples)
+        self.drift_fraction = float(drift_fraction)
+        self.noise_fraction = float(noise_fraction)
+        self.max_correction_rate = float(max_correction_rate)
+        self.hysteresis = float(hysteresis)
+
+        self.positions = {p: PositionStats() for p in range(1, 5)}
+        self.correction_rate = 0.0
+        self.corrections = 0
+        self.home_fallbacks = 0
+        self.alerts = set()
+
+        self._parked = None
+        self._parked_since = None
+        self._last_corrections = None
+        self._last_home_fallbacks = None
+        self._last_rate_time = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a monitor from the "drift" section of the daemon config."""
+        monitor = cls()
+        monitor.configure(config)
+        return monitor
+
+    def configure(self, config):
+        """Change the settings to those in the "drift" section of the config, keeping the
+        statistics gathered so far.
+
+        Raises:
+            ValueError: if the config has a setting that DriftMonitor does not have."""
+        settings = dict(default_settings)
+        settings.update(config or {})
+        unknown = set(settings) - set(default_settings)
+        if unknown:
+            raise ValueError(f"Unknown drift settings {sorted(unknown)}")
+        for name, value in settings.items():
+            setattr(self, name, type(default_settings[name])(value))
+
+    def reset(self):
+        """Forget the counter values, e.g. after the connection to the controller was lost.
+
+        The statistics of each position are kept, as the hardware has not changed."""
+        self._parked = None
+        self._parked_since = None
+        self._last_corrections = None
+        self._last_home_fallbacks = None
+        self._last_rate_time = None
+
+    def sample(self, status_word, angle_error, angle_tolerance, corrections, home_fallbacks, now):
+        """Add the values read by a poll of the controller.
+
+        Arguments:
+            status_word (int) : the controller's status word
+            angle_error (float) : angle error in degrees
+            angle_tolerance (float) : angle tolerance in degrees
+            corrections (int) : the controller's count of corrective moves while parked
+            home_fallbacks (int) : the controller's count of homes after failed corrective moves
+            now (float) : time of the poll in seconds
+
+        Returns:
+            list: (alert, raised, details) for each alert raised or cleared by the sample, where
+                `raised` is False when the alert clears."""
+        changes = []
+        self._count_corrections(corrections, now)
+
+        fallbacks = self._delta("_last_home_fallbacks", home_fallbacks)
+        if fallbacks:
+            self.home_fallbacks += fallbacks
+            changes.append((HOME_FALLBACK, True, {"home_fallbacks": self.home_fallbacks}))
+
+        status_word = int(status_word)
+        homing, moving, _ = selector_events.decode_status_word(status_word)
+        position = (status_word >> 4) & 15
+        if homing or moving or status_word & STATUS_SEQUENCE or position not in self.positions:
+            self._parked = None
+        elif position != self._parked:
+            self._parked = position
+            self._parked_since = now
+        elif now - self._parked_since >= self.settle_time:
+            stats = self.positions[position]
+            stats.add(float(angle_error), now, self.time_constant)
+            if stats.samples >= self.min_samples and angle_tolerance:
+                changes.extend(self._check(DRIFT, abs(stats.mean), self.drift_fraction * angle_tolerance,
+                                           position=position, mean=stats.mean))
+                changes.extend(self._check(NOISE, stats.std, self.noise_fraction * angle_tolerance,
+                                           position=position, std=stats.std))
+
+        changes.extend(self._check(CORRECTIONS, self.correction_rate, self.max_correction_rate,
+                                   correction_rate=self.correction_rate))
+        return changes
+
+    def _delta(self, name, count):
+        """Return the increase of a controller counter since the last sample.
+
+        The counters restart from 0 when the controller program restarts, so a decrease
+        counts as an increase from 0."""
+        count = int(count)
+        last = getattr(self, name)
+        setattr(self, name, count)
+        if last is None:
+            return 0
+        return count - last if count >= last else count
+
+    def _count_corrections(self, corrections, now):
+        """Update the exponentially decaying rate of corrective moves per hour."""
+        new = self._delta("_last_corrections", corrections)
+        self.corrections += new
+        if self._last_rate_time is not None:
+            dt = max(now - self._last_rate_time, 0.0)
+            self.correction_rate *= math.exp(-dt / self.time_constant)
+        self.correction_rate += new * 3600.0 / self.time_constant
+        self._last_rate_time = now
+
+    def _check(self, alert, value, threshold, **details):
+        """Raise or clear `alert` as `value` crosses `threshold`, returning any change."""
+        if alert not in self.alerts:
+            if value > threshold:
+                self.alerts.add(alert)
+                return [(alert, True, details)]
+        elif value < self.hysteresis * threshold:
+            self.alerts.discard(alert)
+            return [(alert, False, details)]
+        return []
+
+    def stats(self):
+        """Return the statistics as a dictionary, for logging to SMA-X."""
+        means = []
+        stds = []
+        samples = []
+        for position in sorted(self.positions):
+            stats = self.positions[position]
+            means.append(stats.mean)
+            stds.append(stats.std)
+            samples.append(stats.samples)
+        return {"mean": means,
+                "std": stds,
+                "samples": samples,
+                "correction_rate": self.correction_rate,
+                "corrections": self.corrections,
+                "home_fallbacks": self.home_fallbacks,
+                "alerts": ",".join(sorted(self.alerts)) or "none"}
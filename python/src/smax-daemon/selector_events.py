@@ -0,0 +1,86 @@
+"""
+Detection of selector state transitions from the controller's status word.
+
+The daemon polls the status word frequently, and the hardware interface also
+reports the moves and homes it commands.  A `TransitionDetector` turns the
+sequence of states into events such as "move_start" and "move_complete", so
+that each transition is reported once, whichever of the two saw it first.
+"""
+from wsma_cryostat_selector import STATUS_MOVING, STATUS_IN_POSITION, STATUS_IN_TOLERANCE
+
+# Commanded position written to the controller to start a home
+HOME_POSITION = 5
+
+MOVE_START = "move_start"
+MOVE_COMPLETE = "move_complete"
+HOME_START = "home_start"
+HOME_COMPLETE = "home_complete"
+TOLERANCE_EXCEEDED = "tolerance_exceeded"
+TOLERANCE_RESTORED = "tolerance_restored"
+COMM_LOST = "comm_lost"
+COMM_RESTORED = "comm_restored"
+
+
+def decode_status_word(status_word):
+    """Return the (homing, moving, in_tolerance) flags of a status word.
+
+    The wheel counts as moving until it has reached the commanded position and the
+    motor has stopped, and as homing while the commanded position is the home position."""
+    status_word = int(status_word)
+    homing = (status_word >> 8) & 15 == HOME_POSITION
+    moving = bool(status_word & STATUS_MOVING) or not status_word & STATUS_IN_POSITION
+    in_tolerance = bool(status_word & STATUS_IN_TOLERANCE)
+    return homing, moving, in_tolerance
+
+
+class TransitionDetector:
+    """Tracks the state of the selector and reports the transitions between states."""
+    def __init__(self):
+        self.homing = None
+        self.moving = None
+        self.in_tolerance = None
+
+    def reset(self):
+        """Forget the state, e.g. after the connection to the controller was lost."""
+        self.homing = None
+        self.moving = None
+        self.in_tolerance = None
+
+    def update(self, status_word):
+        """Record a new status word read from the controller.
+
+        Returns:
+            list: names of the events for the transitions since the last state."""
+        return self._transition(*decode_status_word(status_word))
+
+    def move_started(self):
+        """Record a move commanded by the daemon, before the controller reports it.
+
+        Returns:
+            list: names of the events for the transition."""
+        return self._transition(self.homing, True, self.in_tolerance)
+
+    def home_started(self):
+        """Record a home commanded by the daemon, before the controller reports it.
+
+        Returns:
+            list: names of the events for the transition."""
+        return self._transition(True, True, self.in_tolerance)
+
+    def _transition(self, homing, moving, in_tolerance):
+        """Move to a new state, and return the events for the transition."""
+        events = []
+        if self.homing is None:
+            # First state seen, so there is nothing to compare it to
+            pass
+        elif homing != self.homing:
+            events.append(HOME_START if homing else HOME_COMPLETE)
+        elif not homing:
+            if moving != self.moving:
+                events.append(MOVE_START if moving else MOVE_COMPLETE)
+            elif not moving and in_tolerance != self.in_tolerance and self.in_tolerance is not None:
+                events.append(TOLERANCE_RESTORED if in_tolerance else TOLERANCE_EXCEEDED)
+        self.homing = homing
+        self.moving = moving
+        self.in_tolerance = in_tolerance
+        return events
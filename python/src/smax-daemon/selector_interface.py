@@ -1,13 +1,31 @@
 from collections.abc import MutableMapping
+import logging
 import types
+import functools
 import threading
+import time
 
 import smax
 
-from wsma_cryostat_selector import Selector
+from wsma_cryostat_selector import Selector, StateWriter, ReplayClient, SimulatedController, home_phase_names
+
+import selector_events
+import selector_drift
 
 default_port = 502
 default_timeout = 10
+default_home_timeout = 60.0
+default_move_timeout = 60.0
+
+# Interval between reads of the home progress while homing
+home_poll_interval = 0.2
+# Interval between reads of the move status while moving
+move_poll_interval = 0.1
+
+# Selector config settings used when connecting to the controller, which only take
+# effect on a reload by reconnecting
+connection_settings = ["ip_address", "port", "transport", "simulate", "simulate_drift", "replay",
+                       "replay_speed", "transcript", "history", "wrap", "max_turns", "clear_stale_handles"]
 
 leaf_keys = [
     "function",
@@ -30,23 +48,56 @@ def flatten_logged_data(dictionary, parent_key="", separator=":"):
             items.append((new_key, value))
     return dict(items)
 
+class SelectorState:
+    """Snapshot of the logged data, updated in place by each logging action.
+    
+    `values` holds the value of each of `keys` in order, and is only valid while
+    `comm_status` is "good"."""
+    __slots__ = ("keys", "values", "comm_status", "comm_error")
+    
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.values = [None] * len(self.keys)
+        self.comm_status = "connection error"
+        self.comm_error = "No connection attempted"
+
 class SelectorInterface:
     """An daemon interface for communicating with a wSMA Cryomech Selector."""
-    def __init__(self, config=None, logger=None):
+    def __init__(self, config=None, logger=None, publish=None):
         """Create a new daemon class that carries out monitoring and control of a simulated
         piece of hardware. 
         
         Pass the initial config to the hardware object if given.
         
         Keyword Arguments:
-            config (dict) : dictionary of config values for the hardware and daemon"""
+            config (dict) : dictionary of config values for the hardware and daemon
+            publish (callable) : called with (key, value) to publish values to SMA-X immediately"""
         self._hardware = None
         self._hardware_config = None
         self._hardware_lock = threading.Lock()
         self._hardware_error = 'No connection attempted'
         self._hardware_data = {}
+        self._logged_plan = []
+        self.state = SelectorState([])
+        
+        self._home_thread = None
+        self._home_timeout = default_home_timeout
+        self._homes = 0
+        self._home_failures = 0
+        
+        self._move_thread = None
+        
+        self._state_writer = None
+        
+        self._transitions = selector_events.TransitionDetector()
+        self._comm_lost = False
+        self._handles_cleared = False
+        # (origin, position) of the last position request, reported with the events of its move
+        self._move_request = None
+        self._drift = selector_drift.DriftMonitor()
         
         self.logger = logger
+        self.publish = publish
         
         if config:
             self.configure(config)
@@ -71,10 +122,23 @@ class SelectorInterface:
         
         if 'config' in config.keys():
             self._hardware_config = config['config']
+            self._home_timeout = self._hardware_config["selector"].get("home_timeout", default_home_timeout)
+            shared_memory = self._hardware_config["selector"].get("shared_memory", None)
+            if shared_memory and self._state_writer is None:
+                try:
+                    self._state_writer = StateWriter(shared_memory)
+                    self.logger.info(f"Exporting selector state to shared memory {shared_memory}")
+                except Exception as e:
+                    self.logger.error(f"Could not create shared memory {shared_memory}: {e}")
+
+        if 'drift' in config.keys():
+            self._drift = selector_drift.DriftMonitor.from_config(config['drift'])
+            self.logger.debug(f"Got drift config: {config['drift']}")
 
         if 'logged_data' in config.keys():
             self._hardware_data = flatten_logged_data(config['logged_data'])
             self.logger.debug(f"Got logged_data: {self._hardware_data}")
+            self._plan_logging()
             
         if self._hardware and self._hardware_config:
             with self._hardware_lock:
@@ -83,8 +147,104 @@ class SelectorInterface:
                 except AttributeError:
                     pass
 
+    def reconfigure(self, config, changed):
+        """Apply a reloaded config to the running interface, changing only what is needed.
+        
+        The wheel is never moved: the initial position, speed, tolerance and offset in the
+        config only apply at start up.  The controller is only reconnected if a setting in
+        `connection_settings` changed.
+        
+        Arguments:
+            config (dict) : the reloaded config
+            changed (set) : names of the config values that changed, as colon separated paths
+                
+        Returns:
+            bool : True if the controller was reconnected"""
+        def touched(prefix):
+            return any(c == prefix or c.startswith(prefix + ":") for c in changed)
+        
+        if touched("drift"):
+            try:
+                self._drift.configure(config.get("drift"))
+                self.logger.info(f"Reconfigured drift monitor: {config.get('drift')}")
+            except (ValueError, TypeError) as e:
+                self.logger.error(f"Invalid drift config {config.get('drift')}: {e}")
+        
+        if touched("logged_data"):
+            hardware_data = flatten_logged_data(config.get("logged_data", {}))
+            # Swap the plan under the lock, so that a logging action never reads with a
+            # plan that does not match its state snapshot
+            with self._hardware_lock:
+                self._hardware_data = hardware_data
+                self._plan_logging()
+            self.logger.info(f"Logging {len(self._hardware_data)} keys")
+        
+        if not touched("config"):
+            return False
+        
+        self._hardware_config = config["config"]
+        selector = self._hardware_config["selector"]
+        self._home_timeout = selector.get("home_timeout", default_home_timeout)
+        
+        if touched("config:selector:shared_memory"):
+            if self._state_writer:
+                self._state_writer.close()
+                self._state_writer = None
+            shared_memory = selector.get("shared_memory", None)
+            if shared_memory:
+                try:
+                    self._state_writer = StateWriter(shared_memory)
+                    self.logger.info(f"Exporting selector state to shared memory {shared_memory}")
+                except Exception as e:
+                    self.logger.error(f"Could not create shared memory {shared_memory}: {e}")
+        
+        if any(touched(f"config:selector:{setting}") for setting in connection_settings):
+            self.logger.status(f"Reconnecting to selector at {selector['ip_address']} for the new config")
+            self._reconnect_hardware()
+            return True
+        
+        if touched("config:selector:position_corrections") and selector.get("position_corrections", None):
+            try:
+                with self._hardware_lock:
+                    if self._hardware:
+                        self._hardware.set_position_corrections(selector["position_corrections"])
+            except ValueError as e:
+                self.logger.error(f"Invalid position corrections {selector['position_corrections']}: {e}")
+            except Exception as e: # Except hardware errors
+                self._lose_hardware(e)
+                self.logger.error(f"Could not set position corrections: {self._hardware_error}")
+        return False
+    
+    def _reconnect_hardware(self):
+        """Replace the connection to the controller with one made with the current config.
+        
+        The old connection is closed and the new one made in one locked section, so that no
+        other thread connects in between.  This is a planned change, so no comm_lost event is
+        published for it."""
+        with self._hardware_lock:
+            if self._hardware:
+                try:
+                    self._hardware.disconnect()
+                except Exception as e:
+                    self.logger.warning(f"Error disconnecting from selector: {e}")
+            self._hardware = None
+            self._hardware_error = "reconnecting"
+            self._transitions.reset()
+            self._drift.reset()
+            self._connect_hardware()
+    
     def connect_hardware(self):
-        """Create and initialize hardware communication object."""
+        """Create and initialize hardware communication object, if there is none."""
+        with self._hardware_lock:
+            # Another thread may have connected while this one waited for the lock
+            if self._hardware:
+                return
+            self._connect_hardware()
+    
+    def _connect_hardware(self):
+        """Create and initialize hardware communication object.
+        
+        Call with the hardware lock held."""
         self._selector_ip = self._hardware_config["selector"]["ip_address"]
         if "port" in self._hardware_config["selector"].keys():
             self._selector_port = self._hardware_config["port"]
@@ -93,20 +253,51 @@ class SelectorInterface:
             
         self.logger.debug(f"Connecting to {self._selector_ip}:{self._selector_port}")
         
+        # Answer commands from a recorded transcript instead of the controller
+        client_factory = None
+        replay = self._hardware_config["selector"].get("replay", None)
+        if replay:
+            self.logger.warning(f"Replaying controller transcript {replay}")
+            client_factory = functools.partial(ReplayClient, replay,
+                                               speed=self._hardware_config["selector"].get("replay_speed", 1.0))
+        
+        # Use a simulated controller, running moves faster than real time by the given factor
+        simulate = self._hardware_config["selector"].get("simulate", None)
+        if simulate:
+            self.logger.warning(f"Using a simulated controller with time scale {simulate}")
+            client_factory = functools.partial(SimulatedController, time_scale=float(simulate),
+                                               drift=self._hardware_config["selector"].get("simulate_drift", 0.0))
+        
         try:
-            with self._hardware_lock:
-                self._hardware = Selector( \
-                    ip_address = self._selector_ip)
-                self._hardware_error = "None"
-                self.logger.debug(f"Connected")
-                if self._hardware and self._hardware_config:
-                    try:   
-                        self.configure_hardware(self._hardware_config)
-                    except AttributeError:
-                        pass
+            self._hardware = Selector( \
+                ip_address = self._selector_ip,
+                history = self._hardware_config["selector"].get("history", None),
+                wrap = self._hardware_config["selector"].get("wrap", True),
+                max_turns = self._hardware_config["selector"].get("max_turns", None),
+                name = "selector_smax_daemon",
+                client_factory = client_factory,
+                transcript = self._hardware_config["selector"].get("transcript", None),
+                transport = self._hardware_config["selector"].get("transport", None))
+            self._hardware_error = "None"
+            self.logger.debug(f"Connected on handle {self._hardware.handle}")
+            if self._comm_lost:
+                self._comm_lost = False
+                self._publish_event(selector_events.COMM_RESTORED)
+            # Stale handles can only have been left by a crash before the daemon started,
+            # so they are only cleared on the first connection
+            if self._hardware_config["selector"].get("clear_stale_handles", False) and not self._handles_cleared:
+                self._handles_cleared = True
+                self._hardware.clear_stale_handles()
+            # Without corrections in the config, keep those already on the controller
+            if self._hardware_config["selector"].get("position_corrections", None):
+                self._hardware.set_position_corrections(self._hardware_config["selector"]["position_corrections"])
+            if self._hardware and self._hardware_config:
+                try:   
+                    self.configure_hardware(self._hardware_config)
+                except AttributeError:
+                    pass
         except Exception as e: # Hardware connection errors
-            self._hardware = None
-            self._hardware_error = repr(e)
+            self._lose_hardware(e)
             self.logger.error(f"Failed to connect to selector at {self._selector_ip} with error {e}.")
             
     def initialize_hardware(self, kwargs):
@@ -121,7 +312,7 @@ class SelectorInterface:
             if pos == 5 or pos == 0:
                 self.logger.status(f"Homing selector.")
                 try:
-                    self._hardware.home()
+                    self.start_home()
                 except Exception as e:
                     self.logger.error(f"Could not home selector: {e}")
             else:
@@ -134,67 +325,345 @@ class SelectorInterface:
             self.logger.info(f"No default selector position given.")
             
     def disconnect_hardware(self):
+        if self._hardware:
+            self._hardware.disconnect()
         self._hardware = None
         self._hardware_error = "disconnected"
+        if self._state_writer:
+            self._state_writer.close()
+            self._state_writer = None
+        
+    def reset_hardware_connection(self):
+        """Close the controller handle to break a hung hardware call.
+        
+        Does not take the hardware lock, which the hung call is holding.
+
+        Returns:
+            bool: False if the hung call could not be broken, True otherwise."""
+        hardware = self._hardware
+        if hardware:
+            return hardware.abort_connection()
+        return True
+        
+    def export_state(self):
+        """Write the state last read from the hardware to shared memory, if configured.
+        
+        Call with the hardware lock held."""
+        if self._state_writer and self._hardware:
+            self._state_writer.write_selector(self._hardware)
+        
+    def _lose_hardware(self, error):
+        """Drop the hardware object after a hardware error, and report the loss of communication."""
+        self._hardware_error = repr(error)
+        if self._hardware:
+            # Release the shared connection, so that its handle, transcript and history
+            # are closed rather than leaked
+            try:
+                self._hardware.disconnect()
+            except Exception as e:
+                self.logger.warning(f"Error disconnecting from selector: {e}")
+        self._hardware = None
+        self._transitions.reset()
+        self._drift.reset()
+        if not self._comm_lost:
+            self._comm_lost = True
+            self._publish_event(selector_events.COMM_LOST, error=self._hardware_error)
+        
+    def _publish_event(self, event, timestamp=None, **extra):
+        """Publish a state transition event to SMA-X.
+        
+        The event is published as a structure in `event`, whose pubsub notification
+        downstream systems can subscribe to, and its timestamp in `last_<event>`.
+        
+        Arguments:
+            event (str) : name of the event, one of the names in selector_events
+            timestamp (float) : host epoch time of the event. Defaults to the time at which the
+                controller sampled the last values read, or the current time if there are none.
+
+        Move events also carry the `origin` of the position request that commanded the move,
+        or None if the move was not commanded by a position request."""
+        hardware = self._hardware
+        if timestamp is None:
+            timestamp = getattr(hardware, "timestamp", None) or time.time()
+        data = {"type": event, "timestamp": timestamp}
+        if hardware:
+            for attribute in ("command_position", "position", "angle", "angle_error", "status_word"):
+                data[attribute] = getattr(hardware, attribute, None)
+        if event in (selector_events.MOVE_START, selector_events.MOVE_COMPLETE):
+            request = self._move_request
+            if request and request[1] == data.get("command_position"):
+                data["origin"] = request[0]
+            else:
+                data["origin"] = None
+        data.update(extra)
+        self.logger.info(f"Selector event {event} at {timestamp:.3f}")
+        self._publish("event", data)
+        self._publish(f"last_{event}", timestamp)
+        
+    def _publish_events(self, events, timestamp=None):
+        """Publish each of a list of events."""
+        for event in events:
+            self._publish_event(event, timestamp)
+        
+    def check_transitions(self):
+        """Publish the events for any transitions in the status word last read from the hardware.
+        
+        Call with the hardware lock held."""
+        if self._hardware:
+            self._publish_events(self._transitions.update(self._hardware.status_word))
+            
+    def check_drift(self):
+        """Add the angle error and correction counts last read from the hardware to the drift
+        statistics, and publish any drift alerts raised or cleared.
+        
+        Call with the hardware lock held."""
+        hardware = self._hardware
+        if not hardware:
+            return
+        changes = self._drift.sample(hardware.status_word, hardware.angle_error,
+                                     getattr(hardware, "angle_tolerance", None),
+                                     hardware.corrections, hardware.home_fallbacks, time.monotonic())
+        for alert, raised, details in changes:
+            if raised:
+                self.logger.warning(f"Selector drift alert {alert}: {details}")
+            else:
+                self.logger.info(f"Selector drift alert {alert} cleared: {details}")
+            data = {"type": alert, "raised": raised, "timestamp": time.time()}
+            data.update(details)
+            self._publish("drift_alert", data)
+            
+    def drift_stats(self):
+        """Return the angle error statistics of each parked position, and the correction and
+        home fallback counts, for logging."""
+        return self._drift.stats()
+        
+    def _move_started(self):
+        """Report a move as soon as it has been commanded."""
+        self._publish_events(self._transitions.move_started(), time.time())
+        
+    def poll_events(self):
+        """Read the status word from the hardware, and publish the events for any transitions.
+        
+        Skips the poll if another thread is using the hardware, so that polling never
+        waits behind a long command. Moves and homes commanded by the daemon are
+        also reported by the threads that follow them."""
+        if self._hardware is None:
+            return
+        if not self._hardware_lock.acquire(blocking=False):
+            return
+        try:
+            if self._hardware is None:
+                return
+            if self._hardware.poll_fast():
+                self.export_state()
+                self.check_transitions()
+            self.check_drift()
+        except Exception as e: # Except hardware errors
+            self._lose_hardware(e)
+            self.logger.error(f'Selector status poll failed with {self._hardware_error}')
+        finally:
+            self._hardware_lock.release()
+        
+    def _plan_logging(self):
+        """Work out once how to read each logged data key, and create the state snapshot they
+        are read into.
+        
+        Each key is read from the attribute or function given in the config, or from the
+        attribute named by the key itself. Compound names separated by '.' are followed
+        down to the leaf attribute."""
+        plan = []
+        for data, spec in self._hardware_data.items():
+            if "attribute" in spec:
+                attribute = spec["attribute"]
+            elif "function" in spec:
+                attribute = spec["function"]
+            else:
+                attribute = data.replace(":", ".")
+            args = spec.get("args", [])
+            if type(args) is not list:
+                args = [args]
+            plan.append((attribute.split("."), args))
+        self._logged_plan = plan
+        self.state = SelectorState(self._hardware_data.keys())
         
     def logging_action(self):
-        """Get logging data from hardware and share to SMA-X"""
+        """Get logging data from hardware into the state snapshot, to be shared to SMA-X
+        
+        Returns:
+            SelectorState : the snapshot, updated in place"""
         # check for hardware connection, and connect if not present
         # This will automatically retry the connection every logging_interval
         # We could instead set up a connection retrying loop, but this
         # seems like it would work for most things, and will provide
         # feedback to the 
+        state = self.state
         if self._hardware is None:
             self.connect_hardware()
         
         if self._hardware:
             try:
                 with self._hardware_lock:
+                    # The logging plan may have been reloaded while waiting for the lock
+                    state = self.state
                     self._hardware.update_all()
+                    self.export_state()
+                    self.check_transitions()
+                    self.check_drift()
                     
-                    logged_data = {}
                     # do logging gets
-                    for data in self._hardware_data.keys():
-                        if "attribute" in self._hardware_data[data]:
-                            attribute = self._hardware_data[data]["attribute"]
-                        elif "function" in self._hardware_data[data]:
-                            attribute = self._hardware_data[data]["function"]
-                        else:
-                            attribute = data.replace(":", ".")
-                        self.logger.debug(f"attempting to get data {attribute}")
-                        reading = self.__getattr__(attribute.split(".")[0])
+                    debug = self.logger.isEnabledFor(logging.DEBUG)
+                    values = state.values
+                    for i, (parts, args) in enumerate(self._logged_plan):
+                        reading = self.__getattr__(parts[0])
                         # If this is a compound key, push down to the leaf attribute
-                        if len(attribute.split(".")) > 1:
-                            for d in attribute.split(".")[1:]:
-                                reading = reading.__getattribute__(d)
+                        for d in parts[1:]:
+                            reading = reading.__getattribute__(d)
                         # If this is a method, call it to get the value
                         if type(reading) is types.MethodType:
-                            if "args" in self._hardware_data[data].keys():
-                                args = self._hardware_data[data]["args"]
-                                if type(args) is not list:
-                                    args = [args]
-                                self.logger.debug(f"calling {reading} with arguments {args}.")
-                                reading = reading(*args)
-                            else:
-                                self.logger.debug(f"calling {reading}")
-                                reading = reading()
-                        logged_data[data] = reading
-                        self.logger.info(f'Got data for hardware {data}: {reading}')
-                logged_data['comm_status'] = "good"
-                logged_data['comm_error'] = "None"
+                            reading = reading(*args)
+                        values[i] = reading
+                        if debug:
+                            self.logger.debug(f'Got data for hardware {state.keys[i]}: {reading}')
+                state.comm_status = "good"
+                state.comm_error = "None"
             except Exception as e: # Except hardware connection errors
-                self._hardware = None
+                # Reconnect at the next logging interval, rather than retrying here
+                self._lose_hardware(e)
                 self.logger.error(f'Connection Error {e}')
-                logged_data = {'comm_status':'connection error'}
-                logged_data['comm_error'] = repr(e)
-                self.logging_action()
+                state.comm_status = 'connection error'
+                state.comm_error = repr(e)
         else:
             self.logger.error(f'Selector device not connected')
-            logged_data = {'comm_status':"connection error",
-                           'comm_error':"Not Connected"}
+            state.comm_status = "connection error"
+            state.comm_error = "Not Connected"
+        
+        return state
+        
+    def _publish(self, key, value):
+        """Publish a value to SMA-X immediately, if a publisher has been set."""
+        if self.publish:
+            try:
+                self.publish(key, value)
+            except Exception as e:
+                self.logger.warning(f"Could not publish {key}: {e}")
+
+    def start_home(self):
+        """Start homing the selector, and follow the progress of the home in a separate thread.
+        
+        Returns immediately, so the hardware lock is only held while starting the home
+        and for each progress read. A move in progress is finished first."""
+        if self._home_thread and self._home_thread.is_alive():
+            self.logger.warning("Selector is already homing")
+            return
+        if self._move_thread and self._move_thread.is_alive():
+            self._move_thread.join(default_move_timeout)
+        
+        with self._hardware_lock:
+            self._move_request = None
+            self._hardware.start_home()
+            self._publish_events(self._transitions.home_started(), time.time())
+        self._publish("home_status", "homing")
+        
+        self._home_thread = threading.Thread(target=self._monitor_home, daemon=True, name='Home')
+        self._home_thread.start()
         
-        return logged_data
+    def _monitor_home(self):
+        """Follow the progress of a home, publishing each phase to SMA-X.
         
+        If the home takes longer than the home timeout, the timeout is reported, but the
+        controller is still homing, so the home is followed until it finishes and move
+        requests are refused until then."""
+        start = time.monotonic()
+        phase = None
+        timed_out = False
+        try:
+            while True:
+                time.sleep(home_poll_interval)
+                with self._hardware_lock:
+                    new_phase, done = self._hardware.poll_home()
+                if new_phase != phase:
+                    phase = new_phase
+                    self.logger.info(f"Selector home phase: {home_phase_names.get(phase, phase)}")
+                    self._publish("home_phase", home_phase_names.get(phase, str(phase)))
+                if done:
+                    break
+                if not timed_out and time.monotonic() - start > self._home_timeout:
+                    timed_out = True
+                    self._home_failures += 1
+                    self.logger.error(f"Selector home did not complete within {self._home_timeout} s, "
+                                      f"in phase {home_phase_names.get(phase, phase)}. "
+                                      "Refusing moves until it does")
+                    self._publish("home_status", "timeout")
+                    self._publish("home_failures", self._home_failures)
+            
+            with self._hardware_lock:
+                self._hardware.finish_home()
+                self.export_state()
+                self.check_transitions()
+                phase_times = self._hardware.home_phase_times
+                failed = self._hardware.home_failed
+        except Exception as e: # Except hardware errors
+            self._lose_hardware(e)
+            self._home_failures += 1
+            self.logger.error(f"Selector home failed with {self._hardware_error}")
+            self._publish("home_status", "error")
+            self._publish("home_failures", self._home_failures)
+            return
+        
+        self._homes += 1
+        # A home that timed out has already been counted as a failure
+        if failed and not timed_out:
+            self._home_failures += 1
+        self.logger.status(f"Homed selector in {time.monotonic() - start:.1f} s, phase times {phase_times} ms")
+        self._publish("home_status", "failed" if failed else "complete")
+        self._publish("home_phase_times", phase_times)
+        self._publish("homes", self._homes)
+        self._publish("home_failures", self._home_failures)
+
+    def start_move(self, origin, position):
+        """Start moving the selector to `position`, and follow the move in a separate thread.
+        
+        Returns as soon as the move has been commanded, so the hardware lock is only held
+        while starting the move and for each status read, and status polling carries on
+        during the move. A request made while a move is running retargets that move.
+        
+        Arguments:
+            origin (str) : origin of the position request, reported with the move events
+            position (int) : position to move to"""
+        with self._hardware_lock:
+            self._move_request = (origin, position)
+            self._hardware.set_position(position, wait=False, started=self._move_started)
+        
+        if self._move_thread and self._move_thread.is_alive():
+            return
+        self._move_thread = threading.Thread(target=self._monitor_move, daemon=True, name='Move')
+        self._move_thread.start()
+        
+    def _monitor_move(self):
+        """Wait for a move to finish, then record it and publish the final state."""
+        start = time.monotonic()
+        try:
+            while True:
+                time.sleep(move_poll_interval)
+                with self._hardware_lock:
+                    if self._hardware is None:
+                        return
+                    if self._hardware.move_done():
+                        self._hardware.finish_move()
+                        self.export_state()
+                        self.check_transitions()
+                        position = self._hardware.position
+                        break
+                if time.monotonic() - start > default_move_timeout:
+                    self.logger.error(f"Selector move did not complete within {default_move_timeout} s")
+                    return
+        except Exception as e: # Except hardware errors
+            self._lose_hardware(e)
+            self.logger.error(f"Selector move failed with {self._hardware_error}")
+            return
+        
+        self.logger.status(f"Moved selector to {position} in {time.monotonic() - start:.1f} s")
+
     def position_control_callback(self, message):
         """Run on a pubsub notification to smax_table:selector:position_control_key"""
         date = message.timestamp
@@ -205,23 +674,23 @@ class SelectorInterface:
         
         if self._hardware:
             try:
-                with self._hardware_lock:
-                    if message.data:
-                        if message.data == 5 or message.data == 0:
-                            self.logger.info(f"Homing selector")
-                            try:
-                                self._hardware.home()
-                                self.logger.status(f"Homed selector")
-                            except Exception as e:
-                                self.logger.error(f"Could not home selector: {e}")
-                                raise e
-                        else:
-                            self.logger.info(f"Moving selector to {message.data}")
-                            self._hardware.set_position(int(message.data))
-                            self.logger.status(f"Moved selector to {message.data}")
+                if message.data == 5 or message.data == 0:
+                    self.logger.info(f"Homing selector")
+                    try:
+                        self.start_home()
+                        self.logger.status(f"Started homing selector")
+                    except Exception as e:
+                        self.logger.error(f"Could not home selector: {e}")
+                        raise e
+                    return
+                if message.data:
+                    if self._home_thread and self._home_thread.is_alive():
+                        self.logger.warning(f"Selector is homing, ignoring request to move to {message.data}")
+                    else:
+                        self.logger.info(f"Moving selector to {message.data}")
+                        self.start_move(message.origin, int(message.data))
             except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
-                self._hardware = None
+                self._lose_hardware(e)
                 self.logger.error(f'Attempt by {message.origin} to set position to {message.data} failed with {self._hardware_error}')
         else:
             self.logger.status(f'{message.origin} tried to set selector position to {message.data}, but no hardware connected.')
@@ -242,12 +711,52 @@ class SelectorInterface:
                     self._hardware.set_speed(int(message.data))
                     self.logger.status(f'{message.origin} set selector speed to {message.data}')
             except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
-                self._hardware = None
+                self._lose_hardware(e)
                 self.logger.error(f'Attempt by {message.origin} to set selector speed to {message.data} failed with {self._hardware_error}')
         else:
             self.logger.status(f'Received {message.origin} to set selector speed to {message.data}, but no hardware connected.')
                 
+    def sequence_control_callback(self, message):
+        """Run on a pubsub notification to smax_table:selector:sequence_control_key
+        
+        A positive value starts the move sequence in the config file for that many passes,
+        a negative value starts it to run until stopped, and 0 stops it."""
+        date = message.timestamp
+        self.logger.info(f'Received callback notification for {message.smaxname} from {message.origin} with data {message.data} at {date}')
+        
+        if self._hardware is None:
+            self.connect_hardware()
+        
+        if self._hardware:
+            try:
+                passes = int(message.data)
+                with self._hardware_lock:
+                    if passes == 0:
+                        self._hardware.stop_sequence()
+                        self.logger.status(f'{message.origin} stopped selector sequence')
+                    else:
+                        steps = self._hardware_config["selector"].get("sequence", None)
+                        if not steps:
+                            self.logger.error(f'{message.origin} tried to start a selector sequence, but none is configured')
+                            return
+                        if self._move_thread and self._move_thread.is_alive():
+                            self.logger.error(f'{message.origin} tried to start a selector sequence, but the selector is moving')
+                            return
+                        if self._hardware.get_sequence_status()["state"] != 0:
+                            self.logger.error(f'{message.origin} tried to start a selector sequence, but one is already running')
+                            return
+                        self._move_request = None
+                        self._hardware.upload_sequence(steps)
+                        self._hardware.start_sequence(max(passes, 0))
+                        self.logger.status(f'{message.origin} started selector sequence of {len(steps)} steps for {passes} passes')
+            except ValueError as e:
+                self.logger.error(f'Invalid selector sequence request {message.data} from {message.origin}: {e}')
+            except Exception as e: # Except hardware errors
+                self._lose_hardware(e)
+                self.logger.error(f'Attempt by {message.origin} to control selector sequence with {message.data} failed with {self._hardware_error}')
+        else:
+            self.logger.status(f'Received {message.origin} to control selector sequence with {message.data}, but no hardware connected.')
+                
     def angle_tolerance_control_callback(self, message):
         """Run on a pubsub notification to smax_table:selector:angle_tolerance_control_key"""
         date = message.timestamp
@@ -263,8 +772,7 @@ class SelectorInterface:
                     self._hardware.set_angle_tolerance(float(message.data))
                     self.logger.status(f'{message.origin} set selector angle tolerance to {message.data}')
             except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
-                self._hardware = None
+                self._lose_hardware(e)
                 self.logger.error(f'Attempt by {message.origin} to set selector angle tolerance to {message.data} failed with {self._hardware_error}')
         else:
             self.logger.status(f'Received {message.origin} to set selector angle tolerance to {message.data}, but no hardware connected.')
@@ -284,8 +792,7 @@ class SelectorInterface:
                     self._hardware.set_angle_offset(float(message.data))
                     self.logger.status(f'{message.origin} set selector wheel offset to {message.data}')
             except Exception as e: # Except hardware errors
-                self._hardware_error = repr(e)
-                self._hardware = None
+                self._lose_hardware(e)
                 self.logger.error(f'Attempt by {message.origin} to set selector wheel offset to {message.data} failed with {self._hardware_error}')
         else:
             self.logger.status(f'Received {message.origin} to set selector wheel offset to {message.data}, but no hardware connected.')
\ No newline at end of file
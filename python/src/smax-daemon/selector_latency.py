@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+End-to-end control latency harness for the selector daemon.
+
+Runs one or more selector daemons in this process, each with a simulated
+controller and the in-memory SMA-X backend, and measures the time from
+publishing a `position_control` request to receiving the `move_complete` event
+for it.  Each publisher sends its requests under its own SMA-X origin, and only
+counts the completion of a move that the daemon reports as commanded by that
+origin.  Several publishers can send requests to each wheel at once, and the
+daemons' SMA-X clients can be degraded with extra latency and failures, e.g.::
+
+    python selector_latency.py --wheels 3 --concurrency 2 --moves 20 --time-scale 50 \\
+        --smax-latency 0.005 --smax-jitter 0.01 --smax-failure-rate 0.01
+
+For each wheel, and for all wheels together, it reports the number of requests
+that completed and that were lost, the latency from request to move complete
+notification, and the latency from the controller sampling the completed move to
+the notification being received.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from smax import join
+
+import selector_smax_daemon
+from selector_backends import MemorySmaxStore, MemorySmaxClient, null_notify
+from selector_events import MOVE_COMPLETE
+
+default_config = os.path.join(os.path.dirname(os.path.abspath(__file__)), "selector_config.json")
+
+#: str: SMA-X table the harness runs the daemons under
+harness_table = "latency_harness"
+
+
+def wheel_config(config, index, time_scale, event_poll_interval):
+    """Return a copy of the daemon `config` for simulated wheel `index`."""
+    config = copy.deepcopy(config)
+    config["smax_config"]["smax_key"] = f"{config['smax_config']['smax_key']}{index}"
+    config["smax_config"]["smax_backend"] = "memory"
+    config["event_poll_interval"] = event_poll_interval
+    selector = config["config"]["selector"]
+    selector.update({"ip_address":f"sim-{index}",
+                     "simulate":time_scale,
+                     "shared_memory":None,
+                     "transcript":None,
+                     "replay":None,
+                     "history":None,
+                     "clear_stale_handles":False,
+                     "position_corrections":None})
+    return config
+
+
+class LatencyProbe:
+    """Sends position requests to the daemons and times the move complete events."""
+    def __init__(self, store, table):
+        self.table = table
+        self._store = store
+        self._client = MemorySmaxClient(store, program_name="selector_latency")
+        self._completions = {}
+        self._condition = threading.Condition()
+        self._publishers = 0
+
+    def publisher(self):
+        """Return a new SMA-X client to send requests from, with its own origin."""
+        with self._condition:
+            self._publishers += 1
+            return MemorySmaxClient(self._store, program_name=f"selector_latency{self._publishers}")
+
+    def watch(self, key):
+        """Start collecting the events of the daemon at smax_key `key`."""
+        self._completions[key] = []
+        self._client.smax_subscribe(join(self.table, key, "event"),
+                                    callback=lambda message: self._on_event(key, message))
+
+    def _on_event(self, key, message):
+        received = time.time()
+        if message.data.get("type") == MOVE_COMPLETE:
+            with self._condition:
+                self._completions[key].append((received, message.data))
+                self._condition.notify_all()
+
+    def request(self, publisher, key, target, timeout):
+        """Request a move of the wheel at `key` to `target` from the client `publisher`, and
+        wait for the move it commanded to complete.
+
+        Returns:
+            tuple: (latency, notification latency) in seconds, or None if no move complete
+                event for `target` was received within `timeout`."""
+        with self._condition:
+            first = len(self._completions[key])
+        sent = time.time()
+        publisher.smax_share(join(self.table, key), "position_control", target)
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for received, event in self._completions[key][first:]:
+                    if event.get("origin") == publisher.program_name and event.get("command_position") == target:
+                        return received - sent, received - event["timestamp"]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+
+def run_publisher(probe, key, moves, timeout, results):
+    """Send `moves` requests to random positions, appending (wheel, latency, notification latency)
+    to `results`, with None latencies for lost requests."""
+    publisher = probe.publisher()
+    for _ in range(moves):
+        target = random.randint(1, 4)
+        latency = probe.request(publisher, key, target, timeout)
+        if latency is None:
+            results.append((key, None, None))
+        else:
+            results.append((key, *latency))
+
+
+def summarize(name, results):
+    """Return a line summarizing the latencies in `results`."""
+    done = np.array([(r[1], r[2]) for r in results if r[1] is not None]).reshape(-1, 2) * 1000
+    lost = len(results) - len(done)
+    if not len(done):
+        return f"{name:<12} {0:>5} {lost:>5}"
+    total, notify = done[:, 0], done[:, 1]
+    return (f"{name:<12} {len(done):>5} {lost:>5} "
+            f"{np.median(total):>9.1f} {np.percentile(total, 95):>9.1f} {total.max():>9.1f} "
+            f"{np.median(notify):>9.1f} {np.percentile(notify, 95):>9.1f} {notify.max():>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the selector daemon's position control latency "
+                                                 "against simulated controllers and an in-memory SMA-X.")
+    parser.add_argument("--config", default=default_config, help="Daemon config file to base the wheels' configs on")
+    parser.add_argument("--wheels", type=int, default=1, help="Number of simulated wheels and daemons")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent publishers per wheel")
+    parser.add_argument("--moves", type=int, default=10, help="Number of requests sent by each publisher")
+    parser.add_argument("--time-scale", type=float, default=20.0, help="Speed up factor of the simulated moves")
+    parser.add_argument("--event-poll-interval", type=float, default=selector_smax_daemon.default_event_poll_interval,
+                        help="Interval between the daemons' status polls in seconds")
+    parser.add_argument("--smax-latency", type=float, default=0.0, help="Extra latency of each daemon SMA-X request in seconds")
+    parser.add_argument("--smax-jitter", type=float, default=0.0, help="Maximum random extra latency of each daemon SMA-X request in seconds")
+    parser.add_argument("--smax-failure-rate", type=float, default=0.0, help="Fraction of daemon SMA-X requests that fail")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Time to wait for each move to complete in seconds")
+    parser.add_argument("--verbose", action="store_true", help="Show the daemons' log messages")
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        base_config = json.load(fp)
+
+    store = MemorySmaxStore()
+    workdir = tempfile.mkdtemp(prefix="selector_latency_")
+    smax_config = os.path.join(workdir, "smax_config.json")
+    with open(smax_config, "w") as fp:
+        json.dump({"smax_server":"memory", "smax_port":0, "smax_db":0, "smax_table":harness_table}, fp)
+
+    if not args.verbose:
+        selector_smax_daemon.logging_level = logging.CRITICAL
+    services = []
+    for index in range(1, args.wheels + 1):
+        config = os.path.join(workdir, f"selector_config_{index}.json")
+        with open(config, "w") as fp:
+            json.dump(wheel_config(base_config, index, args.time_scale, args.event_poll_interval), fp)
+        client = MemorySmaxClient(store, program_name=f"{selector_smax_daemon.daemon_name}{index}",
+                                  latency=args.smax_latency, jitter=args.smax_jitter,
+                                  failure_rate=args.smax_failure_rate)
+        services.append(selector_smax_daemon.SelectorSmaxService(config=config, smax_config=smax_config,
+                                                                 smax_client=client, notify=null_notify))
+
+    probe = LatencyProbe(store, services[0].smax_table)
+    for service in services:
+        probe.watch(service.smax_key)
+        threading.Thread(target=service.start, daemon=True, name=service.smax_key).start()
+
+    # Wait for the simulated controllers to finish the home they start with
+    deadline = time.monotonic() + args.timeout
+    for service in services:
+        while service.hardware is None or service.hardware._transitions.homing is not False \
+                or service.hardware._transitions.moving:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{service.smax_key} did not become ready within {args.timeout} s")
+            time.sleep(0.05)
+
+    results = []
+    publishers = [threading.Thread(target=run_publisher, args=(probe, service.smax_key, args.moves, args.timeout, results))
+                  for service in services for _ in range(args.concurrency)]
+    start = time.monotonic()
+    for publisher in publishers:
+        publisher.start()
+    for publisher in publishers:
+        publisher.join()
+    elapsed = time.monotonic() - start
+
+    print(f"{args.wheels} wheels, {args.concurrency} publishers per wheel, {args.moves} moves each, "
+          f"in {elapsed:.1f} s")
+    print(f"{'':<12} {'done':>5} {'lost':>5} {'median':>9} {'p95':>9} {'max':>9} "
+          f"{'notify':>9} {'p95':>9} {'max':>9}  (ms)")
+    for service in services:
+        print(summarize(service.smax_key, [r for r in results if r[0] == service.smax_key]))
+    print(summarize("all", results))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,18 +3,21 @@ import logging
 import sys
 import os
 import time
+import fnmatch
+import queue
 
 import threading
 import json
 
 from retrying import retry
-import systemd.daemon
 import signal
 
-from smax import SmaxRedisClient, SmaxConnectionError, SmaxKeyError, join, normalize_pair
-from gclib import GclibError
+from smax import SmaxConnectionError, SmaxKeyError, join, normalize_pair
+from wsma_cryostat_selector.galil import GclibError
 
 from selector_interface import SelectorInterface as HardwareInterface
+from selector_watchdog import Watchdog
+from selector_backends import create_smax_client, systemd_notify
 
 # Change these based on system setup
 default_smax_config = os.path.expanduser("~smauser/wsma_config/smax_config.json")
@@ -85,6 +88,21 @@ logging.basicConfig(format='%(levelname)s - %(message)s', level=logging_level)
 
 READY = 'READY=1'
 STOPPING = 'STOPPING=1'
+WATCHDOG = 'WATCHDOG=1'
+
+# Default watchdog settings, overridden by the "watchdog" section of the config file
+default_watchdog_config = {
+    "command_timeout":120,
+    "pubsub_timeout":60,
+    "ping_interval":10,
+    "reset_grace":30
+}
+
+# Default interval between polls of the controller status for state transition events, in seconds
+default_event_poll_interval = 0.05
+
+# SMA-X connection settings, which can only be changed by restarting the service
+restart_settings = ["smax_server", "smax_port", "smax_db", "smax_backend"]
 
 def _is_smaxconnectionerror(exception):
     return isinstance(exception, SmaxConnectionError)
@@ -92,36 +110,111 @@ def _is_smaxconnectionerror(exception):
 def _is_gclibconnectionerror(exception):
     return isinstance(exception, GclibError)
 
+def _config_diff(old, new, parent_key=""):
+    """Return the set of keys whose values differ between two configs.
+    
+    Nested dictionaries are compared key by key, and the differing keys are returned
+    as paths separated by ':', e.g. "config:selector:ip_address"."""
+    changed = set()
+    for key in set(old) | set(new):
+        path = join(parent_key, key) if parent_key else key
+        old_value, new_value = old.get(key), new.get(key)
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changed |= _config_diff(old_value, new_value, path)
+        elif old_value != new_value or (key in old) != (key in new):
+            changed.add(path)
+    return changed
+
+def _struct_lookup(smax_struct, key):
+    """Return the value of `key` from a pulled SMA-X structure, or None if it is missing.
+    
+    `key` may be a compound key separated by ':'.  SMA-X structures may be
+    returned as mappings or as objects with attributes, so both are handled."""
+    value = smax_struct
+    for k in key.split(":"):
+        if value is None:
+            return None
+        try:
+            value = value[k]
+        except (KeyError, TypeError, IndexError):
+            value = getattr(value, k, None)
+    return value
+
 class SelectorSmaxService:
-    def __init__(self, config=default_config, smax_config=default_smax_config):
-        """Service object initialization code"""
+    def __init__(self, config=default_config, smax_config=default_smax_config, smax_client=None, notify=None):
+        """Service object initialization code
+        
+        Keyword Arguments:
+            config (str) : path of the daemon config file
+            smax_config (str) : path of the SMA-X config file
+            smax_client : SMA-X client to use instead of one created for the smax_backend in the config
+            notify (callable) : called with the systemd notification strings. Defaults to
+                notifying systemd, if systemd-python is installed."""
         self.logger = self._init_logger()
+        self.notify = notify if notify else systemd_notify
         
         # Configure SIGTERM behavior
         signal.signal(signal.SIGTERM, self._handle_sigterm)
+        
+        # SIGHUP reloads the config files, from the main loop
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+        self._reload_requested = False
 
         # A list of control keys
         self.control_keys = None
-
+        
+        # Control callbacks keyed by full SMA-X name, and the queue of control messages
+        # handed from the pubsub thread to the command thread
+        self.dispatch = {}
+        self.commands = queue.Queue()
+
+        # SMA-X (table, key) pairs of the logged data, as (smax table:key, logged keys, pairs),
+        # worked out by the logging thread once for each set of logged keys
+        self._logged_pairs = None
+        self._comm_pairs = None
+        
         # Read the hardware and SMAX configuration
+        self.config_file = config
+        self.smax_config_file = smax_config
         self.read_config(config, smax_config)
+        self._config_stamps = self._stat_config()
         self.logger.info('Read Config File')
 
-        # The SMAXRedisClient instance
-        self.smax_client = None
+        # The SMA-X client instance
+        self.smax_client = smax_client
         
         # The simulated hardware class
         self.hardware = None
+        
+        # The event thread, if event polling is enabled, and a wake up call for the logging thread
+        # when the logging interval changes
+        self.event_thread = None
+        self._logging_wake = threading.Event()
 
         # Log that we managed to create the instance
         self.logger.info(f'{daemon_name} instance created')
         
         # A time to delay between loops
         self.delay = 1.0
+        
+        # Supervision of the logging, command and pubsub threads
+        self.watchdog = Watchdog()
+        self.watchdog.register("logging", self.watchdog_config["logging_timeout"])
+        self.watchdog.register("command", self.watchdog_config["command_timeout"], periodic=False)
+        self.watchdog.register("pubsub", self.watchdog_config["pubsub_timeout"])
+        if self.event_poll_interval:
+            self.watchdog.register("events", self.watchdog_config["events_timeout"])
+        self._next_ping = 0
+        self._next_watchdog_publish = 0
+        self._stall_since = None
+        self._stall_escalated = False
 
     def _init_logger(self):
         logger = logging.getLogger(daemon_name)
         logger.setLevel(logging_level)
+        if logger.handlers:
+            # Already set up by another service instance in this process
+            return logger
         file_handler = logging.FileHandler(f'{daemon_name.lower()}.log')
         file_handler.setLevel(logging_level)
         fileFormatter = logging.Formatter('%(asctime)s: %(levelname)s - %(message)s')
@@ -132,9 +225,17 @@ class SelectorSmaxService:
     
     def read_config(self, config, smax_config=None):
         """Read the configuration file."""
+        self._config = self.load_config(config, smax_config)
+        self.apply_config()
+        
+    def load_config(self, config, smax_config=None):
+        """Read the configuration file, and merge in the SMA-X configuration file if given.
+        
+        Returns:
+            dict : the merged config"""
         # Read the file
         with open(config) as fp:
-            self._config = json.load(fp)
+            new_config = json.load(fp)
             fp.close()
         
         # If smax_config is given, update the hardware specific config file with the smax_config
@@ -144,18 +245,28 @@ class SelectorSmaxService:
                 fp.close()
             self.logger.debug("Got smax_config")
             self.logger.debug(s_config)
-            if "smax_table" in self._config["smax_config"]:
+            if "smax_table" in new_config["smax_config"]:
                 smax_root = s_config["smax_table"]
-                self._config["smax_config"]["smax_table"] = ":".join([smax_root, self._config["smax_config"]["smax_table"]])
+                new_config["smax_config"]["smax_table"] = ":".join([smax_root, new_config["smax_config"]["smax_table"]])
                 del s_config["smax_table"]
-            self._config["smax_config"].update(s_config)
+            new_config["smax_config"].update(s_config)
+        return new_config
         
+    def apply_config(self):
+        """Set up the service's settings from the _config dictionary."""
         # parse the _config dictionary and set up values
         self.smax_server = self._config["smax_config"]["smax_server"]
         self.smax_port = self._config["smax_config"]["smax_port"]
         self.smax_db = self._config["smax_config"]["smax_db"]
         self.smax_table = self._config["smax_config"]["smax_table"]
         self.smax_key = self._config["smax_config"]["smax_key"]
+        self.smax_backend = self._config["smax_config"].get("smax_backend", "redis")
+        
+        # The logging thread works out new pairs for the logged data itself when the table or
+        # key change, so they are not reset here while it may be using them
+        comm_pairs = [normalize_pair(join(self.smax_table, self.smax_key), k) for k in ("comm_status", "comm_error")]
+        if comm_pairs != self._comm_pairs:
+            self._comm_pairs = comm_pairs
         
         self.logger.info("SMAX Configuration:")
         self.logger.info(f"\tSMAX Server: {self.smax_server}")
@@ -163,6 +274,7 @@ class SelectorSmaxService:
         self.logger.info(f"\tSMAx DB    : {self.smax_db}")
         self.logger.info(f"\tSMAX Table : {self.smax_table}")
         self.logger.info(f"\tSMAX Key   : {self.smax_key}")
+        self.logger.info(f"\tSMAX Backend: {self.smax_backend}")
         
         
         self.control_keys = self._config["smax_config"]["smax_control_keys"]
@@ -172,13 +284,121 @@ class SelectorSmaxService:
         
         self.logging_interval = self._config["logging_interval"]
         self.logger.info(f"Logging Interval {self.logging_interval}")
+        
+        self.event_poll_interval = self._config.get("event_poll_interval", default_event_poll_interval)
+        self.logger.info(f"Event Poll Interval {self.event_poll_interval}")
+        
+        self.watchdog_config = dict(default_watchdog_config, logging_timeout=3*self.logging_interval,
+                                    events_timeout=max(10.0, 100*(self.event_poll_interval or 0)))
+        self.watchdog_config.update(self._config.get("watchdog", {}))
+        self.logger.info(f"Watchdog config {self.watchdog_config}")
+        
+        self.watch_config = self._config.get("watch_config", True)
+        self.logger.info(f"Watch config files {self.watch_config}")
+        
+    def _stat_config(self):
+        """Return the modification time and size of each config file, to detect changes."""
+        stamps = []
+        for path in (self.config_file, self.smax_config_file):
+            try:
+                stat = os.stat(path) if path else None
+                stamps.append((stat.st_mtime_ns, stat.st_size) if stat else None)
+            except OSError:
+                stamps.append(None)
+        return stamps
+        
+    def _handle_sighup(self, sig, frame):
+        self.logger.info('SIGHUP received, reloading config...')
+        self._reload_requested = True
+        
+    def check_config(self):
+        """Reload the config if SIGHUP was received, or if watch_config is set and a config
+        file has changed since it was last read."""
+        stamps = self._stat_config()
+        if self._reload_requested or (self.watch_config and stamps != self._config_stamps):
+            self._reload_requested = False
+            self._config_stamps = stamps
+            try:
+                self.reload_config()
+            except Exception as e:
+                self.logger.error(f"Could not apply reloaded config: {e}")
+            
+    def reload_config(self):
+        """Re-read the config files, and apply only the settings that changed.
+        
+        Logged data, the logging and event poll intervals, the watchdog timeouts and the
+        control keys take effect without interrupting the service.  The controller is
+        reconnected only if its connection settings changed, and the wheel is not moved.
+        Changes to the SMA-X server settings are ignored until the service is restarted.
+        
+        Returns:
+            set : names of the config values that changed, as colon separated paths"""
+        try:
+            new_config = self.load_config(self.config_file, self.smax_config_file)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.error(f"Could not reload config from {self.config_file}: {e}")
+            return set()
+        
+        for setting in restart_settings:
+            if new_config["smax_config"].get(setting) != self._config["smax_config"].get(setting):
+                self.logger.warning(f"Change of {setting} to {new_config['smax_config'].get(setting)} "
+                                    f"needs a restart of the service, keeping {self._config['smax_config'].get(setting)}")
+                if setting in self._config["smax_config"]:
+                    new_config["smax_config"][setting] = self._config["smax_config"][setting]
+                else:
+                    new_config["smax_config"].pop(setting, None)
+        
+        changed = _config_diff(self._config, new_config)
+        if not changed:
+            self.logger.info("Config reloaded, nothing changed")
+            return changed
+        self.logger.status(f"Config reloaded, applying changes to {sorted(changed)}")
+        
+        old_logging_interval = self.logging_interval
+        old_subscriptions = self.subscriptions()
+        self._config = new_config
+        self.apply_config()
+        
+        # Watchdog timeouts, and the event thread
+        self.watchdog.configure("logging", self.watchdog_config["logging_timeout"])
+        self.watchdog.configure("command", self.watchdog_config["command_timeout"], periodic=False)
+        self.watchdog.configure("pubsub", self.watchdog_config["pubsub_timeout"])
+        if self.event_poll_interval:
+            self.watchdog.configure("events", self.watchdog_config["events_timeout"])
+            if self.event_thread is None or not self.event_thread.is_alive():
+                self.start_event_thread()
+        else:
+            self.watchdog.configure("events", self.watchdog_config["events_timeout"], periodic=False)
+        
+        if self.hardware:
+            self.hardware.reconfigure(self._config, changed)
+            self.build_dispatch()
+        
+        # Wake the logging thread so that it runs at the new interval straight away, once
+        # the hardware has been reconfigured
+        if self.logging_interval != old_logging_interval:
+            self._logging_wake.set()
+        
+        # Move the subscriptions to the new control keys
+        if self.smax_client and self.subscriptions() != old_subscriptions:
+            new_patterns = [pattern for pattern, _ in self.subscriptions()]
+            for pattern, _ in old_subscriptions:
+                if pattern not in new_patterns:
+                    self.smax_client.smax_unsubscribe(pattern)
+            self.subscribe()
+        return changed
 
     def start(self):
         """Code to be run before the service's main loop"""
         # Start up code
         
         # Create the hardware interface
-        self.hardware = HardwareInterface(config=self._config, logger=self.logger)
+        self.hardware = HardwareInterface(config=self._config, logger=self.logger, publish=self.smax_publish)
+        self.build_dispatch()
+        
+        # Control callbacks run in their own thread, so that the pubsub thread never waits on the hardware
+        self.command_thread = threading.Thread(target=self.command_loop, daemon=True, name='Command')
+        self.command_thread.start()
         
         # Create the SMA-X interface
         #
@@ -198,7 +418,7 @@ class SelectorSmaxService:
 
         # systemctl will wait until this notification is sent
         # Tell systemd that we are ready to run the service
-        systemd.daemon.notify(READY)
+        self.notify(READY)
 
         # Run the service's main loop
         self.run()
@@ -209,12 +429,12 @@ class SelectorSmaxService:
         try:
             self.hardware.connect_hardware()
             self.logger.status(f'Connected to hardware')
-            self.smax_client.smax_share(join(self.table, self.key), 'comm_status', 'connection error')
-            self.smax_client.smax_share(join(self.table, self.key), 'comm_error', repr(e))
+            self.smax_publish('comm_status', 'good')
+            self.smax_publish('comm_error', 'None')
         except GclibError as e:
             self.logger.error(f'Could not connect to hardware: {e}')
-            self.smax_client.smax_share(join(self.table, self.key), 'comm_status', 'connection error')
-            self.smax_client.smax_share(join(self.table, self.key), 'comm_error', repr(e))
+            self.smax_publish('comm_status', 'connection error')
+            self.smax_publish('comm_error', repr(e))
             raise e
         
     
@@ -223,14 +443,22 @@ class SelectorSmaxService:
         
         initialize_config = self._config["smax_config"]["smax_init_keys"]
         
+        # Pull the whole smax_table:smax_key structure in a single round trip, rather
+        # than one smax_pull per init key.
+        try:
+            smax_struct = self.smax_client.smax_pull(self.smax_table, self.smax_key)
+        except SmaxKeyError:
+            self.logger.info(f"No initial values found at {join(self.smax_table, self.smax_key)}")
+            smax_struct = None
+        
         init_kwargs = {}
         for smax_key, kw in initialize_config.items():
-            try:
-                value = self.smax_client.smax_pull(join(self.smax_table, self.smax_key), smax_key)
-            except SmaxKeyError:
+            value = _struct_lookup(smax_struct, smax_key)
+            if value is None:
                 continue
             init_kwargs[kw] = value
         
+        self.logger.debug(f"Initial values from SMA-X: {init_kwargs}")
         self.hardware.initialize_hardware(init_kwargs)
         
     @retry(wait_exponential_multiplier=1000, wait_exponential_max=30000, retry_on_exception=_is_smaxconnectionerror)
@@ -239,8 +467,9 @@ class SelectorSmaxService:
         service terminates."""
         try:
             if self.smax_client is None:
-                self.smax_client = SmaxRedisClient(redis_ip=self.smax_server, redis_port=self.smax_port, redis_db=self.smax_db, program_name=daemon_name, \
-                                                    debug=logging_level==logging.DEBUG, logger=self.logger)
+                self.smax_client = create_smax_client(self.smax_backend, self.smax_server, self.smax_port, self.smax_db,
+                                                      program_name=daemon_name, logger=self.logger,
+                                                      debug=logging_level==logging.DEBUG)
             else:
                 self.smax_client.smax_connect_to(self.smax_server, self.smax_port, self.smax_db)
 
@@ -249,12 +478,61 @@ class SelectorSmaxService:
             self.logger.warning(f'Could not connect to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')    
             raise e
         
-        # Register pubsub channels specified in config["smax_config"]["control_keys"] to the 
-        # callbacks specified in the config.
-        for k in self.control_keys.keys():
-            self.smax_client.smax_subscribe(join(self.smax_table, self.smax_key, k), callback=getattr(self.hardware, self.control_keys[k]))
-            self.logger.debug(f'connected {getattr(self.hardware, self.control_keys[k])} to {join(self.smax_table, self.smax_key, k)}')
-        self.logger.info('Subscribed to pubsub notifications')
+        self.subscribe()
+        
+    def build_dispatch(self):
+        """Build the table of control callbacks, keyed by the full SMA-X name of each control
+        key in config["smax_config"]["control_keys"].
+        
+        The table is replaced whole, so the pubsub thread never sees one partly built."""
+        dispatch = {}
+        for k, callback in self.control_keys.items():
+            dispatch[join(self.smax_table, self.smax_key, k)] = getattr(self.hardware, callback)
+            self.logger.debug(f'dispatching {join(self.smax_table, self.smax_key, k)} to {callback}')
+        self.dispatch = dispatch
+            
+    def subscriptions(self):
+        """Return the (pattern, callback) of each pubsub subscription for the current config.
+        
+        All the control keys ending in _control are covered by a single pattern subscription."""
+        control_pattern = join(self.smax_table, self.smax_key, "*_control")
+        patterns = [control_pattern]
+        patterns.extend(name for name in self.dispatch if not fnmatch.fnmatchcase(name, control_pattern))
+        subscriptions = [(pattern, self.control_callback) for pattern in patterns]
+        # Pings sent to ourselves by the main loop show that notifications are being delivered
+        subscriptions.append((join(self.smax_table, self.smax_key, "watchdog_ping"), self.watchdog_ping_callback))
+        return subscriptions
+        
+    def subscribe(self):
+        """Subscribe to the control keys and the watchdog ping.
+        
+        Subscriptions are keyed by their pattern, so repeating them after a reconnect
+        replaces rather than duplicates them."""
+        subscriptions = self.subscriptions()
+        for pattern, callback in subscriptions:
+            self.smax_client.smax_subscribe(pattern, callback=callback)
+        self.logger.info(f'Subscribed to pubsub notifications for {[pattern for pattern, _ in subscriptions]}')
+        
+    def control_callback(self, message):
+        """Run on a pubsub notification to any of the control keys.
+        
+        Hands the message to the command thread, which runs the control callback for the key."""
+        callback = self.dispatch.get(message.smaxname)
+        if callback is None:
+            self.logger.warning(f'Received notification for {message.smaxname} from {message.origin}, which is not a control key')
+            return
+        self.commands.put((callback, message))
+        
+    def command_loop(self):
+        """The loop that will run in the thread to carry out control callbacks, in the order
+        the control messages arrived"""
+        while True:
+            callback, message = self.commands.get()
+            try:
+                with self.watchdog.busy("command"):
+                    callback(message)
+            except Exception as e:
+                self.logger.error(f'Control callback for {message.smaxname} failed with {e}')
 
     def run(self):
         """Run the main service loop"""
@@ -265,9 +543,16 @@ class SelectorSmaxService:
         
         self.logger.status("Started logging thread")
         
+        # Poll the controller status quickly in a separate thread, so that state transitions
+        # are published as they happen rather than at the next logging_interval
+        if self.event_poll_interval:
+            self.start_event_thread()
+        
         try:
             while True:
                 time.sleep(self.delay)
+                self.supervise()
+                self.check_config()
 
         except KeyboardInterrupt:
             # Monitor for SIGINT, which we've set as the terminate signal in the
@@ -275,9 +560,65 @@ class SelectorSmaxService:
             self.logger.status('SIGINT (keyboard interrupt) received...')
             self.stop()
             
+    def start_event_thread(self):
+        """Start the thread that polls for state transition events."""
+        self.event_thread = threading.Thread(target=self.event_loop, daemon=True, name='Events')
+        self.event_thread.start()
+        self.logger.status("Started event thread")
+            
+    def watchdog_ping_callback(self, message):
+        """Run on a pubsub notification of the watchdog ping sent by the main loop"""
+        self.watchdog.beat("pubsub")
+        
+    def supervise(self):
+        """Check that the supervised threads are progressing, and tell systemd that the
+        service is alive only while they are.
+        
+        On a stall, first close the controller handle, which breaks a hung hardware call.
+        If the handle cannot be closed, or the stall persists for reset_grace seconds, stop
+        sending WATCHDOG=1, so that systemd restarts the service when WatchdogSec runs out."""
+        now = time.monotonic()
+        if now >= self._next_ping:
+            self._next_ping = now + self.watchdog_config["ping_interval"]
+            self.smax_publish("watchdog_ping", time.time())
+        
+        stalled = self.watchdog.stalled()
+        if not stalled:
+            if self._stall_since is not None:
+                self.logger.status(f"Watchdog: all threads progressing again after {now - self._stall_since:.1f} s")
+                self.smax_publish("watchdog_status", "ok")
+            self._stall_since = None
+            self._stall_escalated = False
+            self.notify(WATCHDOG)
+        elif self._stall_since is None:
+            self._stall_since = now
+            self.logger.error(f"Watchdog: stalled threads {stalled}, lags {self.watchdog.lags()}. Resetting controller connection.")
+            self.smax_publish("watchdog_status", f"stalled: {', '.join(stalled)}")
+            try:
+                reset = self.hardware.reset_hardware_connection()
+            except Exception as e:
+                self.logger.error(f"Watchdog: could not reset controller connection: {e}")
+                reset = False
+            if reset:
+                self.notify(WATCHDOG)
+            else:
+                # Nothing to wait for, let systemd restart the service
+                self._stall_since -= self.watchdog_config["reset_grace"]
+        elif now - self._stall_since < self.watchdog_config["reset_grace"]:
+            self.notify(WATCHDOG)
+        elif not self._stall_escalated:
+            self._stall_escalated = True
+            self.logger.critical(f"Watchdog: threads {stalled} still stalled after reset, waiting for systemd to restart the service")
+            self.smax_publish("watchdog_status", f"restarting: {', '.join(stalled)}")
+        
+        if now >= self._next_watchdog_publish:
+            self._next_watchdog_publish = now + self.logging_interval
+            self.smax_publish("watchdog_lag", self.watchdog.lags())
+            
     def logging_loop(self):
         """The loop that will run in the thread to carry out logging"""
         while True:
+            self.watchdog.beat("logging")
             self.logger.debug("tick")
             next_log_time = time.monotonic() + self.logging_interval
             try:
@@ -287,13 +628,26 @@ class SelectorSmaxService:
 
             # Try to run on a regular schedule, but if smax_logging_action takes too long,
             # just wait logging_interval between finishing one smax_logging_action and starting next.
+            # A change of logging_interval wakes the thread early.
             curr_time = time.monotonic()
             if next_log_time > curr_time:
-                time.sleep(next_log_time - curr_time)
+                self._logging_wake.wait(next_log_time - curr_time)
             else:
-                time.sleep(self.logging_interval)
+                self._logging_wake.wait(self.logging_interval)
+            self._logging_wake.clear()
                 
         
+    def event_loop(self):
+        """The loop that will run in the thread to poll for state transition events, until
+        event polling is disabled by setting event_poll_interval to 0"""
+        while self.event_poll_interval:
+            self.watchdog.beat("events")
+            try:
+                self.hardware.poll_events()
+            except Exception as e:
+                self.logger.error(f"Event poll failed with {e}")
+            time.sleep(self.event_poll_interval)
+        
     def smax_logging_action(self):
         """Run the code to write logging data to SMAX"""
         # If we've lost the connection, lets reconnect
@@ -307,22 +661,41 @@ class SelectorSmaxService:
             self.logger.warning(f'Lost SMA-X connection to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
             self.connect_to_smax()
                 
-        logged_data = self.hardware.logging_action()
-
-        self.logger.info(f"Received data for {len(logged_data)} keys.")    
+        state = self.hardware.logging_action()
+        root = join(self.smax_table, self.smax_key)
+        logged = self._logged_pairs
+        if logged is None or logged[0] != root or logged[1] is not state.keys:
+            logged = (root, state.keys, [normalize_pair(root, k) for k in state.keys])
+            self._logged_pairs = logged
+
+        self.logger.info(f"Received data for {len(state.keys)} keys.")    
         # write values to SMA-X
         # Retry if connection is missing
         try:
-            for k in logged_data.keys():
-                self.logger.debug(f"key in logged_data.keys(): {k}")
-                table, key = normalize_pair(join(self.smax_table, self.smax_key), k)
-                self.smax_client.smax_share(table, key, logged_data[k])
+            if state.comm_status == "good":
+                for (table, key), value in zip(logged[2], state.values):
+                    self.smax_client.smax_share(table, key, value)
+            (table, key), (error_table, error_key) = self._comm_pairs
+            self.smax_client.smax_share(table, key, state.comm_status)
+            self.smax_client.smax_share(error_table, error_key, state.comm_error)
             self.logger.status(f'Wrote hardware data to SMAX ')
         except SmaxConnectionError:
             self.logger.warning(f'Lost SMA-X connection to {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
             self.connect_to_smax()
             self.smax_logging_action()
             
+    def smax_publish(self, key, value):
+        """Write a single value to smax_table:smax_key:key immediately, outside the logging loop.
+        
+        Used by the hardware interface to report events, such as the progress of a home,
+        as they happen."""
+        if self.smax_client is None:
+            return
+        try:
+            self.smax_client.smax_share(join(self.smax_table, self.smax_key), key, value)
+        except SmaxConnectionError:
+            self.logger.warning(f'Could not write {key} to SMA-X {self.smax_server}:{self.smax_port} DB:{self.smax_db}')
+            
     def _handle_sigterm(self, sig, frame):
         self.logger.info('SIGTERM received...')
         self.stop()
@@ -330,7 +703,7 @@ class SelectorSmaxService:
     def stop(self):
         """Clean up after the service's main loop"""
         # Tell systemd that we received the stop signal
-        systemd.daemon.notify(STOPPING)
+        self.notify(STOPPING)
 
         self.logger.status('Cleaning up...')
         
@@ -0,0 +1,105 @@
+"""
+Supervision of the selector daemon's threads.
+
+Each supervised thread reports progress to a `Watchdog`, either by beating a
+periodic heartbeat on every pass through its loop, or by marking itself busy while
+it handles a single piece of work.  The service's main loop asks the watchdog
+which threads have stalled, and only tells systemd that the service is alive
+(`WATCHDOG=1`) while none have.
+"""
+import contextlib
+import threading
+import time
+
+
+class Heartbeat:
+    """Progress of a single supervised thread."""
+    def __init__(self, name, timeout, periodic=True):
+        """Create a heartbeat.
+
+        Arguments:
+            name (str) : name of the supervised thread
+            timeout (float) : time in seconds after which the thread is considered stalled
+            periodic (bool) : True if the thread should beat at least every `timeout` seconds.
+                False if the thread is only expected to make progress while busy."""
+        self.name = name
+        self.timeout = timeout
+        self.periodic = periodic
+        self.last = time.monotonic()
+        self.busy_since = None
+        self.beats = 0
+
+    def lag(self, now=None):
+        """Return the time in seconds the thread has gone without progress."""
+        if now is None:
+            now = time.monotonic()
+        if self.busy_since is not None:
+            return now - self.busy_since
+        if self.periodic:
+            return now - self.last
+        return 0.0
+
+    def stalled(self, now=None):
+        """Return True if the thread has gone without progress for longer than its timeout."""
+        return self.lag(now) > self.timeout
+
+
+class Watchdog:
+    """Collects heartbeats from the daemon's threads and detects stalls."""
+    def __init__(self):
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, timeout, periodic=True):
+        """Start supervising the thread `name`.  See `Heartbeat` for the arguments."""
+        with self._lock:
+            self._heartbeats[name] = Heartbeat(name, timeout, periodic)
+
+    def configure(self, name, timeout, periodic=True):
+        """Change the timeout of the thread `name`, keeping its progress, or start supervising
+        it if it is not supervised yet."""
+        with self._lock:
+            hb = self._heartbeats.get(name)
+            if hb is None:
+                self._heartbeats[name] = Heartbeat(name, timeout, periodic)
+            else:
+                hb.timeout = timeout
+                hb.periodic = periodic
+
+    def beat(self, name):
+        """Record progress by the thread `name`."""
+        hb = self._heartbeats[name]
+        hb.last = time.monotonic()
+        hb.beats += 1
+
+    @contextlib.contextmanager
+    def busy(self, name):
+        """Context manager marking the thread `name` as busy until the context exits."""
+        hb = self._heartbeats[name]
+        hb.busy_since = time.monotonic()
+        try:
+            yield
+        finally:
+            hb.busy_since = None
+            self.beat(name)
+
+    def supervised(self, name, func):
+        """Wrap `func` so that thread `name` is marked busy while it runs."""
+        def wrapper(*args, **kwargs):
+            with self.busy(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = getattr(func, "__name__", name)
+        wrapper.__doc__ = getattr(func, "__doc__", None)
+        return wrapper
+
+    def lags(self):
+        """Return a dict of the time in seconds each thread has gone without progress."""
+        now = time.monotonic()
+        with self._lock:
+            return {name: hb.lag(now) for name, hb in self._heartbeats.items()}
+
+    def stalled(self):
+        """Return a list of the names of the threads that have stalled."""
+        now = time.monotonic()
+        with self._lock:
+            return [name for name, hb in self._heartbeats.items() if hb.stalled(now)]
@@ -1,12 +1,79 @@
 __version__ = '1.0.1'
 
 from time import sleep
+import time
+import math
 import logging
 
-import gclib
+from wsma_cryostat_selector.galil import gclib, GalilSocket, default_transport, transports
+
+from wsma_cryostat_selector import firmware
+from wsma_cryostat_selector.clock import ClockSync
+from wsma_cryostat_selector.connection import SharedConnection, get_connection, release_connection, default_options
+from wsma_cryostat_selector.history import MoveHistory, EVENT_MOVE, EVENT_HOME
+from wsma_cryostat_selector.movetime import MoveTimeEstimator, SPEED_AUTO
+from wsma_cryostat_selector.simulator import SimulatedController
+from wsma_cryostat_selector.sharedstate import StateReader, StateWriter
+from wsma_cryostat_selector.transcript import TranscriptRecorder, ReplayClient
+from wsma_cryostat_selector.planner import plan_move, check_sequence, directions, DIRECTION_SHORTEST, \
+    DIRECTION_FORWARD, DIRECTION_REVERSE, DIRECTION_DIRECT
 
 default_IP = "192.168.42.100"
 
+#: int: Status word bit set while the wheel is moving
+STATUS_MOVING = 1
+
+#: int: Status word bit set when the wheel is at the commanded position
+STATUS_IN_POSITION = 2
+
+#: int: Status word bit set when the angle error is within the angle tolerance
+STATUS_IN_TOLERANCE = 4
+
+#: int: Status word bit set while homing, or if the last home failed
+STATUS_HOMING = 8
+
+#: int: Status word bit set while a move sequence is running
+STATUS_SEQUENCE = 4096
+
+#: int: Sequence state when no sequence is running
+SEQUENCE_IDLE = 0
+
+#: int: Sequence state while a sequence is running
+SEQUENCE_RUNNING = 1
+
+#: int: Sequence state written to request the start of a sequence
+SEQUENCE_START = 2
+
+#: int: Maximum number of steps in a move sequence
+max_sequence_steps = 32
+
+#: int: Maximum number of samples recorded during an angle offset sweep
+max_sweep_samples = 1000
+
+#: int: Home phase when not homing
+HOME_IDLE = 0
+
+#: int: Home phase while moving off the home switch before searching for the index
+HOME_PRE_MOVE = 1
+
+#: int: Home phase while searching for the resolver index
+HOME_FIND_INDEX = 2
+
+#: int: Home phase while resetting the resolver turn counter
+HOME_COUNTER_RESET = 3
+
+#: int: Home phase while rebuilding the position table
+HOME_TABLE_REBUILD = 4
+
+#: dict: Names of the home phases
+home_phase_names = {
+    HOME_IDLE: "idle",
+    HOME_PRE_MOVE: "pre-move",
+    HOME_FIND_INDEX: "find index",
+    HOME_COUNTER_RESET: "counter reset",
+    HOME_TABLE_REBUILD: "position table rebuild",
+}
+
 loglevel = logging.INFO
 logging.basicConfig(level=loglevel)
 logger = logging.getLogger(__name__)
@@ -43,6 +110,31 @@ class Selector(object):
     #: str: address of the controller's angle offset register (angle offset in degrees)
     _angle_offset_var = 'A[8]'
     
+    #: str: address of the controller's move count register (number of moves needed for the last commanded move)
+    _moves_var = 'A[9]'
+    
+    #: str: address of the controller's move direction register (one of the planner DIRECTION_* values)
+    _direction_var = 'A[10]'
+    
+    #: str: address of the controller's packed status word register (see the STATUS_* bits)
+    _status_word_var = 'A[11]'
+    
+    #: str: address of the controller's state change sequence number, incremented when the status word changes
+    _sequence_var = 'A[12]'
+    
+    #: str: address of the controller's count of corrective moves made while parked, when the
+    #: angle error drifted beyond the tolerance
+    _corrections_var = 'A[26]'
+    
+    #: str: address of the controller's count of homes since the program started
+    _homes_var = 'A[27]'
+    
+    #: str: address of the controller's count of homes made because corrective moves failed
+    _home_fallbacks_var = 'A[28]'
+    
+    #: str: address of the angle error at which the last move first landed, before any corrective moves
+    _first_error_var = 'A[29]'
+    
     #: str: address of the controller's position 1 setting
     _pos_1_var = 'POS[0]'
     
@@ -55,18 +147,172 @@ class Selector(object):
     #: str: address of the controller's position 4 setting
     _pos_4_var = 'POS[3]'
     
+    #: str: address of the controller's home phase register (one of the HOME_* values)
+    _home_phase_var = 'A[13]'
+    
+    #: list: addresses of the controller's home phase duration registers (ms spent in each home phase)
+    _home_phase_time_vars = ['HPT[0]', 'HPT[1]', 'HPT[2]', 'HPT[3]']
+    
+    #: str: firmware variable set while homing, and left set if homing fails
+    _homefail_var = 'homefail'
+    
+    #: list: addresses of the controller's per-position aim corrections, in resolver counts
+    _pos_correction_vars = ['POSC[0]', 'POSC[1]', 'POSC[2]', 'POSC[3]']
+    
     #: str: address of the controller's resolver turns register
     _resolver_turns_var = 'R[0]'
     
     #: str: address of the controller's resolver position register
     _resolver_position_var = 'R[1]'
+    
+    #: str: controller's running average of moves per position request, used by auto speed
+    _auto_average_var = 'autoavg'
+    
+    #: str: controller's limit on autoavg above which auto speed uses the medium profile
+    _auto_limit_var = 'autolim'
+    
+    #: str: controller's free running clock, in servo updates
+    _clock_var = 'TIME'
+    
+    #: str: address of the controller's move sequence state register (one of the SEQUENCE_* values)
+    _seq_state_var = 'A[14]'
+    
+    #: str: address of the controller's register holding the sequence step being run
+    _seq_step_var = 'A[15]'
+    
+    #: str: address of the controller's register holding the number of steps in the sequence
+    _seq_length_var = 'A[16]'
+    
+    #: str: address of the controller's register holding the number of passes to run (0 until stopped)
+    _seq_passes_var = 'A[17]'
+    
+    #: str: address of the controller's register counting completed passes through the sequence
+    _seq_done_var = 'A[18]'
+    
+    #: str: controller array of sequence step positions
+    _seq_position_array = 'SQP'
+    
+    #: str: controller array of sequence step angle offsets in degrees
+    _seq_offset_array = 'SQO'
+    
+    #: str: controller array of sequence step dwell times in ms
+    _seq_dwell_array = 'SQD'
+    
+    #: str: controller array of controller TIMEs at which each sequence step reached its position
+    _seq_time_array = 'SQT'
+    
+    #: str: controller array of the angle error at which each sequence step reached its position
+    _seq_error_array = 'SQE'
+    
+    #: str: controller array of the angle at which each sequence step reached its position
+    _seq_angle_array = 'SQA'
+    
+    #: str: address of the controller's angle offset sweep state register (one of the SEQUENCE_* values)
+    _sweep_state_var = 'A[19]'
+    
+    #: str: address of the controller's angle offset sweep rate register, in degrees/s
+    _sweep_rate_var = 'A[20]'
+    
+    #: str: address of the controller's angle offset sweep end register, in degrees
+    _sweep_end_var = 'A[21]'
+    
+    #: str: address of the controller's sweep record interval register (samples every 2**n ms)
+    _sweep_interval_var = 'A[22]'
+    
+    #: str: address of the controller's register counting the samples recorded in the last sweep
+    _sweep_count_var = 'A[23]'
+    
+    #: str: address of the controller's register holding the motor position at angle 0
+    _sweep_angle_zero_var = 'A[24]'
+    
+    #: str: address of the controller's register holding the motor position at angle offset 0
+    _sweep_offset_zero_var = 'A[25]'
+    
+    #: str: controller array of the controller TIME of each sweep sample
+    _sweep_time_array = 'SWT'
+    
+    #: str: controller array of the motor position of each sweep sample
+    _sweep_position_array = 'SWP'
+    
+    #: str: firmware variable holding the resolver counts per degree of wheel angle
+    _angle_scale_var = 'rstep'
+    
+    #: str: firmware variable holding the resolver counts per turn, which sets the angle offset scale
+    _resolver_counts_var = 'rres'
+    
+    #: list: (attribute, controller variable, type) read by update(). These are read in a single
+    #: command along with the controller clock, so that they are sampled together.
+    _update_registers = [
+        ('_command_position', _compos_var, int),
+        ('_position', _curpos_var, int),
+        ('_speed', _speed_var, int),
+        ('_time', _time_var, float),
+        ('_status', _status_var, int),
+        ('_angle', _angle_var, float),
+        ('_angle_error', _angle_error_var, float),
+        ('_angle_tolerance', _angle_tolerance_var, float),
+        ('_angle_offset', _angle_offset_var, float),
+        ('_moves', _moves_var, int),
+        ('_status_word', _status_word_var, int),
+        ('_sequence', _sequence_var, int),
+        ('_corrections', _corrections_var, int),
+        ('_homes', _homes_var, int),
+        ('_home_fallbacks', _home_fallbacks_var, int),
+        ('_first_error', _first_error_var, float),
+        ('_sequence_state', _seq_state_var, int),
+        ('_sequence_step', _seq_step_var, int),
+    ]
+    
+    #: list: (attribute, controller variable, type) read by every poll_fast(), along with the
+    #: status word and sequence number
+    _fast_registers = [
+        ('_angle_error', _angle_error_var, float),
+        ('_corrections', _corrections_var, int),
+        ('_home_fallbacks', _home_fallbacks_var, int),
+    ]
+    
+    #: list: (attribute, controller variable, type) read by update_extra()
+    _update_extra_registers = [
+        ('_pos_1', _pos_1_var, int),
+        ('_pos_2', _pos_2_var, int),
+        ('_pos_3', _pos_3_var, int),
+        ('_pos_4', _pos_4_var, int),
+        ('_resolver_turns', _resolver_turns_var, int),
+        ('_resolver_position', _resolver_position_var, int),
+    ]
+    
+    #: int: Maximum length of a batched MG command
+    _max_command_length = 72
+    
+    #: dict: firmware variables holding the (speed, acceleration, deceleration) for each speed setting
+    _profile_vars = {
+        1: ('slowsp', 'slowAC', 'slowDC'),
+        2: ('medsp', 'medAC', 'medDC'),
+        3: ('fastsp', 'fastAC', 'fastDC'),
+    }
 
-    def __init__(self, ip_address=default_IP, logger=logger, debug=False):
+    def __init__(self, ip_address=default_IP, logger=logger, debug=False, history=None, wrap=True, max_turns=None,
+                 client_factory=None, name=None, timeout=None, transcript=None, transport=None):
         """Create a SelectorWheel object for communication with one Selector Wheel Controller.
         Opens a Modbus TCP connection to the Selector Wheel controller at `ip_address`, and reads the
         current _position, speed etc.
         Args:
             ip_address (str): IP Address of the controller to communicate with
+            history (str or :obj:`MoveHistory`): History store, or path to a history store,
+                to record moves and homes in.
+            wrap (bool): Allow moves to wrap through position 4 <-> 1. Set to False if there
+                is a hard stop or cable wrap that prevents this.
+            max_turns (float): Maximum number of full turns the wheel may wind away from home.
+                None for no limit.
+            client_factory (callable): Returns a new gclib.py-like client. Defaults to gclib.py.
+            name (str): Name identifying this client's connection in logs and telemetry.
+            timeout (float): Timeout for communication with the controller in seconds.
+                Defaults to the gclib default.
+            transcript (str or :obj:`TranscriptRecorder`): Transcript, or path to a transcript
+                file, to record all the commands sent to the controller and their responses in.
+            transport (str): "gclib" to talk to the controller through gclib, or "socket" to use
+                the native :obj:`GalilSocket` transport, which pipelines reads and does not need
+                gclib. Defaults to gclib if it is installed. Ignored if `client_factory` is given.
         """
         #: (:obj:`ModbusTcpClient`): Client for communicating with the controller
         self._debug = debug
@@ -80,35 +326,131 @@ class Selector(object):
         
         self._time_step = 0.1
         
-        self._client = gclib.py()
+        # Only close histories we opened ourselves
+        self._own_history = isinstance(history, str)
+        if self._own_history:
+            history = MoveHistory(history)
+        #: (:obj:`MoveHistory`): Store for the history of moves and homes
+        self.history = history
+        
+        self.wrap = wrap
+        self.max_turns = max_turns
+        
+        self._home_phase = HOME_IDLE
+        self._home_phase_times = [0] * len(self._home_phase_time_vars)
+        self._home_failed = False
+        
+        #: (:obj:`ClockSync`): Estimate of the controller clock in host time
+        self.clock = ClockSync()
+        self._controller_time = None
+        self._timestamp = None
+        
+        #: (:obj:`MoveTimeEstimator`): Estimator for the duration of moves
+        self.move_time_estimator = None
+        self._build_move_time_estimator()
+        
+        # Only close transcripts we opened ourselves
+        self._own_transcript = isinstance(transcript, str)
+        if self._own_transcript:
+            transcript = TranscriptRecorder(transcript)
+        #: (:obj:`TranscriptRecorder`): Recorder for the commands sent to the controller
+        self.transcript = transcript
+        
+        if transport is None:
+            transport = default_transport
+        if transport not in transports:
+            raise ValueError(f"Transport must be one of {transports}")
+        if client_factory is None and transport == "socket":
+            client_factory = GalilSocket
+        
+        self._client_factory = client_factory
+        self._name = name
+        self._options = default_options
+        if timeout is not None:
+            self._options = f"{default_options} -t {int(timeout * 1000)}"
+        
+        #: (:obj:`SharedConnection`): Connection to the controller, shared with other Selector objects
+        self._client = SharedConnection(ip_address, options=self._options, client_factory=client_factory, name=name)
         
         self.connect(ip_address)
         
     def connect(self, ip_address=default_IP):
-        
+        """Connect to the controller at `ip_address`, sharing any existing connection to it."""
         try:
-            self._client.GOpen(f"{ip_address} -s ALL")
+            self._client = get_connection(ip_address, options=self._options, client_factory=self._client_factory,
+                                          name=self._name)
+            self._logger.debug(f"Using controller handle {self._client.handle} for {ip_address}")
+            if self.transcript:
+                self._client.recorder = self.transcript
         
             self.update_all()
+            self.get_speed_profiles()
+            self.get_position_corrections()
+            # The controller makes corrective moves and runs sequences and sweeps itself, with
+            # the direction mode it starts up with, so make that match the wrap setting
+            self.set_direction(self.default_direction)
         except gclib.GclibError as e:
             self._logger.error(f"GCLib error: {str(e)}")
             if str(e) == 'device failed to open':
                 self._logger.error(f"Could not connect to selector controller at {ip_address}")
+            # Don't leave a handle open on the controller if we failed to set up
+            if self._client.users > 0:
+                release_connection(self._client)
                 
     def is_connected(self):
         """Return the connection status to the Galil device"""
-        try:
-            status = self._client._cc()
-            if status == 0:
-                status = True
-        except gclib.GcLibError as e:
-            status = False
-        
-        return status
+        return self._client.is_open
         
     def disconnect(self):
-        """Disconnect from the modbus server"""
-        self._client.disconnect()
+        """Release the connection to the controller, closing its handle if no one else is using it."""
+        if self._client.users > 0:
+            if self.transcript and self._client.recorder is self.transcript:
+                self._client.recorder = None
+            release_connection(self._client)
+        if self._own_transcript:
+            self.transcript.close()
+        if self._own_history:
+            self.history.close()
+
+    def abort_connection(self):
+        """Close the controller handle immediately, to break a command that is hung.
+        
+        May be called from another thread while a command is in progress. Commands fail
+        until the Selector reconnects.
+
+        Returns:
+            bool: True if the hung command was broken, False if it could not be."""
+        self._logger.warning(f"Aborting connection to {self._client.address}")
+        aborted = self._client.abort()
+        if not aborted:
+            self._logger.error(f"Could not abort connection to {self._client.address}")
+        return aborted
+
+    @property
+    def handle(self):
+        """str: Letter of the controller handle used by this connection."""
+        return self._client.handle
+
+    def get_handles(self):
+        """Read the state of all the controller's Ethernet handles."""
+        return self._client.handles()
+
+    def get_handles_in_use(self):
+        """Read the number of the controller's Ethernet handles that are in use."""
+        return self._client.handles_in_use()
+
+    def clear_stale_handles(self):
+        """Close any other handles on the controller opened from this host.
+        
+        Only done when the connection is confirmed to go through gcaps, as otherwise the
+        other handles may belong to live clients such as the command line interface."""
+        if not self._client.gcaps_running():
+            self._logger.info("gcaps is not confirmed to be running, not clearing controller handles")
+            return []
+        closed = self._client.clear_stale_handles()
+        if closed:
+            self._logger.warning(f"Closed stale controller handles {', '.join(closed)}")
+        return closed
         
     @property
     def command_position(self):
@@ -127,12 +469,13 @@ class Selector(object):
 
     @property
     def speed(self):
-        """int: Speed of the Selector Wheel. Value is one of 1 (slowest) to 3 (fastest)."""
+        """int: Speed of the Selector Wheel. Value is one of 1 (slowest) to 3 (fastest), or 0 (auto)."""
         return self._speed
 
     @property
     def angle(self):
-        """float: Angle of the Selector Wheel in degrees."""
+        """float: Angle of the Selector Wheel from home in degrees.
+        Includes any full turns made by wrapping moves, so may be outside 0-360."""
         return self._angle
 
     @property
@@ -155,6 +498,56 @@ class Selector(object):
         """int: Time taken for last commanded move. Value is the time take in milliseconds."""
         return self._time
     
+    @property
+    def timestamp(self):
+        """float: Host epoch time at which the controller sampled the values read by the last update."""
+        return self._timestamp
+    
+    @property
+    def controller_time(self):
+        """float: Controller TIME at which the values read by the last update were sampled."""
+        return self._controller_time
+    
+    @property
+    def clock_offset(self):
+        """float: Host epoch time at controller TIME 0."""
+        return self.clock.offset
+    
+    @property
+    def clock_rtt(self):
+        """float: Shortest recent round trip time to the controller in seconds. Bounds the
+        error of `timestamp`."""
+        return self.clock.rtt
+    
+    @property
+    def moves(self):
+        """int: Number of moves needed to reach the position in the last commanded move.
+        Values above 1 indicate that corrective moves were needed."""
+        return self._moves
+    
+    @property
+    def corrections(self):
+        """int: Number of corrective moves the controller has made while parked, because the
+        angle error drifted beyond the angle tolerance."""
+        return self._corrections
+    
+    @property
+    def homes(self):
+        """int: Number of times the controller has homed since its program started."""
+        return self._homes
+    
+    @property
+    def home_fallbacks(self):
+        """int: Number of times the controller has homed because corrective moves failed to
+        bring the angle error within the tolerance."""
+        return self._home_fallbacks
+    
+    @property
+    def first_error(self):
+        """float: Angle error in degrees at which the last move first landed, before the
+        controller made any corrective moves."""
+        return self._first_error
+    
     @property
     def pos_1(self):
         """int: Position of 1st selector position"""
@@ -190,6 +583,47 @@ class Selector(object):
         """int: Selector Wheel status"""
         return self._status
     
+    @property
+    def status_word(self):
+        """int: Packed status word. Bits are given by the STATUS_* constants, with the current
+        position in bits 4-7 and the commanded position in bits 8-11."""
+        return self._status_word
+    
+    @property
+    def sequence(self):
+        """int: State change sequence number. Increments whenever the status word changes."""
+        return self._sequence
+    
+    @property
+    def sequence_state(self):
+        """int: State of the move sequence, one of the SEQUENCE_* values."""
+        return self._sequence_state
+    
+    @property
+    def sequence_step(self):
+        """int: Step of the move sequence being run."""
+        return self._sequence_step
+    
+    @property
+    def moving(self):
+        """bool: True if the wheel is moving."""
+        return bool(self._status_word & STATUS_MOVING)
+    
+    @property
+    def in_position(self):
+        """bool: True if the wheel has reached the commanded position."""
+        return bool(self._status_word & STATUS_IN_POSITION)
+    
+    @property
+    def in_tolerance(self):
+        """bool: True if the angle error is within the angle tolerance."""
+        return bool(self._status_word & STATUS_IN_TOLERANCE)
+    
+    @property
+    def homing(self):
+        """bool: True if the wheel is homing, or the last home failed."""
+        return bool(self._status_word & STATUS_HOMING)
+    
     def read_value(self, var_name):
         """Read a variable value from the Galil controller"""
         cmd = f'MG {var_name}'
@@ -202,6 +636,67 @@ class Selector(object):
         
         return float(ret)
     
+    def read_values(self, var_names):
+        """Read several variable values from the Galil controller.
+        
+        Variables are read in as few MG commands as possible, rather than one command
+        per variable.
+        
+        Args:
+            var_names (list): Names of the variables to read.
+        
+        Returns:
+            list: float values of the variables, in the same order as var_names."""
+        batches = []
+        batch = []
+        for var_name in var_names:
+            if batch and len("MG " + ",".join(batch + [var_name])) > self._max_command_length:
+                batches.append(batch)
+                batch = []
+            batch.append(var_name)
+        if batch:
+            batches.append(batch)
+        
+        # The MG commands are pipelined by transports that support it
+        cmds = [f'MG {",".join(batch)}' for batch in batches]
+        self._logger.debug(f"Calling {cmds}")
+        try:
+            rets = self._client.GCommands(cmds)
+        except gclib.GclibError as e:
+            self._logger.error(f"GCLib Error: {e}")
+            raise e
+        
+        values = []
+        for batch, cmd, ret in zip(batches, cmds, rets):
+            batch_values = [float(v) for v in ret.split()]
+            if len(batch_values) != len(batch):
+                raise ValueError(f"Expected {len(batch)} values from '{cmd}', got '{ret}'")
+            values.extend(batch_values)
+        return values
+    
+    def _read_registers(self, registers):
+        """Read a list of (attribute, variable, type) registers, and set the attributes."""
+        values = self.read_values([var for _, var, _ in registers])
+        for (attr, _, cast), value in zip(registers, values):
+            setattr(self, attr, cast(value))
+
+    def read_values_timed(self, var_names):
+        """Read several variable values along with the controller clock, and update the
+        estimate of the controller clock.
+        
+        The values are sampled together, at the same controller time, if they fit in a single
+        MG command.
+        
+        Returns:
+            tuple: (values, timestamp) where values is a list of the float values of the variables,
+                and timestamp is the host epoch time at which they were sampled."""
+        sent = time.time()
+        values = self.read_values([self._clock_var] + list(var_names))
+        received = time.time()
+        self._controller_time = values[0]
+        self.clock.add_sample(sent, received, values[0])
+        return values[1:], self.clock.to_host(values[0])
+
     def write_value(self, var_name, value):
         """Read a variable value from the Galil controller"""
         cmd = f'{var_name}={value}'
@@ -305,6 +800,13 @@ class Selector(object):
 
         return self.time
 
+    def get_moves(self):
+        """Read the number of moves needed for the last commanded move from the controller."""
+        ret = self.read_value(self._moves_var)
+        self._moves = int(ret)
+
+        return self.moves
+
     def get_resolver_turns(self):
         """Read the resolver turn count from the controller."""
         ret = self.read_value(self._resolver_turns_var)
@@ -319,17 +821,74 @@ class Selector(object):
 
         return self.resolver_position
            
+    def get_speed_profiles(self):
+        """Read the speed, acceleration and deceleration for each speed setting from the controller,
+        and rebuild the move time estimator from them."""
+        profiles = {}
+        for speed, names in self._profile_vars.items():
+            profiles[speed] = tuple(self.read_value(name) for name in names)
+        self._build_move_time_estimator(profiles)
+        self.get_auto_profile()
+
+        return profiles
+
+    def get_auto_profile(self):
+        """Read which profile the controller's auto speed uses for the bulk of a move, and
+        update the move time estimator to match.
+        
+        The controller uses the medium profile while its running average of moves per
+        position request is above its limit, and the fast profile otherwise.
+        
+        Returns:
+            int: Speed setting whose profile auto moves use, 2 or 3."""
+        average, limit = self.read_values([self._auto_average_var, self._auto_limit_var])
+        auto_profile = 2 if average > limit else 3
+        self.move_time_estimator.set_auto_profile(auto_profile)
+        return auto_profile
+
+    def _build_move_time_estimator(self, profiles=None):
+        """Create the move time estimator, and refine it from the move history if there is one."""
+        self.move_time_estimator = MoveTimeEstimator(profiles=profiles, wrap=self.wrap)
+        if self.history is not None:
+            self.move_time_estimator.fit(self.history)
+
+    def estimate_move_time(self, position, speed=None, from_position=None):
+        """Estimate the time a move to `position` will take, without moving the wheel.
+        
+        Args:
+            position (int): Position to move to. One of 1, 2, 3 or 4.
+            speed (int): Speed setting to estimate for. Defaults to the current speed.
+            from_position (int): Position to move from. Defaults to the current position.
+        
+        Returns:
+            float: Estimated move time in ms.
+        
+        Raises:
+            ValueError: if the position to move from is not known, e.g. before the wheel is homed."""
+        if speed is None:
+            speed = self.speed
+        if from_position is None:
+            from_position = self.position
+        if int(speed) == SPEED_AUTO:
+            self.get_auto_profile()
+        return self.move_time_estimator.estimate(int(from_position), int(position), int(speed))
+
+    def move_time_table(self, speed=None):
+        """Return the table of estimated move times in ms, indexed by [from-1, to-1].
+        
+        Args:
+            speed (int): Speed setting to return the table for. Defaults to the current speed."""
+        if speed is None:
+            speed = self.speed
+        if int(speed) == SPEED_AUTO:
+            self.get_auto_profile()
+        return self.move_time_estimator.table[int(speed)]
+
     def update(self, debug=False):
         """Update all the data from the selector."""
-        self.get_command_position()
-        self.get_position()
-        self.get_speed()
-        self.get_time()
-        self.get_status()
-        self.get_angle()
-        self.get_angle_error()
-        self.get_angle_tolerance()
-        self.get_angle_offset()
+        values, self._timestamp = self.read_values_timed([var for _, var, _ in self._update_registers])
+        for (attr, _, cast), value in zip(self._update_registers, values):
+            setattr(self, attr, cast(value))
         if debug:
             self.update_extra()
             
@@ -337,12 +896,26 @@ class Selector(object):
         """Get the extra status variables from the controller.
         
         These will only change when the wheel is rehomed."""
-        self.get_pos_1()
-        self.get_pos_2()
-        self.get_pos_3()
-        self.get_pos_4()
-        self.get_resolver_turns()
-        self.get_resolver_position()
+        self._read_registers(self._update_extra_registers)
+
+    def poll_fast(self):
+        """Read the status word and sequence number, along with the angle error and correction
+        counts, in a single command, and refresh all the data from the selector only if the
+        sequence number has changed.
+        
+        Returns:
+            bool: True if the state of the selector changed since the last poll."""
+        values, _ = self.read_values_timed([self._status_word_var, self._sequence_var] +
+                                           [var for _, var, _ in self._fast_registers])
+        status_word, sequence = values[:2]
+        self._status_word = int(status_word)
+        for (attr, _, cast), value in zip(self._fast_registers, values[2:]):
+            setattr(self, attr, cast(value))
+        if int(sequence) == getattr(self, "_sequence", None):
+            return False
+        
+        self.update()
+        return True
 
     def update_all(self):
         """Get all the status variables from the controller"""
@@ -351,25 +924,53 @@ class Selector(object):
 
     def set_speed(self, speed):
         """Set the speed of motion for the wheel.
+        
+        Speed 0 selects the adaptive profile: the controller makes most of each move with the
+        fast profile and the final approach with the slow profile, dropping to the medium
+        profile if recent moves have needed corrective moves.
+        
         Args:
-            speed (int): Speed setting. One of 1 (slowest), 2 or 3 (fastest). 1 and 2 are more reliable.
+            speed (int): Speed setting. One of 0 (auto), 1 (slowest), 2 or 3 (fastest). 1 and 2 are more reliable.
         """
         try:
             speed = int(speed)
         except ValueError:
             raise ValueError("Cannot cast speed to integer")
         
-        if speed not in range(1,4):
-            raise ValueError("Speed must be an integer between 1 and 3")
+        if speed not in range(0,4):
+            raise ValueError("Speed must be an integer between 0 and 3")
 
         self.write_value(self._speed_var, int(speed))
         self._speed = self.get_speed()
 
-    def set_position(self, position):
+    @property
+    def default_direction(self):
+        """int: The direction mode used for moves when none is requested."""
+        return DIRECTION_SHORTEST if self.wrap else DIRECTION_DIRECT
+
+    def set_direction(self, direction):
+        """Set the direction mode the controller uses for moves.
+        Args:
+            direction (int): One of DIRECTION_SHORTEST (0), DIRECTION_FORWARD (1),
+                DIRECTION_REVERSE (-1) or DIRECTION_DIRECT (2).
+        """
+        if direction not in directions:
+            raise ValueError(f"Direction must be one of {directions}")
+        self.write_value(self._direction_var, int(direction))
+
+    def set_position(self, position, direction=None, wait=True, started=None):
         """Set the _position for the wheel.
         !This will start motion to requested position at the current speed!
         Args:
             position (int): Position setting. One of 1, 2, 3, or 4.
+            direction (int): Force the direction of rotation, DIRECTION_FORWARD (1) or
+                DIRECTION_REVERSE (-1). Defaults to the shortest rotation allowed by the
+                wrap and max_turns settings.
+            wait (bool): Wait for the move to complete. If False, return as soon as the
+                move has been commanded; call `finish_move` once `move_done` is True to
+                record the move and restore the default direction.
+            started (callable): Called with no arguments as soon as the move has been commanded,
+                before waiting for it to complete.
         """
         try:
             position = int(position)
@@ -379,16 +980,221 @@ class Selector(object):
         if position not in range(1, 5):
             raise ValueError("Requested position must be an integer between 1 and 4.")
 
+        from_position = getattr(self, "_position", 0)
+
+        # Plan the move so that the controller is told the direction to rotate in,
+        # rather than choosing it from the current wrap setting.
+        if direction is None:
+            direction = self.default_direction
+        if from_position in range(1, 5):
+            steps = plan_move(from_position, position, direction=direction, wrap=self.wrap,
+                              angle=getattr(self, "_angle", None), max_turns=self.max_turns)
+            if steps != 0:
+                direction = DIRECTION_FORWARD if steps > 0 else DIRECTION_REVERSE
+        if not self.wrap:
+            direction = DIRECTION_DIRECT
+
         try:
+            self.set_direction(direction)
             self.write_value(self._compos_var, int(position))
-            sleep(self._time_step)
-            self._client.GMotionComplete('A')
+            if started:
+                started()
+            self._command_position = position
+            self._move_from_position = from_position
+            self._move_direction = direction
+            if not wait:
+                return
+            self.wait_for_move()
+        except gclib.GclibError as e:
+            self._logger.error(f"GCLib Error: {e}")
+            raise e
 
+        self.finish_move()
+
+    def finish_move(self):
+        """Read back the state of the selector after a move, restore the default direction,
+        and record the move in the history."""
+        try:
             self.update()
+            if getattr(self, "_move_direction", None) != self.default_direction:
+                self.set_direction(self.default_direction)
         except gclib.GclibError as e:
             self._logger.error(f"GCLib Error: {e}")
             raise e
+
+        self._record_history(EVENT_MOVE, getattr(self, "_move_from_position", 0))
             
+    def get_position_corrections(self):
+        """Read the per-position aim corrections from the controller."""
+        self._position_corrections = [int(v) for v in self.read_values(self._pos_correction_vars)]
+        
+        return self._position_corrections
+
+    def set_position_corrections(self, corrections):
+        """Set the per-position aim corrections used by the controller.
+        
+        The corrections are added to the target of each move to a position, to cancel
+        systematic landing errors. They are not changed by homing, but are reset when the
+        controller restarts. See `calibration.position_corrections`.
+        
+        Args:
+            corrections (list): Correction for each of positions 1-4, in resolver counts."""
+        if len(corrections) != len(self._pos_correction_vars):
+            raise ValueError(f"Need {len(self._pos_correction_vars)} position corrections")
+        for var, correction in zip(self._pos_correction_vars, corrections):
+            self.write_value(var, int(correction))
+        
+        return self.get_position_corrections()
+
+    def upload_sequence(self, steps):
+        """Download a move sequence to the controller.
+        
+        The controller runs the sequence itself once started with `start_sequence`, moving to
+        each step's position and angle offset in turn and staying there for the step's dwell
+        time, so the timing of the sequence does not depend on the host.
+        
+        Args:
+            steps (list): (position, offset, dwell) for each step, where position is 1-4 or 5
+                to home, offset is the angle offset in degrees, and dwell is the time to stay
+                at the position in seconds, from the time it is reached.
+        
+        Raises:
+            ValueError: if the sequence is empty, too long, has invalid positions, or could wind
+                the wheel beyond `max_turns`.
+            RuntimeError: if a sequence is running."""
+        if not 0 < len(steps) <= max_sequence_steps:
+            raise ValueError(f"Sequence must have 1-{max_sequence_steps} steps")
+        positions = [int(p) for p, _, _ in steps]
+        if any(p not in range(1, 6) for p in positions):
+            raise ValueError(f"Sequence positions must be 1-5, got {positions}")
+        check_sequence(getattr(self, "_position", 0), positions, wrap=self.wrap,
+                       angle=getattr(self, "_angle", None), max_turns=self.max_turns)
+        if int(self.read_value(self._seq_state_var)) != SEQUENCE_IDLE:
+            raise RuntimeError("Cannot change the sequence while it is running")
+        
+        last = len(steps) - 1
+        self._client.GArrayDownload(self._seq_position_array, 0, last, positions)
+        self._client.GArrayDownload(self._seq_offset_array, 0, last, [float(o) for _, o, _ in steps])
+        self._client.GArrayDownload(self._seq_dwell_array, 0, last, [int(d * 1000) for _, _, d in steps])
+        self.write_value(self._seq_length_var, len(steps))
+        
+    def start_sequence(self, passes=1):
+        """Start running the move sequence downloaded with `upload_sequence`.
+        
+        The angle offset in use when the sequence starts is restored when it ends.
+        
+        Args:
+            passes (int): Number of passes through the sequence. 0 runs the sequence until
+                `stop_sequence` is called."""
+        if passes < 0:
+            raise ValueError("Number of passes must be 0 or more")
+        self.write_value(self._seq_passes_var, int(passes))
+        self.write_value(self._seq_state_var, SEQUENCE_START)
+        
+    def stop_sequence(self):
+        """Stop the running move sequence after the current step's move."""
+        self.write_value(self._seq_state_var, SEQUENCE_IDLE)
+        
+    def get_sequence_status(self):
+        """Read the state of the move sequence.
+        
+        Returns:
+            dict: 'state' (one of the SEQUENCE_* values), 'step' being run, number of
+                'steps' in the sequence and number of 'passes' completed."""
+        state, step, steps, passes = self.read_values([self._seq_state_var, self._seq_step_var,
+                                                       self._seq_length_var, self._seq_done_var])
+        return {'state': int(state), 'step': int(step), 'steps': int(steps), 'passes': int(passes)}
+        
+    def get_sequence_results(self):
+        """Read the time, angle error and angle at which each step of the last pass through
+        the move sequence reached its position.
+        
+        Returns:
+            list: (timestamp, angle_error, angle) for each step, where timestamp is the host
+                epoch time."""
+        steps = int(self.read_value(self._seq_length_var))
+        if steps == 0:
+            return []
+        if self.clock.offset is None:
+            self.update()
+        times = self._client.GArrayUpload(self._seq_time_array, 0, steps - 1)
+        errors = self._client.GArrayUpload(self._seq_error_array, 0, steps - 1)
+        angles = self._client.GArrayUpload(self._seq_angle_array, 0, steps - 1)
+        return [(self.clock.to_host(t), float(e), float(a)) for t, e, a in zip(times, errors, angles)]
+        
+    def run_sequence(self, steps, passes=1, timeout=None):
+        """Download and run a move sequence, and wait for it to finish.
+        
+        Args:
+            steps (list): Sequence steps, as for `upload_sequence`.
+            passes (int): Number of passes through the sequence.
+            timeout (float): Time to wait in seconds, or None to wait indefinitely.
+        
+        Returns:
+            list: (timestamp, angle_error, angle) for each step of the last pass.
+        
+        Raises:
+            TimeoutError: if the sequence has not finished within `timeout`. The
+                sequence is stopped."""
+        if passes < 1:
+            raise ValueError("run_sequence needs a finite number of passes")
+        self.upload_sequence(steps)
+        self.start_sequence(passes)
+        start = time.monotonic()
+        while self.get_sequence_status()['state'] != SEQUENCE_IDLE:
+            if timeout is not None and time.monotonic() - start > timeout:
+                self.stop_sequence()
+                raise TimeoutError(f"Sequence did not finish within {timeout} s")
+            sleep(self._time_step)
+        self.update_all()
+        return self.get_sequence_results()
+
+    def start_sweep(self, end, rate, interval=0.016):
+        """Start a continuous sweep of the angle offset from its current value to `end`.
+        
+        The controller moves the wheel at a constant rate, recording the motor position
+        at regular intervals, and sets the angle offset to `end` when the sweep finishes.
+        
+        Args:
+            end (float): Angle offset to sweep to, in degrees.
+            rate (float): Sweep rate in degrees/s.
+            interval (float): Time between recorded samples in seconds. Rounded to a power
+                of two ms between 2 and 256 ms."""
+        if rate <= 0:
+            raise ValueError("Sweep rate must be positive")
+        n = min(max(int(round(math.log2(interval * 1000))), 1), 8)
+        self.write_value(self._sweep_rate_var, f"{rate:.4f}")
+        self.write_value(self._sweep_end_var, f"{end:.3f}")
+        self.write_value(self._sweep_interval_var, n)
+        self.write_value(self._sweep_state_var, SEQUENCE_START)
+        
+    def get_sweep_state(self):
+        """Read the state of the angle offset sweep (one of the SEQUENCE_* values)."""
+        return int(self.read_value(self._sweep_state_var))
+        
+    def get_sweep_samples(self):
+        """Read the samples recorded during the last angle offset sweep.
+        
+        Returns:
+            list: (timestamp, angle, offset) for each sample, where timestamp is the host
+                epoch time, and angle and offset are in degrees."""
+        count, angle_zero, offset_zero, rstep, rres = self.read_values(
+            [self._sweep_count_var, self._sweep_angle_zero_var, self._sweep_offset_zero_var,
+             self._angle_scale_var, self._resolver_counts_var])
+        count = min(int(count), max_sweep_samples)
+        if count == 0:
+            return []
+        if self.clock.offset is None:
+            self.update()
+        times = self._client.GArrayUpload(self._sweep_time_array, 0, count - 1)
+        positions = self._client.GArrayUpload(self._sweep_position_array, 0, count - 1)
+        samples = []
+        for t, p in zip(times, positions):
+            offset = (p - offset_zero) * 360.0 / rres
+            # Offsets are measured from the nearest turn of the position, as the firmware does
+            samples.append((self.clock.to_host(t), (p - angle_zero) / rstep, offset - round(offset / 360.0) * 360.0))
+        return samples
+
     def set_angle_tolerance(self, tolerance):
         """Set the angle tolerance for corrections.
         
@@ -412,20 +1218,212 @@ class Selector(object):
         self.write_value(self._angle_offset_var, f"{offset:.3f}")
         self._angle_offset = self.get_angle_offset()
         
+    def move_done(self):
+        """Read whether the controller has finished the last commanded move.
+        
+        The motion stopping is not enough: at auto speed #MOVE makes a long move as an
+        approach and a final move, and the motor is briefly idle between the two.  The move
+        is only done once the controller has set the current position to the commanded
+        position and cleared the moving status.
+        
+        Returns:
+            bool: True if the wheel is at the commanded position and not moving."""
+        command_position, position, status = self.read_values(
+            [self._compos_var, self._curpos_var, self._status_var])
+        return int(status) == 0 and int(position) == int(command_position)
+
+    def wait_for_move(self, timeout=None):
+        """Wait for the controller to start and finish any move following a change of
+        position or offset.
+        
+        Args:
+            timeout (float): Maximum time to wait in seconds. None to wait forever.
+        
+        Raises:
+            TimeoutError: if the move does not finish within `timeout`."""
+        sleep(self._time_step)
+        start = time.monotonic()
+        while not self.move_done():
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Move did not complete within {timeout} s")
+            sleep(self._time_step)
+        
     def zero_angle_offset(self):
         """Reset the angle offset to zero"""
         self.set_angle_offset(0.0)
 
-    def home(self):
-        """Move the wheel to the home position, and then to position 1.
-        Selector wheel controller automatically homes on power on."""
+    def deploy_firmware(self, path, force=False, burn=True, timeout=60.0):
+        """Deploy the firmware program in `path` to the controller, if it is not already loaded.
+        
+        !Restarting the firmware homes the wheel!  Waits for the start up home to finish
+        before reading back the state of the selector.
+        
+        Args:
+            path (str): Path to the firmware .dmc file.
+            force (bool): Download the program even if it is already loaded.
+            burn (bool): Burn the program to flash.
+            timeout (float): Maximum time to wait for the start up home in seconds.
+        
+        Returns:
+            bool: True if the program was downloaded.
+        
+        Raises:
+            TimeoutError: if the start up home does not finish within `timeout`."""
+        with open(path) as fp:
+            text = fp.read()
+        
+        try:
+            deployed = firmware.deploy(self._client, text, force=force, burn=burn, logger=self._logger)
+        except gclib.GclibError as e:
+            self._logger.error(f"GCLib Error: {e}")
+            raise e
+        
+        if deployed:
+            # #AUTO waits before initialising, so wait for the start up home to be commanded
+            # before waiting for it to finish
+            start = time.monotonic()
+            while int(self.read_value(self._compos_var)) != 5:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Controller did not start homing within {timeout} s of restarting")
+                sleep(self._time_step)
+            while not self.poll_home()[1]:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Start up home did not complete within {timeout} s")
+                sleep(self._time_step)
+            self.update_all()
+            self.get_speed_profiles()
+            self.get_position_corrections()
+            self.set_direction(self.default_direction)
+        return deployed
+
+    @property
+    def home_phase(self):
+        """int: Phase of the current home operation, one of the HOME_* values."""
+        return self._home_phase
+
+    @property
+    def home_phase_times(self):
+        """list: Time spent in each phase of the last home in ms."""
+        return self._home_phase_times
+
+    @property
+    def home_failed(self):
+        """bool: True if the last home did not complete."""
+        return self._home_failed
+
+    def get_home_phase_times(self):
+        """Read the time spent in each phase of the last home from the controller."""
+        self._home_phase_times = [int(v) for v in self.read_values(self._home_phase_time_vars)]
+
+        return self.home_phase_times
+
+    def get_home_failed(self):
+        """Read the home failure flag from the controller."""
+        ret = self.read_value(self._homefail_var)
+        self._home_failed = bool(int(ret))
+
+        return self.home_failed
+
+    def start_home(self):
+        """Start homing the wheel, and return immediately.
+        
+        Use `poll_home` to follow the progress of the home, and `finish_home` once it is done."""
+        self._home_from_position = getattr(self, "_position", 0)
+        self._home_phase = HOME_IDLE
         try:
             self.write_value(self._compos_var, 5)
-            sleep(self._time_step)
-            self._client.GMotionComplete('A')
-            sleep(self._time_step)
+        except gclib.GclibError as e:
+            self._logger.error(f"GCLib Error: {e}")
+            raise e
+
+    def poll_home(self):
+        """Read the progress of a home started with `start_home`.
+        
+        The home is only done once the wheel has moved back to its previous position:
+        the controller resets the commanded position from 5 at the end of #HOME, but keeps
+        the moving flag set until #EVENTLP has settled the wheel within the angle tolerance.
+        
+        Returns:
+            tuple: (phase, done), where phase is one of the HOME_* values, and done is True
+                once the controller has finished homing and returned to the previous position."""
+        command_position, phase, status, motion, angle_error, tolerance = self.read_values(
+            [self._compos_var, self._home_phase_var, self._status_var, "_BGA",
+             self._angle_error_var, self._angle_tolerance_var])
+        self._home_phase = int(phase)
+        done = (int(command_position) != 5 and self._home_phase == HOME_IDLE and int(status) == 0
+                and int(motion) == 0 and abs(angle_error) <= tolerance)
 
+        return self._home_phase, done
+
+    def finish_home(self):
+        """Read back the state of the selector after a home, and record it in the history."""
+        try:
             self.update_all()
+            self.get_home_phase_times()
+            self.get_home_failed()
         except gclib.GclibError as e:
             self._logger.error(f"GCLib Error: {e}")
-            raise e
\ No newline at end of file
+            raise e
+
+        self._record_history(EVENT_HOME, getattr(self, "_home_from_position", 0))
+
+    def home(self, timeout=None, progress=None):
+        """Move the wheel to the home position, and then back to the previous position.
+        Selector wheel controller automatically homes on power on.
+        
+        Args:
+            timeout (float): Maximum time to wait for the home in seconds. None to wait forever.
+            progress (callable): Called with the new phase whenever the home phase changes.
+        
+        Raises:
+            TimeoutError: if the home does not complete within `timeout`."""
+        self.start_home()
+        start = time.monotonic()
+        phase = HOME_IDLE
+        while True:
+            sleep(self._time_step)
+            new_phase, done = self.poll_home()
+            if progress and new_phase != phase:
+                progress(new_phase)
+            phase = new_phase
+            if done:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                self._logger.error(f"Home did not complete within {timeout} s, in phase {home_phase_names.get(phase, phase)}")
+                raise TimeoutError(f"Home did not complete within {timeout} s")
+
+        self.finish_home()
+
+    def _record_history(self, event, from_position):
+        """Record the last move or home in the history store, if there is one."""
+        if self.history is None:
+            return
+        aim_correction = math.nan
+        corrections = getattr(self, "_position_corrections", None)
+        if event == EVENT_MOVE and corrections and self.position in range(1, len(corrections) + 1):
+            aim_correction = corrections[self.position - 1]
+        try:
+            self.history.append(event=event, from_position=from_position, to_position=self.position,
+                                speed=self.speed, duration=self.time, angle=self.angle,
+                                angle_error=self.angle_error, angle_offset=self.angle_offset,
+                                retries=self.moves if event == EVENT_MOVE else 0,
+                                first_error=self.first_error if event == EVENT_MOVE else math.nan,
+                                aim_correction=aim_correction)
+        except OSError as e:
+            self._logger.error(f"Could not record history: {e}")
+
+
+class DummySelector(Selector):
+    """A Selector connected to a :obj:`SimulatedController` instead of real hardware."""
+    def __init__(self, ip_address="0.0.0.0", logger=logger, debug=False, time_scale=1.0, **kwargs):
+        """Create a Selector for a simulated controller.
+        
+        Args:
+            time_scale (float): Factor by which simulated moves run faster than real time.
+        """
+        super().__init__(ip_address=ip_address, logger=logger, debug=debug,
+                         client_factory=lambda: SimulatedController(time_scale=time_scale), **kwargs)
+        # The simulated controller homes on start up, as the real one does on power on.
+        while not self.poll_home()[1]:
+            sleep(self._time_step)
+        self.update_all()
@@ -0,0 +1,131 @@
+"""
+Offline analysis of the selector wheel position calibration.
+
+The firmware sets the position table from the home position with a fixed
+4096 count spacing (`POS[0..3]`), and converts resolver counts to motor steps
+with a fixed ratio.  Any mismatch shows up as a systematic error in where the
+wheel lands at the end of a move, which the firmware then fixes with corrective
+moves.
+
+This module fits the landing errors of recorded moves with a model of per-slot
+offsets and a term proportional to the length of the move, and turns the fit
+into per-slot aim corrections for the firmware's `POSC[]` array.
+
+The landing error used is the one the controller records where each move first
+lands, before any corrective moves.  The final angle error of a move is always
+within the angle tolerance, so fitting it would bias the offsets toward 0.
+Every move lands at one of the 4 slot angles, so a nonlinearity of the resolver
+with wheel angle cannot be told apart from the slot offsets, and is not fitted.
+
+Each move is recorded with the aim correction the controller applied to it, which
+is taken off its landing error before fitting.  The fit is therefore of the
+uncorrected landing errors, and gives the total corrections to use, whatever
+corrections were in effect while the history was recorded.
+"""
+import numpy as np
+
+from wsma_cryostat_selector.history import EVENT_MOVE
+from wsma_cryostat_selector.planner import plan_move, n_positions
+
+#: float: Resolver counts per degree of wheel rotation (rstep in the firmware)
+counts_per_degree = 45.1111
+
+
+class CalibrationFit(object):
+    """Result of fitting a calibration model to move landing errors."""
+
+    def __init__(self, slot_offsets, distance_gain, residual_rms, n_moves):
+        #: numpy.ndarray: Mean landing error for each slot in degrees
+        self.slot_offsets = slot_offsets
+        #: float: Landing error per position step moved, in degrees
+        self.distance_gain = distance_gain
+        #: float: RMS of the fit residuals in degrees
+        self.residual_rms = residual_rms
+        #: int: Number of moves used in the fit
+        self.n_moves = n_moves
+
+    def __repr__(self):
+        return (f"CalibrationFit(slot_offsets={self.slot_offsets}, distance_gain={self.distance_gain:.4f}, "
+                f"residual_rms={self.residual_rms:.4f}, n_moves={self.n_moves})")
+
+    def predict(self, slot, steps):
+        """Predict the landing error in degrees for moves to `slot` (0-3) after moving
+        `steps` positions. Both arguments may be arrays."""
+        return self.slot_offsets[np.asarray(slot)] + self.distance_gain * np.asarray(steps)
+
+
+def first_attempt_moves(history, start=None, stop=None, wrap=True):
+    """Return the recorded moves whose first landing error and aim correction are known.
+
+    The first landing error shows where the wheel lands after a single commanded move,
+    whether or not corrective moves followed, so all these moves are used for
+    calibration.  Moves recorded before the controller reported the first landing error,
+    or before the history recorded the aim correction, are left out.
+
+    Returns:
+        numpy.ndarray: structured array of history rows, with an extra `steps` field
+            giving the signed number of positions moved.
+    """
+    moves = history.query(start=start, stop=stop, event=EVENT_MOVE)
+    valid = (np.isfinite(moves["first_error"]) & np.isfinite(moves["aim_correction"])
+             & (moves["from_position"] >= 1) & (moves["from_position"] <= n_positions)
+             & (moves["to_position"] >= 1) & (moves["to_position"] <= n_positions)
+             & (moves["from_position"] != moves["to_position"]))
+    moves = moves[valid]
+
+    # Steps for each of the 4x4 position pairs, looked up for every move at once
+    step_table = np.array([[plan_move(i + 1, j + 1, wrap=wrap) for j in range(n_positions)]
+                           for i in range(n_positions)])
+    steps = step_table[moves["from_position"] - 1, moves["to_position"] - 1]
+
+    dtype = np.dtype(moves.dtype.descr + [("steps", "<i1")])
+    result = np.empty(len(moves), dtype=dtype)
+    for name in moves.dtype.names:
+        result[name] = moves[name]
+    result["steps"] = steps
+    return result
+
+
+def fit_calibration(moves):
+    """Fit the calibration model to the first landing errors of `moves`, without the
+    aim corrections that were applied to them.
+
+    The model is::
+
+        error - correction / counts_per_degree = offset[slot] + gain * steps
+
+    Args:
+        moves (numpy.ndarray): Moves as returned by `first_attempt_moves`.
+
+    Returns:
+        :obj:`CalibrationFit`
+    """
+    n = len(moves)
+    if n == 0:
+        raise ValueError("No moves to fit")
+
+    slot = moves["to_position"].astype(int) - 1
+
+    design = np.empty((n, n_positions + 1))
+    design[:, :n_positions] = slot[:, None] == np.arange(n_positions)
+    design[:, n_positions] = moves["steps"]
+
+    error = moves["first_error"].astype(float) - moves["aim_correction"].astype(float) / counts_per_degree
+    coeffs, _, _, _ = np.linalg.lstsq(design, error, rcond=None)
+    residuals = error - design @ coeffs
+
+    return CalibrationFit(slot_offsets=coeffs[:n_positions],
+                          distance_gain=float(coeffs[n_positions]),
+                          residual_rms=float(np.sqrt(np.mean(residuals**2))),
+                          n_moves=n)
+
+
+def position_corrections(fit):
+    """Return the per-slot aim corrections for the firmware POSC[] array, in resolver counts.
+
+    The corrections cancel the uncorrected landing error predicted for a move to each slot,
+    averaged over the move length, so they replace the corrections in effect rather than
+    adding to them."""
+    bias = fit.predict(np.arange(n_positions), np.zeros(n_positions))
+    return np.rint(-bias * counts_per_degree).astype(int)
+
@@ -16,7 +16,11 @@ Why does this file exist, and why not put this in __main__?
 """
 import os
 import argparse
+import functools
+import json
+import sys
 import wsma_cryostat_selector
+from wsma_cryostat_selector import calibration, fleet, scan
 
 default_ip = os.environ.get('WSMASELECTOR', '192.168.42.100')
 
@@ -35,13 +39,56 @@ parser.add_argument("-0", "--home", action="store_true",
                     help="Home the Selector Wheel. "
                          "Will move to position 1 after completion of homing operation "
                          "and then to requested position if given.")
-parser.add_argument("-s", "--speed", type=int, choices=[1,2,3],
-                    help="Set the speed to move at. "
+parser.add_argument("-s", "--speed", type=int, choices=[0,1,2,3],
+                    help="Set the speed to move at. 0 selects the adaptive profile. "
                          "Does not affect the speed of homing operations.")
 parser.add_argument("-t", "--tolerance", type=float,
                     help="Set the angular position tolerance for the wheel in degrees")
 parser.add_argument("-o", "--offset", type=float,
                     help="Set the angular position offset for the wheel in degrees")
+parser.add_argument("-d", "--direction", choices=["forward", "reverse"],
+                    help="Force the direction of rotation for the move. "
+                         "By default the wheel takes the shortest rotation.")
+parser.add_argument("-e", "--estimate", action="store_true",
+                    help="Estimate the time to move to the requested position without moving, "
+                         "or print the table of estimated move times if no position is given.")
+parser.add_argument("--deploy", metavar="FIRMWARE",
+                    help="Deploy the firmware .dmc file to the controller if it is not already loaded. "
+                         "Restarting the firmware homes the wheel.")
+parser.add_argument("--force", action="store_true",
+                    help="Deploy the firmware even if it is already loaded.")
+parser.add_argument("--no-burn", action="store_true",
+                    help="Do not burn the deployed firmware to flash.")
+parser.add_argument("--calibrate", metavar="HISTORY",
+                    help="Fit the position calibration to the move history in HISTORY "
+                         "and print the corrections.")
+parser.add_argument("--apply-calibration", action="store_true",
+                    help="Send the corrections fitted with --calibrate to the controller. "
+                         "They are lost when the controller restarts, see --save-calibration.")
+parser.add_argument("--save-calibration", metavar="CONFIG",
+                    help="Write the corrections fitted with --calibrate to the selector daemon config "
+                         "file CONFIG, from which the daemon applies them whenever it connects.")
+parser.add_argument("--scan", nargs=3, type=float, metavar=("START", "STOP", "STEP"),
+                    help="Step the angle offset from START to STOP degrees in steps of STEP, "
+                         "and print where the wheel settled at each offset.")
+parser.add_argument("--settle", type=float, default=0.0,
+                    help="Time to wait at each offset of a --scan, in seconds.")
+parser.add_argument("--scan-tolerance", type=float, default=scan.default_tolerance,
+                    help="Angle tolerance to use during a --scan, in degrees. Also the smallest STEP.")
+parser.add_argument("--sweep", nargs=3, type=float, metavar=("START", "STOP", "RATE"),
+                    help="Sweep the angle offset continuously from START to STOP degrees at RATE "
+                         "degrees/s, and print the recorded wheel angle.")
+parser.add_argument("--capture", metavar="TRANSCRIPT",
+                    help="Record the commands sent to the controller and its responses in TRANSCRIPT.")
+parser.add_argument("--replay", metavar="TRANSCRIPT",
+                    help="Answer commands from the recorded TRANSCRIPT instead of a controller.")
+parser.add_argument("--replay-speed", type=float, default=1.0,
+                    help="Factor by which to speed up the controller's responses when replaying. "
+                         "0 answers immediately.")
+parser.add_argument("--transport", choices=wsma_cryostat_selector.transports,
+                    default=wsma_cryostat_selector.default_transport,
+                    help="Talk to the controller through gclib, or directly over a socket. "
+                         "Defaults to gclib if it is installed.")
 parser.add_argument("position", type=int, choices=[1,2,3,4], nargs="?",
                     help="The wheel position to move to.")
 
@@ -50,13 +97,74 @@ def main(args=None):
 
     # Create the selector wheel object for communication with the controller
     # If address is 0.0.0.0, create a dummy selector for testing purposes.
-    if args.address=="0.0.0.0":
-        sel = wsma_cryostat_selector.DummySelector()
+    if args.replay:
+        factory = functools.partial(wsma_cryostat_selector.ReplayClient, args.replay, speed=args.replay_speed)
+        sel = wsma_cryostat_selector.Selector(ip_address=args.address, name="selector-cli",
+                                              client_factory=factory, transcript=args.capture)
+    elif args.address=="0.0.0.0":
+        sel = wsma_cryostat_selector.DummySelector(transcript=args.capture)
     else:
-        sel = wsma_cryostat_selector.Selector(ip_address=args.address)
+        sel = wsma_cryostat_selector.Selector(ip_address=args.address, name="selector-cli",
+                                              transcript=args.capture, transport=args.transport)
+
+    try:
+        run(sel, args)
+    finally:
+        sel.disconnect()
+
+def save_corrections(path, corrections):
+    """Write position `corrections` to the selector daemon config file at `path`."""
+    with open(path) as fp:
+        config = json.load(fp)
+    config["config"]["selector"]["position_corrections"] = [int(c) for c in corrections]
+    with open(path + ".part", "w") as fp:
+        json.dump(config, fp, indent=4)
+    os.replace(path + ".part", path)
+
+def run(sel, args):
+    """Carry out the actions requested in `args` with the selector `sel`."""
+    if args.deploy:
+        if sel.deploy_firmware(args.deploy, force=args.force, burn=not args.no_burn):
+            print(f"Deployed firmware {args.deploy}")
+        else:
+            print(f"Firmware {args.deploy} already loaded")
+        return
 
     sel.update_all()
 
+    if args.calibrate:
+        history = wsma_cryostat_selector.MoveHistory(args.calibrate)
+        fit = calibration.fit_calibration(calibration.first_attempt_moves(history, wrap=sel.wrap))
+        corrections = calibration.position_corrections(fit)
+        print(f"Calibration fit to {fit.n_moves} moves, residual RMS {fit.residual_rms:.3f} deg")
+        for i, (offset, correction) in enumerate(zip(fit.slot_offsets, corrections)):
+            print(f"Position {i+1} landing error : {offset:.3f} deg, correction {correction:d} counts")
+        print(f"Landing error per step moved : {fit.distance_gain:.4f} deg")
+        print(f"Corrections in effect : {sel.get_position_corrections()} counts")
+        if args.apply_calibration:
+            sel.set_position_corrections(corrections)
+            print("Applied position corrections")
+        if args.save_calibration:
+            save_corrections(args.save_calibration, corrections)
+            print(f"Saved position corrections to {args.save_calibration}")
+        return
+
+    if args.scan:
+        result = scan.offset_scan(sel, scan.scan_offsets(*args.scan), settle=args.settle,
+                                  tolerance=args.scan_tolerance)
+        print("timestamp          offset   angle      angle_error")
+        for row in result:
+            print(f"{row['timestamp']:.3f} {row['offset']:8.3f} {row['angle']:10.4f} {row['angle_error']:8.4f}")
+        return
+
+    if args.sweep:
+        start, stop, rate = args.sweep
+        result = scan.offset_sweep(sel, start, stop, rate)
+        print("timestamp          angle      offset")
+        for row in result:
+            print(f"{row['timestamp']:.3f} {row['angle']:10.4f} {row['offset']:8.4f}")
+        return
+
     if args.tolerance:
         print(f"Setting angle tolerance to {args.tolerance:.2f} degrees")
         sel.set_angle_tolerance(args.tolerance)
@@ -69,7 +177,7 @@ def main(args=None):
             print("Homing complete.")
         sel.set_speed(speed)
 
-    if args.speed:
+    if args.speed is not None:
         if args.verbosity:
             print(f"Setting speed to {args.speed}")
         sel.set_speed(args.speed)
@@ -79,9 +187,24 @@ def main(args=None):
             print(f"Setting offset to {args.offset}")
         sel.set_angle_offset(args.offset)
 
+    if args.estimate:
+        if args.position:
+            print(f"Estimated time to move to position {args.position} : "
+                  f"{sel.estimate_move_time(args.position):.0f} ms")
+        else:
+            print(f"Estimated move times at speed {sel.speed} (ms), from (rows) to (columns):")
+            for i, row in enumerate(sel.move_time_table()):
+                print(f"  {i+1} : " + " ".join(f"{t:6.0f}" for t in row))
+        return
+
     if args.position:
         print(f"Moving to position {args.position}")
-        sel.set_position(args.position)
+        if args.direction == "forward":
+            sel.set_position(args.position, direction=wsma_cryostat_selector.DIRECTION_FORWARD)
+        elif args.direction == "reverse":
+            sel.set_position(args.position, direction=wsma_cryostat_selector.DIRECTION_REVERSE)
+        else:
+            sel.set_position(args.position)
         if args.verbosity:
             print("Done")
     else:
@@ -106,4 +229,51 @@ def main(args=None):
         print(f"Resolver turns count      : {sel.resolver_turns}")
         print(f"Resolver position         : {sel.resolver_position}")
         
-        
\ No newline at end of file
+        
+
+
+fleet_parser = argparse.ArgumentParser(description="Read the status of, or move, many selector wheels at once.")
+
+fleet_parser.add_argument("-a", "--addresses",
+                          help="Comma separated list of controller IP addresses")
+fleet_parser.add_argument("-i", "--inventory",
+                          help="File listing the controllers, one per line as 'address' or 'name address'")
+fleet_parser.add_argument("-t", "--timeout", type=float, default=fleet.default_timeout,
+                          help="Time allowed for each controller in seconds")
+fleet_parser.add_argument("-c", "--command-timeout", type=float, default=fleet.default_command_timeout,
+                          help="Timeout for each command sent to a controller in seconds")
+fleet_parser.add_argument("-j", "--json", action="store_true",
+                          help="Output the results as JSON")
+fleet_parser.add_argument("-w", "--wait", action="store_true",
+                          help="Wait for all the selectors to complete their moves before reporting")
+fleet_parser.add_argument("-s", "--speed", type=int, choices=[0,1,2,3],
+                          help="Set the speed to move at")
+fleet_parser.add_argument("position", type=int, choices=[1,2,3,4], nargs="?",
+                          help="The wheel position to move all the selectors to.")
+
+def fleet_main(args=None):
+    args = fleet_parser.parse_args(args=args)
+
+    hosts = []
+    if args.inventory:
+        hosts.extend(fleet.read_inventory(args.inventory))
+    if args.addresses:
+        hosts.extend((a, a) for a in args.addresses.split(",") if a)
+    if not hosts:
+        fleet_parser.error("No controllers given; use --addresses or --inventory")
+
+    def action(sel):
+        if args.speed is not None:
+            sel.set_speed(args.speed)
+        if args.position:
+            sel.set_position(args.position, wait=args.wait)
+
+    results = fleet.run_fleet(hosts, action=action, timeout=args.timeout, command_timeout=args.command_timeout)
+
+    if args.json:
+        print(fleet.format_json(results))
+    else:
+        print(fleet.format_table(results))
+
+    if any(result["error"] for result in results):
+        sys.exit(1)
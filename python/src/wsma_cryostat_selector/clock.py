@@ -0,0 +1,95 @@
+"""
+Estimation of the offset between the controller's clock and the host's clock.
+
+The controller's `TIME` operand is a free running count of servo updates (1 ms
+each at the default `TM 1000`), with no relation to the host's clock.  Each time
+`TIME` is read along with other values, the host times at which the command was
+sent and the response received bracket the moment the controller sampled them.
+As in NTP, the midpoint of the round trip is taken as the host time of the
+sample, and the samples with the shortest round trips, which bracket it most
+tightly, are used to fit the offset and rate of the controller clock.
+"""
+import collections
+
+import numpy as np
+
+#: float: Nominal length of a controller TIME tick in seconds
+default_tick = 0.001
+
+#: int: Number of recent samples kept for the fit
+default_window = 64
+
+#: float: Minimum span of samples in seconds before the clock rate is fitted rather than
+#: taken to be nominal
+min_rate_span = 60.0
+
+
+class ClockSync(object):
+    """Running estimate of the mapping from controller TIME to host epoch time."""
+
+    def __init__(self, tick=default_tick, window=default_window):
+        """Create a clock estimator.
+
+        Args:
+            tick (float): Nominal length of a controller TIME tick in seconds.
+            window (int): Number of recent samples to fit.
+        """
+        self.tick = tick
+        self._samples = collections.deque(maxlen=window)
+
+        #: float: Host epoch time at controller TIME 0
+        self.offset = None
+        #: float: Fitted length of a controller TIME tick in seconds
+        self.rate = tick
+        #: float: Round trip time of the best sample in the window, in seconds. Bounds the error
+        #: of the offset.
+        self.rtt = None
+
+    def reset(self):
+        """Forget all samples, e.g. after the controller has been restarted."""
+        self._samples.clear()
+        self.offset = None
+        self.rate = self.tick
+        self.rtt = None
+
+    def add_sample(self, sent, received, controller_time):
+        """Add a sample of the controller clock.
+
+        Args:
+            sent (float): Host epoch time at which the command reading TIME was sent.
+            received (float): Host epoch time at which the response was received.
+            controller_time (float): TIME read from the controller.
+        """
+        # TIME going backwards means the controller restarted, or the counter wrapped
+        if self._samples and controller_time < self._samples[-1][1]:
+            self.reset()
+        self._samples.append(((sent + received) / 2, controller_time, received - sent))
+        self._fit()
+
+    def _fit(self):
+        """Fit the offset and rate to the samples with the shortest round trips."""
+        samples = np.array(self._samples)
+        rtt = samples[:, 2]
+        self.rtt = float(rtt.min())
+        # The best half of the samples, which bracket the controller's sample time most tightly
+        best = samples[rtt <= np.median(rtt)]
+
+        # Fit relative to the latest sample, to keep the precision of the large epoch times
+        host0, time0 = samples[-1, 0], samples[-1, 1]
+        host = best[:, 0] - host0
+        ticks = best[:, 1] - time0
+
+        rate = self.tick
+        if len(best) >= 3 and (ticks.max() - ticks.min()) * self.tick >= min_rate_span:
+            rate, _ = np.polyfit(ticks, host, 1)
+        self.rate = float(rate)
+        self.offset = float(host0 + np.mean(host - self.rate * ticks) - self.rate * time0)
+
+    def to_host(self, controller_time):
+        """Convert a controller TIME to host epoch time.
+
+        Returns:
+            float: Host epoch time, or None if there are no samples yet."""
+        if self.offset is None:
+            return None
+        return self.offset + self.rate * controller_time
@@ -0,0 +1,329 @@
+"""
+Shared connections to Galil controllers.
+
+The DMC-30010 only has six Ethernet handles (A-F).  Rather than each
+:obj:`Selector` opening its own handle, connections are shared between all the
+Selector objects in a process that talk to the same controller, and are only
+closed when the last user releases them.
+
+Between processes, handles are shared by gclib's gcaps proxy server when it is
+running; connections are opened through gcaps unless `--direct` is passed in the
+connection options.
+"""
+import threading
+import re
+import time
+
+from wsma_cryostat_selector.galil import gclib, GalilSocket
+from wsma_cryostat_selector import transcript
+
+#: str: Default options passed to GOpen
+default_options = "-s ALL"
+
+#: float: Interval between polls when waiting for motion to complete, in seconds
+motion_poll_interval = 0.05
+
+_th_handle_re = re.compile(r"IH([A-F])\s+(.*)")
+_th_address_re = re.compile(r"IP ADDRESS\s+(\d+,\d+,\d+,\d+)")
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class SharedConnection(object):
+    """A gclib connection shared between several users.
+
+    Provides the subset of the gclib.py interface used by :obj:`Selector`, serializing
+    commands from all users of the connection.  Other gclib methods are passed through
+    to the wrapped client."""
+
+    def __init__(self, address, options=default_options, client_factory=None, name=None):
+        """Create a (not yet opened) shared connection.
+
+        Args:
+            address (str): IP address or hostname of the controller.
+            options (str): Options passed to GOpen.
+            client_factory (callable): Returns a new gclib.py-like client. Defaults to gclib.py.
+            name (str): Name used to identify this connection in logs and telemetry.
+        """
+        self.address = address
+        self.options = options
+        self.name = name if name else address
+        # Key of this connection among the shared connections
+        self._key = (address, options, client_factory)
+        self._client_factory = client_factory if client_factory else gclib.py
+        self._client = None
+        self._lock = threading.RLock()
+
+        #: int: Number of users holding this connection
+        self.users = 0
+        #: str: Controller handle letter used by this connection, or None if not known
+        self.handle = None
+        #: bool: True if the connection has failed and needs to be reopened
+        self.broken = False
+        #: (:obj:`TranscriptRecorder`): Recorder for the commands sent on this connection, or None
+        self.recorder = None
+
+    def __getattr__(self, name):
+        """Pass through other gclib methods to the wrapped client."""
+        if name.startswith("__") or self.__dict__.get("_client") is None:
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+    @property
+    def is_open(self):
+        return self._client is not None and not self.broken
+
+    def open(self):
+        """Open the connection to the controller, if it is not already open."""
+        with self._lock:
+            if self.is_open:
+                return
+            if self._client is not None:
+                self.close()
+            client = self._client_factory()
+            client.GOpen(f"{self.address} {self.options}")
+            self._client = client
+            self.broken = False
+            try:
+                ret = self._client.GCommand("WH").strip()
+                self.handle = ret[-1] if ret.startswith("IH") else None
+            except gclib.GclibError:
+                self.handle = None
+
+    def close(self):
+        """Close the connection to the controller."""
+        with self._lock:
+            if self._client is not None:
+                try:
+                    self._client.GClose()
+                except gclib.GclibError:
+                    pass
+            self._client = None
+            self.handle = None
+
+    def abort(self):
+        """Break a call that is hung waiting for the controller, without waiting for the
+        connection lock.
+
+        A :obj:`GalilSocket` is closed, which makes the hung call fail.  gclib handles cannot
+        be closed while another thread is using them, so instead the controller is told to
+        close this connection's handle from a second connection, which makes the hung gclib
+        call fail.  Either way the connection is marked broken, so it is reopened by the next
+        `get_connection`.
+
+        Returns:
+            bool: True if the hung call was broken, False if it could not be, e.g. because
+                the handle letter is not known."""
+        self.broken = True
+        client = self._client
+        if client is None:
+            return True
+        if isinstance(client, GalilSocket):
+            client.GClose()
+            return True
+        if self.handle is None:
+            return False
+        try:
+            other = self._client_factory()
+            other.GOpen(f"{self.address} {self.options}")
+        except gclib.GclibError:
+            return False
+        try:
+            other.GCommand(f"IH{self.handle}=>-3")
+            return True
+        except gclib.GclibError:
+            return False
+        finally:
+            try:
+                other.GClose()
+            except gclib.GclibError:
+                pass
+
+    def GCommand(self, cmd):
+        """Send a command to the controller and return the response."""
+        with self._lock:
+            if self._client is None:
+                raise gclib.GclibError("connection is closed")
+            sent = time.time()
+            start = time.perf_counter()
+            try:
+                ret = self._client.GCommand(cmd)
+            except gclib.GclibError as e:
+                if self.recorder:
+                    self.recorder.record(sent, time.perf_counter() - start, cmd, str(e), error=True)
+                # A question mark is a rejected command, anything else is a
+                # failure of the connection itself.
+                if "question mark" not in str(e):
+                    self.broken = True
+                raise e
+            if self.recorder:
+                self.recorder.record(sent, time.perf_counter() - start, cmd, ret)
+            return ret
+
+    def GCommands(self, commands):
+        """Send several commands to the controller and return their responses in order.
+
+        The commands are pipelined if the client supports it (e.g. :obj:`GalilSocket`), so
+        that they cost a single round trip, and are otherwise sent one at a time."""
+        with self._lock:
+            if self._client is None:
+                raise gclib.GclibError("connection is closed")
+            pipeline = getattr(self._client, "GCommands", None)
+            if pipeline is None or len(commands) < 2:
+                return [self.GCommand(cmd) for cmd in commands]
+            sent = time.time()
+            start = time.perf_counter()
+            try:
+                responses = pipeline(commands)
+            except gclib.GclibError as e:
+                if self.recorder:
+                    self.recorder.record(sent, time.perf_counter() - start, ";".join(commands), str(e), error=True)
+                if "question mark" not in str(e):
+                    self.broken = True
+                raise e
+            if self.recorder:
+                # Recorded one entry per command, sharing the time of the round trip
+                duration = (time.perf_counter() - start) / len(commands)
+                for cmd, ret in zip(commands, responses):
+                    self.recorder.record(sent, duration, cmd, ret)
+            return responses
+
+    def _recorded(self, command, call, response=lambda ret: ""):
+        """Run `call` with the connection locked, recording it in the transcript as the
+        equivalent controller `command`, with the result formatted by `response`."""
+        with self._lock:
+            sent = time.time()
+            start = time.perf_counter()
+            try:
+                ret = call()
+            except gclib.GclibError as e:
+                if self.recorder:
+                    self.recorder.record(sent, time.perf_counter() - start, command, str(e), error=True)
+                raise e
+            if self.recorder:
+                self.recorder.record(sent, time.perf_counter() - start, command, response(ret))
+            return ret
+
+    def GProgramDownload(self, program, preprocessor=""):
+        """Download a program to the controller."""
+        return self._recorded(transcript.program_download_command(program),
+                              lambda: self._client.GProgramDownload(program, preprocessor))
+
+    def GArrayDownload(self, name, first, last, array_data):
+        """Download values to elements first-last of a controller array."""
+        return self._recorded(transcript.array_download_command(name, first, last, array_data),
+                              lambda: self._client.GArrayDownload(name, first, last, array_data))
+
+    def GArrayUpload(self, name, first, last):
+        """Upload elements first-last of a controller array."""
+        return self._recorded(transcript.array_upload_command(name, first, last),
+                              lambda: self._client.GArrayUpload(name, first, last),
+                              transcript.array_upload_response)
+
+    def GProgramUpload(self):
+        """Upload the program from the controller."""
+        return self._recorded("UL", lambda: self._client.GProgramUpload(), str)
+
+    def GMotionComplete(self, axes):
+        """Wait for motion to complete on `axes`.
+
+        Unlike gclib's GMotionComplete, the connection is only locked for each
+        poll, so other users can keep talking to the controller during the move."""
+        for axis in axes:
+            while float(self.GCommand(f"MG _BG{axis}")) != 0:
+                time.sleep(motion_poll_interval)
+
+    def handles(self):
+        """Return a dict of the controller's handles and their state, as reported by TH.
+
+        Returns:
+            dict: keyed by handle letter, with the TH description of each handle."""
+        ret = self.GCommand("TH")
+        handles = {}
+        for line in ret.splitlines():
+            match = _th_handle_re.match(line.strip())
+            if match:
+                handles[match.group(1)] = match.group(2).strip()
+        return handles
+
+    def handles_in_use(self):
+        """Return the number of the controller's handles that are in use."""
+        return len([h for h in self.handles().values() if "AVAILABLE" not in h.upper()])
+
+    def gcaps_running(self):
+        """Return True if this connection is confirmed to go through the gcaps proxy server.
+
+        gclib reports the gcaps version along with its own in GVersion when gcaps is running.
+        Direct connections, and clients without GVersion such as the socket transport, are
+        never confirmed."""
+        if "--direct" in self.options:
+            return False
+        with self._lock:
+            version = getattr(self._client, "GVersion", None)
+            if version is None:
+                return False
+            try:
+                return "gcaps" in version().lower()
+            except gclib.GclibError:
+                return False
+
+    def clear_stale_handles(self):
+        """Close any other handles on the controller opened from the same host as this connection.
+
+        With gcaps sharing a single handle between all the processes on a host, any other
+        handle from this host has been left behind by a crashed or failed client.  Without
+        gcaps, they may belong to live clients, so nothing is closed unless gcaps is
+        confirmed to be running.
+
+        Returns:
+            list: The handle letters that were closed."""
+        if not self.gcaps_running():
+            return []
+        handles = self.handles()
+        if self.handle not in handles:
+            return []
+        own_address = _th_address_re.search(handles[self.handle])
+        if not own_address:
+            return []
+        closed = []
+        for h, description in handles.items():
+            address = _th_address_re.search(description)
+            if h != self.handle and address and address.group(1) == own_address.group(1):
+                self.GCommand(f"IH{h}=>-3")
+                closed.append(h)
+        return closed
+
+
+def get_connection(address, options=default_options, client_factory=None, name=None):
+    """Return an open shared connection to the controller at `address`.
+
+    Connections are only shared between callers asking for the same `options` and
+    `client_factory`, so that each caller gets the transport and timeout it asked for.
+    The connection is created if there isn't one already, and reopened if it has failed.
+    Callers must call `release_connection` when they are finished with it."""
+    key = (address, options, client_factory)
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = SharedConnection(address, options=options, client_factory=client_factory, name=name)
+            _connections[key] = conn
+        conn.open()
+        conn.users += 1
+        return conn
+
+
+def release_connection(conn):
+    """Release a shared connection, closing it if this was the last user."""
+    with _connections_lock:
+        conn.users -= 1
+        if conn.users <= 0:
+            conn.close()
+            if _connections.get(conn._key) is conn:
+                del _connections[conn._key]
+
+
+def connections():
+    """Return a dict of the open shared connections, keyed by (address, options, client_factory)."""
+    with _connections_lock:
+        return dict(_connections)
@@ -0,0 +1,135 @@
+"""
+Tools for deploying the selector firmware to the controller.
+
+Firmware sources (e.g. `motion-controller/src/selector_firmware_Dec2024.dmc`)
+are compressed to fit the controller's program memory, compared against the
+program already on the controller by checksum, and only downloaded if they
+differ.  After downloading, the program is uploaded again to verify it, and
+restarted at #AUTO.
+"""
+import hashlib
+import re
+
+#: int: Maximum number of program lines on the DMC-30010
+max_lines = 1001
+
+#: int: Maximum number of characters per program line on the DMC-30010
+max_chars = 80
+
+#: str: Label the program is restarted from after a download
+restart_label = "#AUTO"
+
+# The REM and NO comment commands, as whole commands rather than the start of a variable name
+_comment_re = re.compile(r"^(REM|NO)(\s|;|$)")
+
+
+def _strip_line(line):
+    """Remove comments and whitespace outside of quoted strings from a single line."""
+    out = []
+    in_quotes = False
+    for c in line:
+        if c == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes:
+            if c == "'":
+                break
+            if c in " \t":
+                continue
+        out.append(c)
+    if _comment_re.match(line.strip()):
+        return ""
+    return "".join(out)
+
+
+def compress_program(text, lines=max_lines, chars=max_chars):
+    """Compress a firmware program to fit in the controller's program memory.
+
+    Comments, whitespace and blank lines are removed.  If the program still has too
+    many lines, consecutive commands are joined with ';' where this does not change
+    the meaning of the program (labels are always kept at the start of a line).
+
+    Args:
+        text (str): Firmware program source.
+        lines (int): Maximum number of lines.
+        chars (int): Maximum number of characters per line.
+
+    Returns:
+        str: The compressed program, with lines separated by '\\r'.
+
+    Raises:
+        ValueError: if the program cannot be made to fit.
+    """
+    program = [line for line in (_strip_line(l) for l in text.splitlines()) if line]
+
+    if len(program) > lines:
+        packed = []
+        for line in program:
+            if (packed and not line.startswith("#") and not packed[-1].startswith("#")
+                    and not packed[-1].endswith("EN")
+                    and len(packed[-1]) + 1 + len(line) <= chars):
+                packed[-1] = packed[-1] + ";" + line
+            else:
+                packed.append(line)
+        program = packed
+
+    too_long = [line for line in program if len(line) > chars]
+    if too_long:
+        raise ValueError(f"Program lines longer than {chars} characters: {too_long}")
+    if len(program) > lines:
+        raise ValueError(f"Program has {len(program)} lines, more than the maximum of {lines}")
+
+    return "\r".join(program)
+
+
+def checksum(program):
+    """Return a checksum of a program, ignoring differences in comments, whitespace and line endings."""
+    normalized = "\n".join(line for line in (_strip_line(l) for l in program.splitlines()) if line)
+    return hashlib.sha1(normalized.encode("ascii", errors="replace")).hexdigest()
+
+
+def deploy(client, text, force=False, burn=True, logger=None):
+    """Deploy a firmware program to the controller.
+
+    The download is skipped if the program on the controller already matches `text`.
+
+    Note that restarting the program at #AUTO re-runs the firmware's setup code,
+    which homes the wheel.
+
+    Args:
+        client: gclib.py-like client connected to the controller.
+        text (str): Firmware program source.
+        force (bool): Download the program even if it matches the one on the controller.
+        burn (bool): Burn the program to flash so that it persists through power cycles.
+        logger (:obj:`logging.Logger`): Logger for progress messages.
+
+    Returns:
+        bool: True if the program was downloaded, False if it was already loaded.
+
+    Raises:
+        RuntimeError: if the program read back from the controller does not match.
+    """
+    program = compress_program(text)
+    wanted = checksum(program)
+
+    loaded = checksum(client.GProgramUpload())
+    if loaded == wanted and not force:
+        if logger:
+            logger.info(f"Firmware {wanted} already loaded, skipping download")
+        return False
+
+    if logger:
+        logger.info(f"Downloading firmware {wanted} to replace {loaded}")
+    client.GCommand("HX")
+    client.GProgramDownload(program, "")
+
+    verify = checksum(client.GProgramUpload())
+    if verify != wanted:
+        raise RuntimeError(f"Firmware verification failed: expected {wanted}, controller has {verify}")
+
+    if burn:
+        client.GCommand("BP")
+    client.GCommand(f"XQ{restart_label}")
+    if logger:
+        logger.info(f"Firmware {wanted} verified and restarted at {restart_label}")
+
+    return True
@@ -0,0 +1,135 @@
+"""
+Query or command many selector wheel controllers concurrently.
+
+Each controller is handled in its own thread, with its own connection, so
+checking or moving the selectors across the array takes about as long as the
+slowest single controller, rather than the sum of all of them.  The threads are
+daemon threads, so a controller that hangs past the deadline does not keep the
+process from exiting.
+"""
+import json
+import threading
+import time
+
+import wsma_cryostat_selector
+
+#: list: Selector attributes reported for each controller
+status_fields = ["position", "command_position", "speed", "status", "angle", "angle_error", "angle_offset", "time"]
+
+#: float: Default time allowed for each controller, in seconds
+default_timeout = 60.0
+
+#: float: Default timeout for each command sent to a controller, in seconds
+default_command_timeout = 5.0
+
+
+def read_inventory(path):
+    """Read a list of controllers from an inventory file.
+
+    Each line holds a controller address, optionally preceded by a name. Blank lines
+    and anything after a '#' are ignored.
+
+    Returns:
+        list: (name, address) tuples.
+    """
+    hosts = []
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split("#")[0].split()
+            if len(fields) == 1:
+                hosts.append((fields[0], fields[0]))
+            elif len(fields) >= 2:
+                hosts.append((fields[0], fields[1]))
+    return hosts
+
+
+def _run_one(address, action, command_timeout, selector_class):
+    """Connect to one controller, run `action` on it and return its status."""
+    start = time.monotonic()
+    result = {"address": address}
+    sel = None
+    try:
+        sel = selector_class(ip_address=address, timeout=command_timeout, name="selector-fleet")
+        if not sel.is_connected():
+            raise ConnectionError(f"Could not connect to {address}")
+        if action:
+            action(sel)
+        sel.update()
+        for field in status_fields:
+            result[field] = getattr(sel, field)
+        result["error"] = None
+    except Exception as e:
+        result["error"] = repr(e)
+    finally:
+        if sel is not None:
+            sel.disconnect()
+    result["elapsed"] = time.monotonic() - start
+    return result
+
+
+def run_fleet(hosts, action=None, timeout=default_timeout, selector_class=None,
+              command_timeout=default_command_timeout):
+    """Run `action` on every controller in `hosts` concurrently, and collect their status.
+
+    Args:
+        hosts (list): (name, address) tuples.
+        action (callable): Called with the :obj:`Selector` for each controller, or None to
+            just read the status.
+        timeout (float): Time allowed for each controller in seconds. Controllers that have
+            not finished in this time are reported with a timeout error.
+        selector_class (type): Class used to talk to each controller. Defaults to :obj:`Selector`.
+        command_timeout (float): Timeout for each command sent to a controller in seconds,
+            limited to `timeout`.
+
+    Returns:
+        list: A dict of status values for each controller, in the same order as `hosts`.
+    """
+    if selector_class is None:
+        selector_class = wsma_cryostat_selector.Selector
+
+    command_timeout = min(command_timeout, timeout)
+    done = {}
+
+    def run(index, address):
+        done[index] = _run_one(address, action, command_timeout, selector_class)
+
+    # Daemon threads, so that hung controllers are abandoned rather than joined at exit
+    threads = [threading.Thread(target=run, args=(i, address), daemon=True, name=f"fleet-{address}")
+               for i, (_, address) in enumerate(hosts)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+    results = []
+    for i, (name, address) in enumerate(hosts):
+        result = done.get(i)
+        if result is None:
+            result = {"address": address, "error": f"timed out after {timeout} s", "elapsed": timeout}
+        result["name"] = name
+        results.append(result)
+    return results
+
+
+def format_table(results):
+    """Format fleet results as a text table."""
+    columns = ["name", "address"] + status_fields + ["elapsed", "error"]
+    rows = []
+    for result in results:
+        row = []
+        for column in columns:
+            value = result.get(column, "")
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            row.append("" if value is None else str(value))
+        rows.append(row)
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(w) for column, w in zip(columns, widths))]
+    lines.extend("  ".join(value.ljust(w) for value, w in zip(row, widths)) for row in rows)
+    return "\n".join(lines)
+
+
+def format_json(results):
+    """Format fleet results as JSON."""
+    return json.dumps(results, indent=2)
@@ -0,0 +1,444 @@
+"""
+Native Python transport for Galil controllers, without the gclib C library.
+
+:obj:`GalilSocket` is a gclib.py-like client that speaks the DMC Ethernet ASCII
+command protocol directly over a TCP socket, so the package can talk to the
+controller on machines where gclib is not installed, e.g.::
+
+    sel = Selector("192.168.42.100", transport="socket")
+
+Each command is sent terminated by a carriage return, and the controller answers
+with any output followed by a colon if it accepted the command, or a question
+mark if it rejected it.  Responses come back in the order the commands were sent,
+so several commands can be in flight at once: `GCommands` sends a list of
+commands in one write and matches up the responses, rather than waiting a round
+trip for each.  :obj:`AsyncGalil` does the same for asyncio code, with any number
+of commands in flight from different tasks.
+
+Output from `MG` statements in programs running on the controller is unsolicited.
+On the command handle it is marked by the high bit of each character, and kept
+apart from the responses.  :obj:`GalilMessages` opens a secondary handle and
+directs the unsolicited output to it with `CF I`, so it can be followed without
+interfering with commands.
+
+The rest of the package imports `gclib` from this module, which stands in for
+gclib with `GclibError` and `GalilSocket` when gclib is not installed.
+"""
+import asyncio
+import collections
+import queue
+import select
+import socket
+import threading
+import time
+import types
+
+try:
+    import gclib
+except ImportError: # gclib is not installed, e.g. on analysis nodes
+    gclib = None
+
+#: bool: True if gclib is installed
+gclib_available = gclib is not None
+
+#: str: Transport used by :obj:`Selector` unless told otherwise
+default_transport = "gclib" if gclib_available else "socket"
+
+#: list: Names of the available transports
+transports = ["gclib", "socket"]
+
+#: int: TCP port of the controller's command interpreter
+default_port = 23
+
+#: float: Default time to wait for a response, in seconds, as for gclib
+default_timeout = 5.0
+
+#: float: Interval between polls when waiting for motion to complete, in seconds
+motion_poll_interval = 0.05
+
+#: int: Number of unsolicited messages kept on the command handle until they are read
+max_messages = 1000
+
+#: str: Error raised when the controller rejects a command, as raised by gclib
+_question_mark = "question mark returned by controller"
+
+_end_of_upload = 0x1a
+_line_ends = (ord("\n"), _end_of_upload)
+
+
+if gclib_available:
+    GclibError = gclib.GclibError
+else:
+    class GclibError(Exception):
+        """Raised for communication errors and rejected commands, in place of gclib's GclibError."""
+
+
+def parse_address(address):
+    """Split a GOpen address string into (host, port, timeout).
+
+    Understands a `host[:port]` first word and the `-t` timeout option (in ms).  Other
+    gclib options, such as `-s` and `--direct`, have no meaning for a direct socket
+    connection and are ignored."""
+    words = address.split()
+    if not words:
+        raise GclibError("no address given")
+    host, _, port = words[0].partition(":")
+    timeout = default_timeout
+    if "-t" in words[1:-1]:
+        timeout = int(words[words.index("-t") + 1]) / 1000.0
+    return host, int(port) if port else default_port, timeout
+
+
+class ResponseParser(object):
+    """Splits the stream of bytes from a controller handle into command responses and
+    unsolicited messages."""
+
+    def __init__(self):
+        self._response = bytearray()
+        self._message = bytearray()
+        #: collections.deque: (accepted, text) of each complete response, in order
+        self.responses = collections.deque()
+        #: collections.deque: Complete lines of unsolicited output, in order
+        self.messages = collections.deque(maxlen=max_messages)
+
+    def feed(self, data, unsolicited=False):
+        """Parse bytes received from the controller.
+
+        Args:
+            data (bytes): Bytes received.
+            unsolicited (bool): Treat all the output as unsolicited, as on a messages handle.
+        """
+        response = self._response
+        for byte in data:
+            if byte & 0x80 or unsolicited:
+                self._add_message_byte(byte & 0x7f)
+            elif byte in b":?" and (not response or response[-1] in _line_ends):
+                text = response.decode("ascii", errors="replace").strip().rstrip("\x1a")
+                self.responses.append((byte == ord(":"), text))
+                response.clear()
+            else:
+                response.append(byte)
+
+    def _add_message_byte(self, byte):
+        if byte == ord("\n"):
+            self.messages.append(self._message.decode("ascii", errors="replace").strip())
+            self._message.clear()
+        elif byte != ord("\r"):
+            self._message.append(byte)
+
+
+def _array_assignments(name, first, last, array_data):
+    """Return the commands assigning `array_data` to elements first-last of array `name`."""
+    return [f"{name}[{i}]={value}" for i, value in zip(range(first, last + 1), array_data)]
+
+
+def _array_values(text):
+    """Parse the values returned by QU."""
+    return [float(v) for v in text.replace(",", " ").split()]
+
+
+class GalilSocket(object):
+    """A gclib.py-like client talking to the controller over a TCP socket."""
+
+    def __init__(self):
+        self._sock = None
+        self._parser = None
+        self._lock = threading.Lock()
+        self.timeout = default_timeout
+        self.address = None
+
+    def GOpen(self, address):
+        """Connect to the controller. `address` is as for gclib, see `parse_address`."""
+        host, port, self.timeout = parse_address(address)
+        try:
+            sock = socket.create_connection((host, port), timeout=self.timeout)
+        except OSError as e:
+            raise GclibError("device failed to open") from e
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self._sock = sock
+        self._parser = ResponseParser()
+        self.address = (host, port)
+
+    def GClose(self):
+        """Close the connection. Breaks any command waiting for a response."""
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _send(self, data, deadline):
+        """Write all of `data` to the non-blocking socket before `deadline`."""
+        view = memoryview(data)
+        while view:
+            sock = self._sock
+            if sock is None:
+                raise GclibError("device not open")
+            try:
+                sent = sock.send(view)
+                view = view[sent:]
+            except BlockingIOError:
+                self._wait([], [sock], deadline)
+            except OSError as e:
+                raise GclibError(f"write failed: {e}") from e
+
+    def _receive(self, count, deadline):
+        """Read from the socket until `count` responses have been parsed."""
+        parser = self._parser
+        while len(parser.responses) < count:
+            sock = self._sock
+            if sock is None:
+                raise GclibError("device not open")
+            try:
+                data = sock.recv(4096)
+            except BlockingIOError:
+                self._wait([sock], [], deadline)
+                continue
+            except OSError as e:
+                raise GclibError(f"read failed: {e}") from e
+            if not data:
+                raise GclibError("connection closed by controller")
+            parser.feed(data)
+
+    def _wait(self, read, write, deadline):
+        """Wait until the socket is ready, or raise GclibError at `deadline`."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise GclibError("timeout")
+        try:
+            select.select(read, write, [], remaining)
+        except (OSError, ValueError) as e: # The socket was closed while waiting
+            raise GclibError("device not open") from e
+
+    def GCommands(self, commands):
+        """Send several commands at once, and return their responses in order.
+
+        All the commands are sent before any response is read, so the round trips
+        overlap.  Each command must be a single statement.
+
+        Raises:
+            GclibError: if any command was rejected, after all the responses have been read."""
+        if not commands:
+            return []
+        with self._lock:
+            deadline = time.monotonic() + self.timeout * len(commands)
+            self._send("".join(c + "\r" for c in commands).encode("ascii"), deadline)
+            try:
+                self._receive(len(commands), deadline)
+            except GclibError:
+                # The responses can no longer be matched to commands
+                self.GClose()
+                raise
+            responses = [self._parser.responses.popleft() for _ in commands]
+        for accepted, _ in responses:
+            if not accepted:
+                raise GclibError(_question_mark)
+        return [text for _, text in responses]
+
+    def GCommand(self, command):
+        """Send a command and return the response."""
+        return self.GCommands([command])[0]
+
+    def GMotionComplete(self, axes):
+        for axis in axes:
+            while float(self.GCommand(f"MG _BG{axis}")) != 0:
+                time.sleep(motion_poll_interval)
+
+    def GProgramUpload(self):
+        return self.GCommand("UL").replace("\r\n", "\n")
+
+    def GProgramDownload(self, program, preprocessor=""):
+        """Download a program. The gclib preprocessor is not supported, so the program must
+        already fit the controller's line and label limits."""
+        lines = program.replace("\r\n", "\n").split("\n")
+        with self._lock:
+            deadline = time.monotonic() + self.timeout
+            self._send(("DL\r" + "\r".join(lines) + "\r\\").encode("ascii"), deadline)
+            self._receive(1, deadline)
+            accepted, _ = self._parser.responses.popleft()
+        if not accepted:
+            raise GclibError(_question_mark)
+
+    def GArrayDownload(self, name, first, last, array_data):
+        self.GCommands(_array_assignments(name, first, last, array_data))
+
+    def GArrayUpload(self, name, first, last):
+        return _array_values(self.GCommand(f"QU {name}[],{first},{last},1"))
+
+    def messages(self):
+        """Return and clear the unsolicited messages received on the command handle."""
+        messages = list(self._parser.messages) if self._parser else []
+        if self._parser:
+            self._parser.messages.clear()
+        return messages
+
+
+class GalilMessages(object):
+    """Secondary handle receiving the controller's unsolicited messages.
+
+    Each complete line of output is put on `queue`, and passed to `callback` if one
+    is given, from a reader thread."""
+
+    def __init__(self, address, callback=None):
+        """Open a handle to the controller at `address`, and direct unsolicited output to it.
+
+        Args:
+            address (str): Address of the controller, as for `GalilSocket.GOpen`.
+            callback (callable): Called with each message as it arrives.
+        """
+        self.callback = callback
+        #: queue.Queue: Messages received from the controller
+        self.queue = queue.Queue()
+        self._client = GalilSocket()
+        self._client.GOpen(address)
+        self._client.GCommand("CF I")
+        self._thread = threading.Thread(target=self._read, daemon=True, name="Galil messages")
+        self._thread.start()
+
+    def _read(self):
+        client = self._client
+        parser = client._parser
+        while client._sock is not None:
+            try:
+                readable, _, _ = select.select([client._sock], [], [], 1.0)
+                if not readable:
+                    continue
+                data = client._sock.recv(4096)
+            except (OSError, ValueError, TypeError):
+                break
+            if not data:
+                break
+            parser.feed(data, unsolicited=True)
+            while parser.messages:
+                message = parser.messages.popleft()
+                self.queue.put(message)
+                if self.callback:
+                    self.callback(message)
+
+    def get(self, timeout=None):
+        """Return the next message, waiting up to `timeout` seconds.
+
+        Raises:
+            queue.Empty: if no message arrives in time."""
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self._client.GClose()
+
+
+class AsyncGalil(object):
+    """asyncio client talking to the controller over a TCP socket.
+
+    Any number of commands may be in flight at once, from any number of tasks; each
+    is answered with the response that arrives in its place in the stream."""
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._pending = collections.deque()
+        self._parser = ResponseParser()
+        self.timeout = default_timeout
+        #: asyncio.Queue: Unsolicited messages received on the command handle
+        self.messages = asyncio.Queue()
+
+    async def open(self, address):
+        """Connect to the controller. `address` is as for `GalilSocket.GOpen`."""
+        host, port, self.timeout = parse_address(address)
+        try:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise GclibError("device failed to open") from e
+        self._task = asyncio.ensure_future(self._read())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _read(self):
+        """Match the responses arriving from the controller to the commands in flight."""
+        error = GclibError("connection closed by controller")
+        try:
+            while True:
+                data = await self._reader.read(4096)
+                if not data:
+                    break
+                self._parser.feed(data)
+                while self._parser.responses and self._pending:
+                    future = self._pending.popleft()
+                    accepted, text = self._parser.responses.popleft()
+                    if not future.done():
+                        if accepted:
+                            future.set_result(text)
+                        else:
+                            future.set_exception(GclibError(_question_mark))
+                while self._parser.messages:
+                    self.messages.put_nowait(self._parser.messages.popleft())
+        except OSError as e:
+            error = GclibError(f"read failed: {e}")
+        finally:
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+    def _submit(self, command):
+        """Send a command, and return the future for its response."""
+        if self._writer is None:
+            raise GclibError("device not open")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write((command + "\r").encode("ascii"))
+        return future
+
+    async def command(self, command):
+        """Send a command and return the response."""
+        future = self._submit(command)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # The responses can no longer be matched to commands
+            await self.close()
+            raise GclibError("timeout")
+
+    async def commands(self, commands):
+        """Send several commands at once, and return their responses in order.
+
+        Raises:
+            GclibError: if any command was rejected, after all the responses have arrived."""
+        futures = [self._submit(c) for c in commands]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*[asyncio.shield(f) for f in futures],
+                                                            return_exceptions=True),
+                                             self.timeout * max(len(commands), 1))
+        except asyncio.TimeoutError:
+            await self.close()
+            raise GclibError("timeout")
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def motion_complete(self, axes):
+        for axis in axes:
+            while float(await self.command(f"MG _BG{axis}")) != 0:
+                await asyncio.sleep(motion_poll_interval)
+
+    async def array_download(self, name, first, last, array_data):
+        await self.commands(_array_assignments(name, first, last, array_data))
+
+    async def array_upload(self, name, first, last):
+        return _array_values(await self.command(f"QU {name}[],{first},{last},1"))
+
+
+if not gclib_available:
+    gclib = types.ModuleType("gclib", "Stand-in for gclib using the native socket transport")
+    gclib.GclibError = GclibError
+    gclib.py = GalilSocket
@@ -0,0 +1,359 @@
+"""
+Local append-only history store for selector wheel moves and homes.
+
+Each event is stored as one row across a set of columns.  Columns are kept as
+raw little-endian binary files, one file per column, grouped into segments::
+
+    <path>/seg_000000/time.bin
+    <path>/seg_000000/to_position.bin
+    ...
+
+New rows are appended to the newest (active) segment, whose column files are
+kept open.  When the active segment reaches `segment_size` rows it is sealed and
+a new segment is started.  Sealed segments are periodically merged into a single
+larger segment by `compact()`, in a background thread so that appends are not
+held up, and the number of files stays small over years of operation.  A compaction
+journal records a merge once its output is complete, so that a compaction
+interrupted at any point is either discarded or finished when the store is next
+opened, without losing or duplicating rows.
+
+Reads memory map the column files with NumPy, so queries over the full history
+do not need to load it all into memory.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+#: list of (str, str): The columns stored for each event, and their NumPy dtypes.
+history_fields = [
+    ("time", "<f8"),             # Unix timestamp of the end of the event
+    ("event", "<u1"),            # One of EVENT_MOVE or EVENT_HOME
+    ("from_position", "<i1"),    # Position before the event
+    ("to_position", "<i1"),      # Position after the event
+    ("speed", "<i1"),            # Speed setting used for the event
+    ("duration", "<f4"),         # Time taken by the event in ms, as reported by the controller
+    ("angle", "<f4"),            # Final angle in degrees
+    ("angle_error", "<f4"),      # Final angle error in degrees
+    ("angle_offset", "<f4"),     # Angle offset in degrees
+    ("retries", "<i2"),          # Number of moves the controller needed to reach the position
+    ("first_error", "<f4"),      # Angle error in degrees where a move first landed, before corrections
+    ("aim_correction", "<f4"),   # Aim correction (POSC) for the target position in resolver counts
+]
+
+#: dict: Value of each column in rows written before the column was added to the store.
+#: Columns not listed here were present from the start.
+column_defaults = {
+    "first_error": np.nan,
+    "aim_correction": np.nan,
+}
+
+#: numpy.dtype: Structured dtype matching a single history row.
+history_dtype = np.dtype(history_fields)
+
+EVENT_MOVE = 0
+EVENT_HOME = 1
+
+_segment_prefix = "seg_"
+
+#: str: Name of the journal recording a compaction whose merged segment has been written
+_journal_name = "compaction.json"
+
+
+class MoveHistory(object):
+    """Append-only columnar store of selector wheel move and home events."""
+
+    def __init__(self, path, segment_size=8192, compact_after=16):
+        """Open (or create) the history store at `path`.
+
+        Args:
+            path (str): Directory holding the history segments.
+            segment_size (int): Number of rows after which the active segment is sealed.
+            compact_after (int): Number of sealed segments that triggers an automatic compaction.
+        """
+        self.path = os.path.expanduser(path)
+        self.segment_size = segment_size
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        # Held by the compaction in progress, which only takes _lock to swap in its result
+        self._compact_lock = threading.Lock()
+        self._compact_thread = None
+
+        os.makedirs(self.path, exist_ok=True)
+        self._recover_compaction()
+
+        segments = self._segments()
+        if segments:
+            self._active = segments[-1]
+            self._active_rows = self._truncate_segment(self._active)
+        else:
+            self._active = self._new_segment(0)
+            self._active_rows = 0
+        self._files = self._open_columns(self._active)
+
+    def __len__(self):
+        return sum(self._segment_rows(seg) for seg in self._segments())
+
+    def _segments(self):
+        """Return the sorted list of segment directories."""
+        return sorted(os.path.join(self.path, d) for d in os.listdir(self.path)
+                      if d.startswith(_segment_prefix) and not d.endswith(".tmp"))
+
+    def _recover_compaction(self):
+        """Finish or discard a compaction that was interrupted.
+
+        If the journal exists, the merged segment was completely written, so the swap
+        into place and the removal of the merged segments are completed.  Otherwise the
+        partial merged segment is removed, and any sealed segment moved aside is restored."""
+        journal = os.path.join(self.path, _journal_name)
+        if os.path.exists(journal):
+            with open(journal) as fp:
+                entry = json.load(fp)
+            self._finish_compaction(entry["target"], entry["sources"])
+            return
+        if os.path.exists(journal + ".part"):
+            os.remove(journal + ".part")
+
+        for d in os.listdir(self.path):
+            if d.endswith(".old.tmp"):
+                original = os.path.join(self.path, d[:-len(".old.tmp")])
+                if not os.path.exists(original):
+                    os.rename(os.path.join(self.path, d), original)
+        for d in os.listdir(self.path):
+            if d.endswith(".tmp"):
+                shutil.rmtree(os.path.join(self.path, d), ignore_errors=True)
+
+    def _finish_compaction(self, target, sources):
+        """Swap the merged segment in place of `target`, and remove the other merged `sources`.
+
+        Every step can be repeated, so this also completes a compaction interrupted part way
+        through.  `target` and `sources` are segment names relative to the store path."""
+        target = os.path.join(self.path, target)
+        tmp = target + ".tmp"
+        old = target + ".old.tmp"
+        if os.path.exists(tmp):
+            if os.path.exists(target):
+                os.rename(target, old)
+            os.rename(tmp, target)
+        shutil.rmtree(old, ignore_errors=True)
+        for seg in sources:
+            shutil.rmtree(os.path.join(self.path, seg), ignore_errors=True)
+        os.remove(os.path.join(self.path, _journal_name))
+
+    def _open_columns(self, seg):
+        """Open the column files of the active segment `seg` for appending.
+
+        The files are unbuffered, so every row reaches the operating system as it is appended."""
+        return {name: open(os.path.join(seg, f"{name}.bin"), "ab", buffering=0) for name, _ in history_fields}
+
+    def close(self):
+        """Close the column files of the active segment.  No more rows can be appended."""
+        with self._lock:
+            for fp in self._files.values():
+                fp.close()
+            self._files = {}
+
+    def _new_segment(self, index):
+        seg = os.path.join(self.path, f"{_segment_prefix}{index:06d}")
+        os.makedirs(seg, exist_ok=True)
+        return seg
+
+    def _segment_rows(self, seg):
+        """Number of complete rows in a segment.
+
+        If a write was interrupted part way through a row, the columns may have
+        different lengths; only the rows present in every column are counted.  Columns
+        added since the segment was written are missing, and do not limit the count."""
+        rows = []
+        for name, dtype in history_fields:
+            fname = os.path.join(seg, f"{name}.bin")
+            if os.path.exists(fname):
+                rows.append(os.path.getsize(fname) // np.dtype(dtype).itemsize)
+            elif name not in column_defaults:
+                rows.append(0)
+        return min(rows) if rows else 0
+
+    def _truncate_segment(self, seg):
+        """Cut the columns of a segment back to the rows present in every column.
+
+        A write interrupted part way through a row leaves some columns a row longer than
+        others, which would misalign every row appended after it.  Columns added since the
+        segment was written are filled with their default value for the existing rows.
+
+        Returns:
+            int: number of rows in the segment."""
+        n = self._segment_rows(seg)
+        for name, dtype in history_fields:
+            fname = os.path.join(seg, f"{name}.bin")
+            size = n * np.dtype(dtype).itemsize
+            if not os.path.exists(fname):
+                np.full(n, column_defaults.get(name, 0), dtype=dtype).tofile(fname)
+            elif os.path.getsize(fname) > size:
+                os.truncate(fname, size)
+        return n
+
+    def _read_segment(self, seg):
+        """Return a dict of column arrays for a single segment."""
+        n = self._segment_rows(seg)
+        columns = {}
+        for name, dtype in history_fields:
+            fname = os.path.join(seg, f"{name}.bin")
+            if n == 0:
+                columns[name] = np.empty(0, dtype=dtype)
+            elif not os.path.exists(fname):
+                columns[name] = np.full(n, column_defaults.get(name, 0), dtype=dtype)
+            else:
+                columns[name] = np.memmap(fname, dtype=dtype, mode="r", shape=(n,))
+        return columns
+
+    def append(self, event=EVENT_MOVE, from_position=0, to_position=0, speed=0, duration=0.0,
+               angle=0.0, angle_error=0.0, angle_offset=0.0, retries=0, first_error=np.nan,
+               aim_correction=np.nan, timestamp=None):
+        """Append a single event to the store.
+
+        Args:
+            event (int): EVENT_MOVE or EVENT_HOME.
+            from_position (int): Position before the event.
+            to_position (int): Position after the event.
+            speed (int): Speed setting used.
+            duration (float): Event duration in ms.
+            angle (float): Final angle in degrees.
+            angle_error (float): Final angle error in degrees.
+            angle_offset (float): Angle offset in degrees.
+            retries (int): Number of moves needed to reach the position.
+            first_error (float): Angle error in degrees where a move first landed, before any
+                corrective moves. NaN for homes, or if not known.
+            aim_correction (float): Aim correction in resolver counts that the controller applied
+                to the move's target position. NaN for homes, or if not known.
+            timestamp (float): Unix time of the event. Defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        row = np.array([(timestamp, event, from_position, to_position, speed, duration,
+                         angle, angle_error, angle_offset, retries, first_error, aim_correction)],
+                       dtype=history_dtype)
+
+        with self._lock:
+            if not self._files:
+                raise ValueError("History store is closed")
+            if self._active_rows >= self.segment_size:
+                self._seal()
+            for name, _ in history_fields:
+                self._files[name].write(row[name].tobytes())
+            self._active_rows += 1
+
+    def _seal(self):
+        """Start a new active segment, and start a compaction in the background if enough
+        segments have been sealed."""
+        for fp in self._files.values():
+            fp.close()
+        index = int(os.path.basename(self._active)[len(_segment_prefix):]) + 1
+        self._active = self._new_segment(index)
+        self._files = self._open_columns(self._active)
+        self._active_rows = 0
+        if len(self._segments()) - 1 >= self.compact_after and \
+                not (self._compact_thread and self._compact_thread.is_alive()):
+            self._compact_thread = threading.Thread(target=self.compact, daemon=True, name="HistoryCompaction")
+            self._compact_thread.start()
+
+    def compact(self):
+        """Merge all sealed segments into a single segment, ordered by time.
+
+        Sealed segments are never written to, so they are merged while appends and queries
+        carry on, which are only held up while the merged segment is swapped in."""
+        with self._compact_lock:
+            with self._lock:
+                sealed = [seg for seg in self._segments() if seg != self._active]
+            if len(sealed) < 2:
+                return
+            self._compact(sealed)
+
+    def _compact(self, sealed):
+        parts = [self._read_segment(seg) for seg in sealed]
+        order = np.argsort(np.concatenate([p["time"] for p in parts]), kind="stable")
+
+        # Write the merged segment under a temporary name, then record the merge in the
+        # journal before swapping it in place of the first sealed segment.  Until the
+        # journal exists an interrupted compaction is discarded, and after it exists
+        # the compaction is finished, so rows are never lost or duplicated.
+        target = sealed[0]
+        tmp = target + ".tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for name, _ in history_fields:
+            column = np.concatenate([p[name] for p in parts])[order]
+            with open(os.path.join(tmp, f"{name}.bin"), "wb") as fp:
+                column.tofile(fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+        del parts
+
+        with self._lock:
+            journal = os.path.join(self.path, _journal_name)
+            with open(journal + ".part", "w") as fp:
+                json.dump({"target": os.path.basename(target),
+                           "sources": [os.path.basename(seg) for seg in sealed[1:]]}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(journal + ".part", journal)
+
+            self._finish_compaction(os.path.basename(target), [os.path.basename(seg) for seg in sealed[1:]])
+
+    def query(self, start=None, stop=None, event=None, position=None):
+        """Return the events in a time range as a NumPy structured array.
+
+        Each segment is filtered through its memory map, so only the matching rows are
+        loaded into memory.
+
+        Args:
+            start (float): Earliest Unix time to return. Defaults to the start of the history.
+            stop (float): Latest Unix time to return. Defaults to the end of the history.
+            event (int): If given, only return events of this type.
+            position (int): If given, only return events that ended at this position.
+        """
+        with self._lock:
+            parts = [self._read_segment(seg) for seg in self._segments()]
+
+        selected = []
+        for part in parts:
+            mask = np.ones(len(part["time"]), dtype=bool)
+            if start is not None:
+                mask &= part["time"] >= start
+            if stop is not None:
+                mask &= part["time"] <= stop
+            if event is not None:
+                mask &= part["event"] == event
+            if position is not None:
+                mask &= part["to_position"] == position
+            rows = np.empty(np.count_nonzero(mask), dtype=history_dtype)
+            for name, _ in history_fields:
+                rows[name] = part[name][mask]
+            selected.append(rows)
+        del parts
+
+        result = np.concatenate(selected) if selected else np.empty(0, dtype=history_dtype)
+        return result[np.argsort(result["time"], kind="stable")]
+
+    def position_statistics(self, start=None, stop=None):
+        """Return per-position statistics for the moves in a time range.
+
+        Returns:
+            dict: keyed by position, each a dict of count, mean and standard deviation
+                of move duration, mean and maximum absolute angle error, and mean retries.
+        """
+        moves = self.query(start=start, stop=stop, event=EVENT_MOVE)
+        stats = {}
+        for pos in np.unique(moves["to_position"]):
+            m = moves[moves["to_position"] == pos]
+            abs_err = np.abs(m["angle_error"])
+            stats[int(pos)] = {
+                "count": len(m),
+                "duration_mean": float(np.mean(m["duration"])),
+                "duration_std": float(np.std(m["duration"])),
+                "angle_error_mean": float(np.mean(m["angle_error"])),
+                "angle_error_max": float(np.max(abs_err)),
+                "retries_mean": float(np.mean(m["retries"])),
+            }
+        return stats
@@ -0,0 +1,174 @@
+"""
+Estimates of the time taken for selector wheel moves.
+
+Estimates are computed from the trapezoidal velocity profiles set in the
+controller firmware (`slowsp`, `slowAC`, `slowDC` etc.), and can be refined with
+the durations of moves recorded in a :obj:`MoveHistory`.  All estimates are
+precomputed into a lookup table indexed by speed, start position and end position.
+
+Speed 0 is the controller's adaptive (auto) mode, which makes the bulk of a move
+with the fast profile and the final `approach` counts with the slow profile.  While
+the controller's running average of moves per request (`autoavg`) is above
+`autolim`, it makes the bulk of the move with the medium profile instead, so the
+auto estimates follow the profile set with `set_auto_profile`.
+"""
+import numpy as np
+
+from wsma_cryostat_selector.planner import plan_move
+
+#: int: Number of selector positions
+n_positions = 4
+
+#: int: Number of speed settings, including speed 0 (auto)
+n_speeds = 4
+
+#: int: Speed setting for the adaptive profile
+SPEED_AUTO = 0
+
+#: int: Resolver counts before the target at which auto moves switch to the slow profile (apprch in the firmware)
+approach = 128
+
+#: int: Resolver counts between adjacent selector positions
+position_spacing = 4096
+
+#: float: Motor steps per resolver count (drstep in the firmware)
+motor_steps_per_count = 256 * 1000 / 16384
+
+#: dict: Default (speed, acceleration, deceleration) in motor steps/s for each speed setting,
+#: as set in the firmware.
+default_profiles = {
+    1: (10000, 10000, 10000),
+    2: (30000, 50000, 50000),
+    3: (75000, 150000, 150000),
+}
+
+
+def profile_time(distance, speed, acceleration, deceleration):
+    """Return the time in seconds for a trapezoidal move.
+
+    Args:
+        distance (float): Length of the move in motor steps.
+        speed (float): Slew speed in motor steps/s.
+        acceleration (float): Acceleration in motor steps/s^2.
+        deceleration (float): Deceleration in motor steps/s^2.
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    ramp_distance = speed**2 / (2 * acceleration) + speed**2 / (2 * deceleration)
+    if distance >= ramp_distance:
+        return distance / speed + speed / (2 * acceleration) + speed / (2 * deceleration)
+    # Triangular profile - the move never reaches the slew speed
+    peak = np.sqrt(2 * distance * acceleration * deceleration / (acceleration + deceleration))
+    return peak / acceleration + peak / deceleration
+
+
+def move_distance(from_position, to_position, wrap=True):
+    """Return the length of a move between two positions in resolver counts.
+    
+    If `wrap` is True, the move takes the shortest rotation, as planned by `plan_move`."""
+    return plan_move(from_position, to_position, wrap=wrap) * position_spacing
+
+
+class MoveTimeEstimator(object):
+    """Lookup table of estimated move times between selector positions."""
+
+    def __init__(self, profiles=None, overhead=0.0, wrap=True, auto_profile=3):
+        """Create the estimator from the firmware speed profiles.
+
+        Args:
+            profiles (dict): (speed, acceleration, deceleration) in motor steps/s for
+                each speed setting. Defaults to the firmware defaults.
+            overhead (float): Fixed time in ms added to each move for settling and
+                the controller's position checks.
+            wrap (bool): If True, moves take the shortest rotation, wrapping through position 4 <-> 1.
+            auto_profile (int): Speed setting, 2 or 3, whose profile auto moves use for the bulk
+                of the move.
+        """
+        self.profiles = dict(default_profiles)
+        if profiles:
+            self.profiles.update(profiles)
+        self.overhead = overhead
+        self.wrap = wrap
+        self.auto_profile = auto_profile
+
+        #: numpy.ndarray: Estimated move time in ms, indexed by [speed, from-1, to-1]
+        self.table = np.zeros((n_speeds, n_positions, n_positions))
+        self._compute()
+
+    def _compute(self, speeds=range(n_speeds)):
+        """Precompute the lookup table for `speeds` from the speed profiles."""
+        for s in speeds:
+            for i in range(n_positions):
+                for j in range(n_positions):
+                    if i == j:
+                        self.table[s, i, j] = 0.0
+                        continue
+                    counts = abs(move_distance(i + 1, j + 1, wrap=self.wrap))
+                    self.table[s, i, j] = self.counts_time(counts, s) * 1000 + self.overhead
+
+    def counts_time(self, counts, speed):
+        """Time in seconds to move `counts` resolver counts at speed setting `speed`."""
+        if speed == SPEED_AUTO:
+            if counts <= approach:
+                return profile_time(counts * motor_steps_per_count, *self.profiles[1])
+            return (profile_time((counts - approach) * motor_steps_per_count, *self.profiles[self.auto_profile])
+                    + profile_time(approach * motor_steps_per_count, *self.profiles[1]))
+        return profile_time(counts * motor_steps_per_count, *self.profiles[speed])
+
+    def set_auto_profile(self, auto_profile):
+        """Set the speed setting, 2 or 3, whose profile auto moves use for the bulk of the move."""
+        if auto_profile not in (2, 3):
+            raise ValueError("Auto moves use the profile of speed 2 or 3")
+        if auto_profile != self.auto_profile:
+            self.auto_profile = auto_profile
+            self._compute([SPEED_AUTO])
+
+    def fit(self, history, min_samples=5):
+        """Refine the lookup table from recorded moves.
+
+        The fixed overhead is fitted as the median difference between the recorded
+        and modelled durations.  Where a (speed, from, to) combination has at least
+        `min_samples` recorded moves, the median recorded duration is used directly,
+        except at auto speed, where recorded moves used either the medium or fast profile.
+
+        Args:
+            history (:obj:`MoveHistory`): Store of recorded moves.
+            min_samples (int): Minimum number of moves needed to use recorded durations.
+        """
+        from wsma_cryostat_selector.history import EVENT_MOVE
+
+        moves = history.query(event=EVENT_MOVE)
+        valid = ((moves["speed"] >= 0) & (moves["speed"] < n_speeds)
+                 & (moves["from_position"] >= 1) & (moves["from_position"] <= n_positions)
+                 & (moves["to_position"] >= 1) & (moves["to_position"] <= n_positions)
+                 & (moves["from_position"] != moves["to_position"]))
+        moves = moves[valid]
+        if len(moves) == 0:
+            return
+
+        self.overhead = 0.0
+        self._compute()
+        s = moves["speed"].astype(int)
+        i = moves["from_position"].astype(int) - 1
+        j = moves["to_position"].astype(int) - 1
+        self.overhead = float(np.median(moves["duration"] - self.table[s, i, j]))
+        self._compute()
+
+        cells = s * n_positions**2 + i * n_positions + j
+        for cell in np.unique(cells[s != SPEED_AUTO]):
+            durations = moves["duration"][cells == cell]
+            if len(durations) >= min_samples:
+                self.table.flat[cell] = float(np.median(durations))
+
+    def estimate(self, from_position, to_position, speed):
+        """Return the estimated time in ms to move from `from_position` to `to_position` at `speed`.
+
+        Raises:
+            ValueError: if a position is not 1-4, e.g. 0 while the wheel is not homed, or
+                the speed is not 0-3."""
+        if from_position not in range(1, n_positions + 1) or to_position not in range(1, n_positions + 1):
+            raise ValueError(f"Cannot estimate a move from position {from_position} to {to_position}")
+        if speed not in range(n_speeds):
+            raise ValueError(f"Speed must be 0-{n_speeds - 1}")
+        return float(self.table[speed, from_position - 1, to_position - 1])
@@ -0,0 +1,135 @@
+"""
+Move planning for the selector wheel.
+
+The four selector positions are equally spaced around a full turn of the wheel,
+so any move can be made in either direction.  The planner picks the direction of
+rotation for a move, respecting any limits on wrapping through a full turn.
+
+The firmware direction register (`A[10]`) takes one of the `DIRECTION_*` values.
+"""
+
+#: int: Number of selector positions in one turn of the wheel
+n_positions = 4
+
+#: float: Angle between adjacent positions in degrees
+position_angle = 360.0 / n_positions
+
+#: int: Take the shortest rotation, wrapping through position 4 <-> 1 if needed
+DIRECTION_SHORTEST = 0
+
+#: int: Rotate in the positive direction (increasing position number)
+DIRECTION_FORWARD = 1
+
+#: int: Rotate in the negative direction (decreasing position number)
+DIRECTION_REVERSE = -1
+
+#: int: Never wrap - move directly between positions as if there is a hard stop between 4 and 1
+DIRECTION_DIRECT = 2
+
+directions = (DIRECTION_SHORTEST, DIRECTION_FORWARD, DIRECTION_REVERSE, DIRECTION_DIRECT)
+
+
+def plan_move(from_position, to_position, direction=DIRECTION_SHORTEST, wrap=True, angle=None, max_turns=None):
+    """Plan a move between two positions.
+
+    Args:
+        from_position (int): Position to move from. One of 1-4.
+        to_position (int): Position to move to. One of 1-4.
+        direction (int): One of the DIRECTION_* values.
+        wrap (bool): If False, moves may not wrap through position 4 <-> 1, e.g. because of a
+            hard stop or cable wrap.
+        angle (float): Current angle of the wheel from home in degrees, including any full turns.
+            Needed to apply `max_turns`.
+        max_turns (float): Maximum number of full turns the wheel may wind beyond the single turn
+            starting at home, in either direction.
+
+    Returns:
+        int: Signed number of position steps to move. Positive values rotate forward.
+
+    Raises:
+        ValueError: If no move satisfies the direction and wrap constraints.
+    """
+    if direction not in directions:
+        raise ValueError(f"Direction must be one of {directions}")
+
+    direct = to_position - from_position
+    if direct == 0:
+        return 0
+
+    if not wrap or direction == DIRECTION_DIRECT:
+        if direction in (DIRECTION_FORWARD, DIRECTION_REVERSE) and direct * direction < 0:
+            raise ValueError(f"Cannot move from {from_position} to {to_position} in direction {direction} "
+                             "without wrapping")
+        return direct
+
+    forward = direct % n_positions
+    reverse = forward - n_positions
+    if direction == DIRECTION_FORWARD:
+        candidates = [forward]
+    elif direction == DIRECTION_REVERSE:
+        candidates = [reverse]
+    else:
+        # Shortest first.  For moves of half a turn, prefer the direction that unwinds
+        # the wheel towards home, or failing that the direct move.
+        candidates = sorted([forward, reverse], key=lambda steps: (abs(steps), steps != direct))
+        if angle is not None and abs(forward) == abs(reverse):
+            candidates.sort(key=lambda steps: abs(angle + steps * position_angle - 180.0))
+
+    for steps in candidates:
+        if max_turns is None or angle is None or _within_turns(angle + steps * position_angle, max_turns):
+            return steps
+
+    raise ValueError(f"Cannot move from {from_position} to {to_position} in direction {direction} "
+                     f"without exceeding {max_turns} turns from home")
+
+
+def _within_turns(angle, max_turns):
+    """Return True if `angle` is within `max_turns` turns of the turn starting at home."""
+    return -max_turns * 360.0 <= angle <= (max_turns + 1) * 360.0
+
+
+def check_sequence(from_position, positions, wrap=True, angle=None, max_turns=None):
+    """Check that a move sequence run by the controller stays within the turn limit.
+
+    The controller chooses the direction of each step itself: direct moves when wrapping
+    is not allowed, which never wind the wheel, and the shortest rotation otherwise.  The
+    shortest rotations are followed from `angle` through two passes of the sequence, which
+    covers every later pass unless a pass winds the wheel by a net number of turns.
+
+    Args:
+        from_position (int): Position the sequence starts from. One of 1-4.
+        positions (list): Position of each step, 1-4, or 5 to home.
+        wrap (bool): If False, the controller makes direct moves, which never wrap.
+        angle (float): Current angle of the wheel from home in degrees, including any full turns.
+        max_turns (float): Maximum number of full turns the wheel may wind beyond the single turn
+            starting at home, in either direction.
+
+    Raises:
+        ValueError: If a step could take the wheel beyond `max_turns`, a step is half a turn,
+            for which the controller may rotate either way, or each pass winds the wheel further.
+    """
+    if not wrap or max_turns is None or angle is None or from_position not in range(1, n_positions + 1):
+        return
+
+    position = from_position
+    for n_pass in range(2):
+        pass_angle = angle
+        for to_position in positions:
+            if to_position == n_positions + 1:
+                # A home unwinds the wheel, and returns to the same position
+                angle = (position - 1) * position_angle
+                pass_angle = None
+                continue
+            forward = (to_position - position) % n_positions
+            if forward * 2 == n_positions:
+                raise ValueError(f"Sequence step from {position} to {to_position} is half a turn, which the "
+                                 f"controller may make in either direction, so cannot be kept within {max_turns} turns")
+            steps = forward if forward * 2 < n_positions else forward - n_positions
+            angle += steps * position_angle
+            if not _within_turns(angle, max_turns):
+                raise ValueError(f"Sequence step from {position} to {to_position} would exceed {max_turns} "
+                                 "turns from home")
+            position = to_position
+        if n_pass == 1 and pass_angle is not None and angle != pass_angle:
+            raise ValueError(f"Each pass of the sequence winds the wheel by {(angle - pass_angle) / 360.0:g} "
+                             "turns, which would exceed the turn limit")
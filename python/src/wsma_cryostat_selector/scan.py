@@ -0,0 +1,136 @@
+"""
+Angle offset scans of the selector wheel, e.g. for aligning the polarizing grid.
+
+A stepped scan (`offset_scan`) runs the offsets as controller move sequences of up
+to `max_sequence_steps` points, so each batch of points costs a single download
+and readback rather than a round trip per point.  The controller records the angle
+and angle error at which each point settled.
+
+The controller only moves the wheel when its angle error exceeds the angle
+tolerance, so a stepped scan runs with the tighter `default_tolerance`, and its
+steps must be at least that large.
+
+A continuous sweep (`offset_sweep`) moves the wheel slowly through a range of
+offsets in a single move, while the controller records the wheel position at
+regular intervals.
+"""
+import time
+
+import numpy as np
+
+from wsma_cryostat_selector import SEQUENCE_IDLE, max_sequence_steps
+
+#: numpy.dtype: Fields of a stepped scan result. `offset` is the commanded offset, and
+#: `angle` and `angle_error` are the angle and angle error at which the wheel settled.
+scan_dtype = np.dtype([("timestamp", "<f8"), ("offset", "<f8"), ("angle", "<f8"), ("angle_error", "<f8")])
+
+#: numpy.dtype: Fields of a continuous sweep result. `offset` is the measured angle offset.
+sweep_dtype = np.dtype([("timestamp", "<f8"), ("angle", "<f8"), ("offset", "<f8")])
+
+#: float: Interval between polls of the controller while waiting for a scan or sweep, in seconds
+poll_interval = 0.1
+
+#: float: Angle tolerance used during a stepped scan, in degrees.  This is the smallest scan
+#: step.  It should stay a few resolver counts (1/45 degree each) above 0, or the controller
+#: keeps making corrective moves and falls back to homing the wheel.
+default_tolerance = 0.1
+
+
+def scan_offsets(start, stop, step):
+    """Return the offsets from `start` to `stop` inclusive in steps of `step` degrees."""
+    if step == 0:
+        raise ValueError("Scan step must not be 0")
+    n = int(np.floor((stop - start) / step + 1e-9)) + 1
+    if n < 1:
+        raise ValueError(f"No offsets from {start} to {stop} in steps of {step}")
+    return start + step * np.arange(n)
+
+
+def _wait(poll, timeout, stop):
+    """Wait until poll() returns SEQUENCE_IDLE, calling stop() and raising TimeoutError on timeout."""
+    start = time.monotonic()
+    while poll() != SEQUENCE_IDLE:
+        if timeout is not None and time.monotonic() - start > timeout:
+            stop()
+            raise TimeoutError(f"Scan did not finish within {timeout} s")
+        time.sleep(poll_interval)
+
+
+def offset_scan(selector, offsets, position=None, settle=0.0, timeout=None, tolerance=default_tolerance):
+    """Step the wheel through a list of angle offsets, recording where it settles at each.
+
+    The angle tolerance is set to `tolerance` for the scan, and restored afterwards.
+
+    Args:
+        selector (:obj:`Selector`): Selector to scan.
+        offsets (array): Angle offsets to step through, in degrees. See `scan_offsets`.
+        position (int): Position to scan about. Defaults to the current position.
+        settle (float): Time to wait at each offset, in seconds, before moving to the next.
+        timeout (float): Time allowed for each batch of `max_sequence_steps` offsets, in seconds.
+        tolerance (float): Angle tolerance to use during the scan, in degrees.
+
+    Returns:
+        numpy.ndarray: structured array with `scan_dtype`, one row per offset.
+
+    Raises:
+        ValueError: if a step between offsets is smaller than `tolerance`, so that the
+            controller would not move the wheel for it.
+    """
+    if position is None:
+        selector.update()
+        position = selector.position
+    offsets = np.asarray(offsets, dtype=float)
+    if len(offsets) > 1 and np.min(np.abs(np.diff(offsets))) < tolerance:
+        raise ValueError(f"Scan steps must be at least the scan tolerance of {tolerance} deg")
+    original = selector.get_angle_offset()
+    original_tolerance = selector.get_angle_tolerance()
+
+    result = np.empty(len(offsets), dtype=scan_dtype)
+    try:
+        selector.set_angle_tolerance(tolerance)
+        for first in range(0, len(offsets), max_sequence_steps):
+            batch = offsets[first:first + max_sequence_steps]
+            selector.upload_sequence([(position, offset, settle) for offset in batch])
+            selector.start_sequence(1)
+            _wait(lambda: selector.get_sequence_status()["state"], timeout, selector.stop_sequence)
+            points = selector.get_sequence_results()
+            rows = result[first:first + len(batch)]
+            rows["offset"] = batch
+            rows["timestamp"], rows["angle_error"], rows["angle"] = np.array(points).T
+    finally:
+        selector.set_angle_offset(original)
+        selector.set_angle_tolerance(original_tolerance)
+    return result
+
+
+def offset_sweep(selector, start, stop, rate, interval=0.016, timeout=None):
+    """Sweep the angle offset continuously from `start` to `stop`, recording the wheel angle.
+
+    The wheel is first moved to `start`, and is left at `stop`.
+
+    Args:
+        selector (:obj:`Selector`): Selector to sweep.
+        start (float): Angle offset to start the sweep at, in degrees.
+        stop (float): Angle offset to end the sweep at, in degrees.
+        rate (float): Sweep rate in degrees/s.
+        interval (float): Time between samples in seconds. See `Selector.start_sweep`.
+        timeout (float): Time allowed for the sweep, in seconds. Defaults to twice the
+            expected duration of the sweep.
+
+    Returns:
+        numpy.ndarray: structured array with `sweep_dtype`, one row per sample.
+    """
+    if timeout is None:
+        timeout = 2 * abs(stop - start) / rate + 10.0
+    selector.set_angle_offset(start)
+    selector.wait_for_move()
+
+    selector.start_sweep(stop, rate, interval)
+    _wait(selector.get_sweep_state, timeout, lambda: None)
+    samples = selector.get_sweep_samples()
+    selector.update()
+
+    result = np.empty(len(samples), dtype=sweep_dtype)
+    if samples:
+        result["timestamp"], result["angle"], result["offset"] = np.array(samples).T
+    return result
@@ -0,0 +1,222 @@
+"""
+Share the latest selector state with other processes on the same computer.
+
+The daemon writes a snapshot of the selector state into a small, fixed layout
+shared memory segment each time it reads the controller.  Other processes on the
+same computer can read the state from the segment with :obj:`StateReader`, without
+any load on the controller or SMA-X, e.g.::
+
+    with StateReader() as reader:
+        state = reader.read()
+        print(state["position"], state["angle"])
+
+Reads and writes are kept consistent with a seqlock: the writer makes the sequence
+counter odd while it is writing, and even again when it has finished, and the
+reader retries if the counter was odd or changed while it was copying the state.
+Readers never block the writer.
+
+Layout of the segment::
+
+    offset 0   magic (4 bytes, b"WSEL"), layout version (uint16), state size (uint16)
+    offset 8   sequence counter (uint64)
+    offset 16  state, packed as `state_fields`
+"""
+import struct
+import sys
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+#: str: Default name of the shared memory segment
+default_name = "wsma_selector"
+
+#: bytes: Magic number at the start of the segment
+magic = b"WSEL"
+
+#: int: Version of the segment layout. Changes whenever `state_fields` changes.
+layout_version = 1
+
+#: list: (name, struct format) of each field of the state, in the order they are stored
+state_fields = [
+    ("timestamp", "d"),
+    ("command_position", "i"),
+    ("position", "i"),
+    ("status", "i"),
+    ("speed", "i"),
+    ("status_word", "i"),
+    ("sequence", "i"),
+    ("angle", "d"),
+    ("angle_error", "d"),
+    ("angle_offset", "d"),
+]
+
+#: int: Number of times a reader retries a read that was interrupted by a write
+default_retries = 1000
+
+_header = struct.Struct("<4sHH")
+_counter = struct.Struct("<Q")
+_state = struct.Struct("<" + "".join(fmt for _, fmt in state_fields))
+_names = [name for name, _ in state_fields]
+
+# Segments created by writers in this process, which the resource tracker is following
+_created = set()
+
+_counter_offset = _header.size
+_state_offset = _counter_offset + _counter.size
+
+#: int: Size of the segment in bytes
+segment_size = _state_offset + _state.size
+
+
+def _attach(name):
+    """Attach to an existing segment without handing it to this process's resource tracker.
+
+    Otherwise the resource tracker unlinks the segment when a reader exits."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if name not in _created:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class StateWriter(object):
+    """Writes selector state snapshots to the shared memory segment.
+
+    Only one writer should use a segment at a time."""
+
+    def __init__(self, name=default_name):
+        """Create the shared memory segment, or reuse one left behind by a previous writer.
+
+        Args:
+            name (str): Name of the shared memory segment.
+        """
+        self.name = name
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=segment_size)
+            _created.add(name)
+        except FileExistsError:
+            self._shm = _attach(name)
+            if self._shm.size < segment_size:
+                self._shm.close()
+                raise ValueError(f"Existing shared memory segment {name} is too small "
+                                 f"({self._shm.size} < {segment_size} bytes)")
+        self._buf = self._shm.buf
+        self._seq = _counter.unpack_from(self._buf, _counter_offset)[0]
+        # An odd counter was left by a writer that died mid-write
+        if self._seq % 2:
+            self._seq += 1
+        _counter.pack_into(self._buf, _counter_offset, self._seq)
+        _header.pack_into(self._buf, 0, magic, layout_version, _state.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, **state):
+        """Write a state snapshot.
+
+        Args:
+            **state: Values of the fields in `state_fields`. Missing fields are written as 0,
+                and `timestamp` defaults to the current time.
+        """
+        state.setdefault("timestamp", time.time())
+        values = [state.get(name) or 0 for name in _names]
+        self._seq += 1
+        _counter.pack_into(self._buf, _counter_offset, self._seq)
+        _state.pack_into(self._buf, _state_offset, *values)
+        self._seq += 1
+        _counter.pack_into(self._buf, _counter_offset, self._seq)
+
+    def write_selector(self, selector, timestamp=None):
+        """Write the state last read from a :obj:`Selector`, stamped with the time it was sampled
+        on the controller unless `timestamp` is given."""
+        if not timestamp:
+            timestamp = getattr(selector, "timestamp", None) or time.time()
+        self.write(timestamp=timestamp,
+                   **{name: getattr(selector, name) for name in _names[1:]})
+
+    def close(self, unlink=True):
+        """Close the segment, and remove it unless `unlink` is False."""
+        if self._shm is None:
+            return
+        self._buf = None
+        self._shm.close()
+        if unlink:
+            if self.name not in _created:
+                # Reused segments are not followed by the resource tracker, so follow
+                # them now for unlink() to stop following.
+                resource_tracker.register(self._shm._name, "shared_memory")
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            _created.discard(self.name)
+        self._shm = None
+
+
+class StateReader(object):
+    """Reads selector state snapshots from the shared memory segment."""
+
+    def __init__(self, name=default_name, retries=default_retries):
+        """Attach to the shared memory segment written by the selector daemon.
+
+        Args:
+            name (str): Name of the shared memory segment.
+            retries (int): Number of times to retry a read that was interrupted by a write.
+
+        Raises:
+            FileNotFoundError: if the segment does not exist.
+            ValueError: if the segment does not have the expected layout.
+        """
+        self.name = name
+        self.retries = retries
+        self._shm = _attach(name)
+        found, version, size = _header.unpack_from(self._shm.buf, 0)
+        if found != magic or version != layout_version or size != _state.size:
+            self.close()
+            raise ValueError(f"Shared memory segment {name} does not hold selector state "
+                             f"(magic {found}, layout version {version})")
+        self._buf = self._shm.buf
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self):
+        """Return a consistent copy of the latest state.
+
+        Returns:
+            dict: The fields in `state_fields`, or None if nothing has been written yet.
+
+        Raises:
+            RuntimeError: if no consistent copy could be made, e.g. because the writer
+                died while writing.
+        """
+        buf = self._buf
+        for _ in range(self.retries):
+            before = _counter.unpack_from(buf, _counter_offset)[0]
+            if before % 2:
+                continue
+            values = _state.unpack_from(buf, _state_offset)
+            if _counter.unpack_from(buf, _counter_offset)[0] == before:
+                if before == 0:
+                    return None
+                return dict(zip(_names, values))
+        raise RuntimeError(f"Could not read a consistent state from {self.name}")
+
+    @property
+    def counter(self):
+        """int: Seqlock counter of the segment. Changes whenever a new state is written."""
+        return _counter.unpack_from(self._buf, _counter_offset)[0]
+
+    def close(self):
+        """Detach from the segment."""
+        if self._shm is None:
+            return
+        self._buf = None
+        self._shm.close()
+        self._shm = None
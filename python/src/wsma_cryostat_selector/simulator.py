@@ -0,0 +1,428 @@
+"""
+A simulated selector wheel controller.
+
+`SimulatedController` implements the parts of the gclib.py interface used by
+:obj:`Selector`, and responds to commands roughly as the controller running
+`selector_firmware_Dec2024.dmc` does: writing a position to `A[0]` starts a
+move that completes after the time predicted by :obj:`MoveTimeEstimator`, and
+writing 5 homes the wheel.  Move sequences downloaded to the `SQ*` arrays are
+run as the firmware's #SEQ subroutine does, and angle offset sweeps as #SWEEP does.
+
+It is intended for testing the Python code and daemon without hardware, e.g.::
+
+    sel = Selector("sim", client_factory=SimulatedController)
+"""
+import re
+import threading
+import time
+
+from wsma_cryostat_selector.galil import gclib
+
+from wsma_cryostat_selector.movetime import MoveTimeEstimator, position_spacing
+from wsma_cryostat_selector.planner import plan_move
+
+#: dict: Initial values of the controller variables, as set by the firmware #init code
+initial_variables = {
+    **{f"A[{i}]": 0.0 for i in range(30)},
+    "A[20]": 1.0,
+    "A[22]": 4.0,
+    "A[0]": 5.0,
+    "A[2]": 2.0,
+    "A[7]": 0.5,
+    "POS[0]": 153.0,
+    "POS[1]": 4249.0,
+    "POS[2]": 8345.0,
+    "POS[3]": 12441.0,
+    **{f"HPT[{i}]": 0.0 for i in range(4)},
+    **{f"POSC[{i}]": 0.0 for i in range(4)},
+    **{f"{array}[{i}]": 0.0 for array in ("SQP", "SQO", "SQD", "SQT", "SQE", "SQA") for i in range(32)},
+    **{f"{array}[{i}]": 0.0 for array in ("SWT", "SWP") for i in range(1000)},
+    "R[0]": 0.0,
+    "R[1]": 1.0,
+    "homefail": 0.0,
+    "maxmoves": 3.0,
+    "autoavg": 0.0,
+    "autolim": 1.5,
+    "rstep": 45.1111,
+    "rres": 16384.0,
+    "slowsp": 10000.0, "slowAC": 10000.0, "slowDC": 10000.0,
+    "medsp": 30000.0, "medAC": 50000.0, "medDC": 50000.0,
+    "fastsp": 75000.0, "fastAC": 150000.0, "fastDC": 150000.0,
+}
+
+#: float: Time taken to home the wheel in ms
+home_time = 8000.0
+
+#: list: Fraction of the home time spent in each home phase
+home_phase_fractions = [0.3, 0.5, 0.15, 0.05]
+
+#: str: Error raised by gclib when the controller rejects a command
+_question_mark = "question mark returned by controller"
+
+#: int: Move target used for an angle offset sweep
+_sweep_target = -1
+
+#: int: Maximum number of sequence steps simulated in a single poll
+_max_sequence_steps = 1000
+
+_assignment_re = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*(?:\[\d+\])?)\s*=\s*(.+)$")
+
+
+class SimulatedController(object):
+    """Simulated gclib client for the selector wheel controller."""
+
+    def __init__(self, time_scale=1.0, drift=0.0):
+        """Create a simulated controller.
+
+        Args:
+            time_scale (float): Factor by which simulated moves run faster than real time.
+            drift (float): Rate at which the angle error of the parked wheel drifts, in degrees
+                per second of simulated time.
+        """
+        self.time_scale = time_scale
+        self.drift = drift
+        self.is_open = False
+        self.program = ""
+        self._lock = threading.RLock()
+        self._estimator = MoveTimeEstimator()
+        self._reset()
+
+    def _reset(self):
+        """Reset the variables as if the program had been restarted at #AUTO."""
+        self.variables = dict(initial_variables)
+        self.running = True
+        self._start = time.monotonic()
+        self._move_end = None
+        self._move_start = None
+        self._move_target = None
+        self._home_return = 1
+        self._seq_step = 0
+        self._seq_wait = 0
+        self._seq_active = False
+        self._seq_offset = 0.0
+        self._seq_time = None
+        self._arrival = time.monotonic()
+        self._start_move(5)
+
+    def _now_ms(self):
+        return (time.monotonic() - self._start) * 1000.0
+
+    def _start_move(self, target, at=None):
+        """Begin a simulated move or home, at monotonic time `at` or now."""
+        if at is None:
+            at = time.monotonic()
+        v = self.variables
+        current = int(v["A[1]"])
+        if target == 5:
+            self._home_return = current if current in range(1, 5) else 1
+            duration = home_time
+            v["homefail"] = 1.0
+            v["A[27]"] += 1
+        else:
+            speed = int(v["A[2]"])
+            from_position = current if current in range(1, 5) else 1
+            direction = int(v["A[10]"])
+            steps = plan_move(from_position, target, wrap=direction != 2,
+                              direction=direction if direction in (-1, 1) else 0)
+            duration = self._estimator.counts_time(abs(steps) * position_spacing, speed) * 1000.0 + 50.0
+        v["A[3]"] = 1.0
+        self._move_target = target
+        self._move_start = (at - self._start) * 1000.0
+        self._move_end = at + duration / 1000.0 / self.time_scale
+        self._update_status_word()
+
+    def _step(self):
+        """Complete any simulated move whose time is up, and run any sequence."""
+        # Bounded, in case a sequence steps forever without moving or dwelling
+        for _ in range(_max_sequence_steps):
+            if self._move_end is not None and self._move_target == 5:
+                self._step_home_phase()
+            if self._move_end is not None:
+                if time.monotonic() < self._move_end:
+                    return
+                self._complete_move()
+            if self._move_end is None and self.variables["A[19]"] == 2:
+                self._start_sweep()
+                continue
+            if self._move_end is None and not self._step_sequence():
+                self._step_drift()
+                return
+
+    def _base_angle(self):
+        """Angle of the current position at zero angle offset."""
+        v = self.variables
+        return (int(v["A[1]"]) - 1) * 90.0 + v["POS[0]"] / v["rstep"]
+
+    def _start_sweep(self):
+        """Begin a simulated angle offset sweep."""
+        v = self.variables
+        v["A[19]"] = 1.0
+        v["A[3]"] = 1.0
+        v["A[25]"] = v[f"POS[{int(v['A[1]']) - 1}]"]
+        v["A[24]"] = v["A[25]"] - self._base_angle() * v["rstep"]
+        self._sweep_start = v["A[8]"]
+        duration = abs(v["A[21]"] - v["A[8]"]) / max(v["A[20]"], 1e-6)
+        now = time.monotonic()
+        self._move_target = _sweep_target
+        self._move_start = (now - self._start) * 1000.0
+        self._move_end = now + duration / self.time_scale
+        self._update_status_word()
+
+    def _complete_sweep(self):
+        """Record the samples of a simulated sweep, as RA/RD/RC do."""
+        v = self.variables
+        interval = 2 ** int(v["A[22]"])
+        start, end = self._move_start, (self._move_end - self._start) * 1000.0
+        count = min(int((end - start) // interval) + 1, 1000)
+        for i in range(count):
+            t = start + i * interval
+            offset = self._sweep_start + (v["A[21]"] - self._sweep_start) * (t - start) / max(end - start, 1e-9)
+            v[f"SWT[{i}]"] = float(int(t))
+            v[f"SWP[{i}]"] = v["A[25]"] + offset * v["rres"] / 360.0
+        v["A[23]"] = float(count)
+        v["A[8]"] = v["A[21]"]
+        v["A[5]"] = self._base_angle() + v["A[8]"]
+        v["A[19]"] = 0.0
+        v["A[3]"] = 0.0
+        self._arrival = self._move_end
+        self._move_end = None
+        self._update_status_word()
+
+    def _complete_move(self):
+        """Complete the simulated move."""
+        if self._move_target == _sweep_target:
+            self._complete_sweep()
+            return
+        v = self.variables
+        target = self._move_target
+        v["A[4]"] = float(int(self._now_ms() - self._move_start))
+        if target == 5:
+            v["homefail"] = 0.0
+            v["A[8]"] = 0.0
+            v["A[13]"] = 0.0
+            for i, fraction in enumerate(home_phase_fractions):
+                v[f"HPT[{i}]"] = float(int(home_time * fraction))
+            v["A[0]"] = float(self._home_return)
+            target = self._home_return
+        v["A[1]"] = float(target)
+        v["A[3]"] = 0.0
+        v["A[5]"] = (target - 1) * 90.0 + v["POS[0]"] / v["rstep"] + v["A[8]"]
+        v["A[6]"] = 0.0
+        v["A[9]"] = 1.0
+        if self._move_target != 5:
+            v["autoavg"] = v["autoavg"] * 0.8 + v["A[9]"] * 0.2
+        self._arrival = self._move_end
+        self._move_end = None
+        self._update_status_word()
+
+        # Like #EVENTLP, start the next move if the commanded position changed during this one
+        if int(v["A[0]"]) in range(1, 5) and v["A[0]"] != v["A[1]"]:
+            self._start_move(int(v["A[0]"]), at=self._arrival)
+
+    def _step_sequence(self):
+        """Advance a running move sequence while the wheel is stopped, as #SEQ does.
+
+        Returns:
+            bool: True if a move was started.
+        """
+        v = self.variables
+        if v["A[14]"] == 0 and not self._seq_active:
+            return False
+        if v["A[14]"] == 2:
+            self._seq_step = 0
+            self._seq_wait = 0
+            self._seq_active = True
+            self._seq_offset = v["A[8]"]
+            v["A[18]"] = 0.0
+            v["A[14]"] = 1.0
+            self._arrival = time.monotonic()
+        if v["A[14]"] == 0:
+            self._seq_active = False
+            v["A[8]"] = self._seq_offset
+            self._update_status_word()
+            return False
+        i = self._seq_step
+        if self._seq_wait == 0:
+            v["A[15]"] = float(i)
+            v["A[8]"] = v[f"SQO[{i}]"]
+            target = int(v[f"SQP[{i}]"])
+            v["A[0]"] = float(target)
+            self._seq_wait = 1
+            if target == 5 or (target in range(1, 5) and target != int(v["A[1]"])):
+                self._start_move(target, at=self._arrival)
+                return True
+            # Offset changes are simulated as instantaneous
+            v["A[5]"] = self._base_angle() + v["A[8]"]
+        if self._seq_wait == 1:
+            v[f"SQT[{i}]"] = float(int((self._arrival - self._start) * 1000.0))
+            v[f"SQE[{i}]"] = v["A[6]"]
+            v[f"SQA[{i}]"] = v["A[5]"]
+            self._seq_time = self._arrival
+            self._seq_wait = 2
+        dwell_end = self._seq_time + v[f"SQD[{i}]"] / 1000.0 / self.time_scale
+        if time.monotonic() < dwell_end:
+            return False
+        self._arrival = dwell_end
+        self._seq_wait = 0
+        self._seq_step = i + 1
+        if self._seq_step >= v["A[16]"]:
+            self._seq_step = 0
+            v["A[18]"] += 1
+            if v["A[17]"] > 0 and v["A[18]"] >= v["A[17]"]:
+                v["A[14]"] = 0.0
+                self._seq_active = False
+                v["A[8]"] = self._seq_offset
+                self._update_status_word()
+                return False
+        return True
+
+    def _step_drift(self):
+        """Drift the angle error of the parked wheel, correcting it as #EVENTLP does when it
+        exceeds the angle tolerance."""
+        v = self.variables
+        if not self.drift or self._seq_active or v["A[1]"] != v["A[0]"]:
+            return
+        v["A[6]"] = self.drift * (time.monotonic() - self._arrival) * self.time_scale
+        if abs(v["A[6]"]) > v["A[7]"]:
+            v["A[26]"] += 1
+            self._start_move(int(v["A[0]"]))
+        else:
+            self._update_status_word()
+
+    def _step_home_phase(self):
+        """Set the home phase register from the time elapsed in a simulated home."""
+        elapsed = (self._now_ms() - self._move_start) * self.time_scale / home_time
+        phase = 1
+        for fraction in home_phase_fractions[:-1]:
+            if elapsed < fraction:
+                break
+            elapsed -= fraction
+            phase += 1
+        self.variables["A[13]"] = float(phase)
+
+    def _update_status_word(self):
+        """Update the packed status word and sequence number, as #STATW does."""
+        v = self.variables
+        word = 0
+        if v["A[3]"] == 1:
+            word += 1
+        if v["A[1]"] == v["A[0]"]:
+            word += 2
+        if abs(v["A[6]"]) < v["A[7]"]:
+            word += 4
+        if v["homefail"] == 1:
+            word += 8
+        if v["A[14]"] != 0:
+            word += 4096
+        word += int(v["A[1]"]) * 16 + int(v["A[0]"]) * 256
+        if word != v["A[11]"]:
+            v["A[11]"] = float(word)
+            v["A[12]"] += 1
+
+    def _value(self, operand):
+        """Evaluate a single MG operand."""
+        operand = operand.strip()
+        if operand.startswith('"'):
+            return operand.strip('"')
+        if operand == "TIME":
+            return int(self._now_ms())
+        if operand == "_BGA":
+            return 1.0 if self._move_end is not None else 0.0
+        if operand == "_TPA":
+            return self.variables["A[5]"] * self.variables["rstep"]
+        if operand in self.variables:
+            return self.variables[operand]
+        try:
+            return float(operand)
+        except ValueError:
+            raise gclib.GclibError(_question_mark)
+
+    def _command(self, cmd):
+        """Execute a single command and return its response."""
+        v = self.variables
+        cmd = cmd.strip()
+        if cmd == "":
+            return ""
+        if cmd.startswith("MG"):
+            values = [self._value(op) for op in cmd[2:].split(",")]
+            return " ".join(val if isinstance(val, str) else f"{val:.4f}" for val in values)
+        if cmd == "WH":
+            return "IHA"
+        if cmd == "TH":
+            return ("CONTROLLER IP ADDRESS 192,168,42,100 ETHERNET ADDRESS 00-50-4C-20-4B-74\r\n"
+                    "IHA TCP PORT 23 TO IP ADDRESS 192,168,42,1 PORT 49152\r\n"
+                    + "".join(f"IH{h} AVAILABLE\r\n" for h in "BCDEF"))
+        if cmd.startswith("IH") or cmd in ("BP", "ST", "STA"):
+            return ""
+        if cmd == "HX":
+            self.running = False
+            return ""
+        if cmd.startswith("XQ"):
+            self._reset()
+            return ""
+        match = _assignment_re.match(cmd)
+        if match:
+            name, value = match.groups()
+            try:
+                value = float(self._value(value))
+            except ValueError:
+                raise gclib.GclibError(_question_mark)
+            v[name] = value
+            if name == "A[0]" and self.running and self._move_end is None:
+                target = int(value)
+                if target in range(1, 5) and target != int(v["A[1]"]):
+                    self._start_move(target)
+                elif target == 5:
+                    self._start_move(5)
+            self._update_status_word()
+            return ""
+        raise gclib.GclibError(_question_mark)
+
+    def GOpen(self, address):
+        self.is_open = True
+
+    def GClose(self):
+        self.is_open = False
+
+    def GCommand(self, command):
+        """Execute a command, or several commands separated by ';'."""
+        if not self.is_open:
+            raise gclib.GclibError("device not open")
+        with self._lock:
+            self._step()
+            responses = [self._command(c) for c in command.split(";")]
+            self._step()
+        return " ".join(r for r in responses if r)
+
+    def GMotionComplete(self, axes):
+        while True:
+            with self._lock:
+                self._step()
+                if self._move_end is None:
+                    return
+            time.sleep(0.01)
+
+    def GArrayDownload(self, name, first, last, array_data):
+        with self._lock:
+            self._step()
+            for i, value in zip(range(first, last + 1), array_data):
+                key = f"{name}[{i}]"
+                if key not in self.variables:
+                    raise gclib.GclibError(_question_mark)
+                self.variables[key] = float(value)
+
+    def GArrayUpload(self, name, first, last):
+        with self._lock:
+            self._step()
+            try:
+                return [self.variables[f"{name}[{i}]"] for i in range(first, last + 1)]
+            except KeyError:
+                raise gclib.GclibError(_question_mark)
+
+    def GProgramDownload(self, program, preprocessor=""):
+        if self.running:
+            raise gclib.GclibError(_question_mark)
+        self.program = program
+
+    def GProgramUpload(self):
+        return self.program
@@ -0,0 +1,275 @@
+"""
+Capture and replay of the command/response stream with the controller.
+
+A :obj:`TranscriptRecorder` attached to a connection records every command sent to
+the controller, with its response (or error), the time it was sent and how long
+the controller took to answer, in a compact binary log.  A :obj:`ReplayClient`
+plays a transcript back as a gclib.py-like client, at the original or an
+accelerated speed, so that field incidents can be reproduced and daemon changes
+benchmarked without the hardware, e.g.::
+
+    sel = Selector("replay",
+                   client_factory=functools.partial(ReplayClient, "incident.wst", speed=10))
+
+Array and program transfers are recorded as the equivalent controller commands:
+`QD` with the downloaded values for array downloads, `QU` for array uploads,
+`UL` for program uploads, and `DL` with a hash of the program for program
+downloads.
+
+Layout of a transcript file::
+
+    header  magic (4 bytes, b"WSTR"), version (uint16), reserved (uint16), start time (double, Unix time)
+    entry   time since start (double, s), duration (float, s), flags (uint8),
+            command length (uint16), response length (uint32), command, response
+"""
+import collections
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+
+from wsma_cryostat_selector.galil import gclib
+
+#: bytes: Magic number at the start of a transcript file
+magic = b"WSTR"
+
+#: int: Version of the transcript file layout
+version = 1
+
+#: int: Entry flag set when the command raised an error, whose message is stored as the response
+FLAG_ERROR = 1
+
+#: int: Default number of entries the replay searches ahead for a matching command
+default_lookahead = 32
+
+#: str: Error raised by gclib when the controller rejects a command
+_question_mark = "question mark returned by controller"
+
+_assignment_re = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(?:\[\d+\])?=[^;]+$")
+
+#: float: Interval between polls when replaying a wait for motion to complete, in seconds
+#: at the original speed
+motion_poll_interval = 0.05
+
+_header = struct.Struct("<4sHHd")
+_entry = struct.Struct("<dfBHI")
+
+#: A recorded command. `time` is in seconds from the start of the transcript,
+#: `duration` is the time taken by the controller to respond in seconds, and `error` is
+#: True if the command raised an error, in which case `response` is the error message.
+TranscriptEntry = collections.namedtuple("TranscriptEntry", ["time", "duration", "command", "response", "error"])
+
+
+def array_download_command(name, first, last, array_data):
+    """Return the command recorded for a download of `array_data` to elements first-last of `name`."""
+    return f"QD {name}[],{first},{last} " + ",".join(repr(float(v)) for v in array_data)
+
+
+def array_upload_command(name, first, last):
+    """Return the command recorded for an upload of elements first-last of `name`."""
+    return f"QU {name}[],{first},{last},1"
+
+
+def array_upload_response(values):
+    """Return the response recorded for the `values` returned by an array upload."""
+    return ",".join(repr(float(v)) for v in values)
+
+
+def parse_array_upload(response):
+    """Return the values of a recorded array upload response."""
+    return [float(v) for v in response.replace(",", " ").split()]
+
+
+def program_download_command(program):
+    """Return the command recorded for a program download.
+
+    The program itself may be longer than a transcript entry allows, so it is recorded
+    by its hash."""
+    return "DL " + hashlib.sha1(program.encode("ascii", errors="replace")).hexdigest()
+
+
+class TranscriptRecorder(object):
+    """Records commands and responses to a transcript file."""
+
+    def __init__(self, path):
+        """Open a transcript file for recording, appending to it if it already exists.
+
+        Args:
+            path (str): Path of the transcript file.
+        """
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._fp = open(self.path, "ab+")
+        self._fp.seek(0)
+        header = self._fp.read(_header.size)
+        if header:
+            found, found_version, _, self.start = _header.unpack(header)
+            if found != magic or found_version != version:
+                self._fp.close()
+                raise ValueError(f"{self.path} is not a version {version} transcript")
+        else:
+            self.start = time.time()
+            self._fp.write(_header.pack(magic, version, 0, self.start))
+        #: int: Number of entries recorded by this recorder
+        self.entries = 0
+
+    def record(self, sent, duration, command, response, error=False):
+        """Record a single command.
+
+        Args:
+            sent (float): Unix time at which the command was sent.
+            duration (float): Time taken for the response in seconds.
+            command (str): Command sent to the controller.
+            response (str): Response from the controller, or the error message.
+            error (bool): True if the command raised an error.
+        """
+        command = command.encode("ascii", errors="replace")
+        response = response.encode("ascii", errors="replace")
+        data = _entry.pack(sent - self.start, duration, FLAG_ERROR if error else 0,
+                           len(command), len(response)) + command + response
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.write(data)
+            # Flush every entry, so that the transcript survives a crash
+            self._fp.flush()
+            self.entries += 1
+
+    def close(self):
+        """Close the transcript file."""
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def read_transcript(path):
+    """Read all the entries of a transcript file.
+
+    Returns:
+        tuple: (start, entries) where start is the Unix time the transcript was started, and
+            entries is a list of :obj:`TranscriptEntry`.
+    """
+    with open(os.path.expanduser(path), "rb") as fp:
+        data = fp.read()
+    found, found_version, _, start = _header.unpack_from(data, 0)
+    if found != magic or found_version != version:
+        raise ValueError(f"{path} is not a version {version} transcript")
+
+    entries = []
+    offset = _header.size
+    while offset + _entry.size <= len(data):
+        t, duration, flags, n_command, n_response = _entry.unpack_from(data, offset)
+        offset += _entry.size
+        if offset + n_command + n_response > len(data):
+            # Truncated by a crash while recording
+            break
+        command = data[offset:offset + n_command].decode("ascii")
+        offset += n_command
+        response = data[offset:offset + n_response].decode("ascii")
+        offset += n_response
+        entries.append(TranscriptEntry(t, duration, command, response, bool(flags & FLAG_ERROR)))
+    return start, entries
+
+
+class ReplayClient(object):
+    """A gclib.py-like client that answers commands from a recorded transcript.
+
+    Each command is answered with the response of the next matching entry in the transcript,
+    after the time the controller originally took to respond divided by `speed`.  Entries
+    that the replayed code does not ask for (e.g. because it polled a move fewer times than
+    the original) are skipped, searching up to `lookahead` entries ahead.  Commands with no
+    matching entry within the lookahead are answered with the most recent response to
+    the same command.  If there is none, variable assignments are accepted and other
+    commands are rejected with a question mark error."""
+
+    def __init__(self, transcript, speed=1.0, lookahead=default_lookahead):
+        """Create a replay client.
+
+        Args:
+            transcript (str or list): Path of a transcript file, or a list of :obj:`TranscriptEntry`.
+            speed (float): Factor by which to speed up the controller's responses.
+                0 answers every command immediately.
+            lookahead (int): Number of entries to search ahead for a matching command.
+        """
+        if isinstance(transcript, str):
+            _, transcript = read_transcript(transcript)
+        self.entries = transcript
+        self.speed = speed
+        self.lookahead = lookahead
+        self.is_open = False
+        self._index = 0
+        self._last = {}
+        self._lock = threading.Lock()
+
+        #: int: Number of transcript entries skipped because they were not asked for
+        self.skipped = 0
+        #: int: Number of commands answered from an earlier response, or rejected
+        self.unmatched = 0
+
+    @property
+    def exhausted(self):
+        """bool: True when every entry of the transcript has been replayed or skipped."""
+        return self._index >= len(self.entries)
+
+    def _next(self, command):
+        """Return the entry that answers `command`, advancing through the transcript."""
+        with self._lock:
+            stop = min(self._index + self.lookahead, len(self.entries))
+            for i in range(self._index, stop):
+                if self.entries[i].command == command:
+                    self.skipped += i - self._index
+                    self._index = i + 1
+                    self._last[command] = self.entries[i]
+                    return self.entries[i]
+            self.unmatched += 1
+            return self._last.get(command)
+
+    def GOpen(self, address):
+        self.is_open = True
+
+    def GClose(self):
+        self.is_open = False
+
+    def GCommand(self, command):
+        if not self.is_open:
+            raise gclib.GclibError("device not open")
+        entry = self._next(command)
+        if entry is None:
+            if self.exhausted:
+                raise gclib.GclibError("transcript exhausted")
+            if _assignment_re.match(command):
+                return ""
+            raise gclib.GclibError(_question_mark)
+        if self.speed:
+            time.sleep(entry.duration / self.speed)
+        if entry.error:
+            raise gclib.GclibError(entry.response)
+        return entry.response
+
+    def GMotionComplete(self, axes):
+        """Replay the polls of a wait for motion to complete.
+
+        The wait ends when the motion is reported complete, or when the transcript has no
+        more polls for it, as the original wait ended there."""
+        for axis in axes:
+            while True:
+                unmatched = self.unmatched
+                if float(self.GCommand(f"MG _BG{axis}")) == 0 or self.unmatched != unmatched:
+                    break
+                if self.speed:
+                    time.sleep(motion_poll_interval / self.speed)
+
+    def GProgramUpload(self):
+        return self.GCommand("UL")
+
+    def GProgramDownload(self, program, preprocessor=""):
+        self.GCommand(program_download_command(program))
+
+    def GArrayDownload(self, name, first, last, array_data):
+        self.GCommand(array_download_command(name, first, last, array_data))
+
+    def GArrayUpload(self, name, first, last):
+        return parse_array_upload(self.GCommand(array_upload_command(name, first, last)))